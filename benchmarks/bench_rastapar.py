@@ -0,0 +1,341 @@
+"""Benchmarks of the raster ingestion with `rastapar`.
+
+Synthetic GeoTIFFs are generated offline, block by block so that their size is only limited by the disk,
+and converted with `rastapar` for several numbers of workers and engines. Every run is a separate process,
+so that its peak resident memory, including the one of its workers, can be measured.
+
+The results are written in a JSON file, with a description of the machine, and can be compared with a stored
+baseline such as 'benchmarks/baseline.json', which is only meaningful on a similar machine:
+
+    python benchmarks/bench_rastapar.py --sizes small medium -o bench.json
+    python benchmarks/bench_rastapar.py -o bench.json --baseline benchmarks/baseline.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pyarrow
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+# side of the square synthetic rasters, in pixels
+sizes = {
+    "tiny": 256,  # 65 k pixels, to check that the benchmarks run
+    "small": 2_048,  # 4 M pixels, a few MB
+    "medium": 16_384,  # 268 M pixels, about 1 GB in float32
+    "large": 65_536,  # 4.3 G pixels, about 17 GB in float32
+    "xlarge": 131_072,  # 17 G pixels, about 69 GB in float32
+}
+
+# origin and pixel size of the rasters in each CRS, so that they cover a region of a few degrees
+crs_grids = {
+    "epsg:4326": (-10.0, 60.0, 1e-3),
+    "epsg:3857": (-1_100_000.0, 8_400_000.0, 100.0),
+}
+
+layouts = ["tiled", "striped"]
+
+dtypes = ["uint8", "int16", "float32"]
+
+# fraction of a run slower than the baseline before it is reported as a regression
+tolerance = 0.1
+
+# runs of each case, the fastest of which is kept to leave out the noise of the machine
+repeat = 3
+
+
+def dataset_name(size: str, dtype: str, layout: str, nodata: float, crs: str) -> str:
+    """A name identifying the parameters of a synthetic raster."""
+    return f"{size}_{dtype}_{layout}_nd{int(nodata * 100)}_{crs.replace(':', '')}"
+
+
+def make_raster(
+    filename: str,
+    side: int,
+    dtype: str = "float32",
+    layout: str = "tiled",
+    nodata: float = 0.5,
+    crs: str = "epsg:4326",
+    seed: int = 0,
+):
+    """Write a synthetic square raster, one strip of blocks at a time.
+
+    Parameters
+    ----------
+    filename : str
+        The GeoTIFF to write
+    side : int
+        The number of rows and columns
+    dtype : str, optional
+        The data type of the band, by default "float32"
+    layout : str, optional
+        'tiled' for 512x512 blocks, 'striped' for blocks of single rows, by default "tiled"
+    nodata : float, optional
+        The fraction of nodata pixels, the left part of the raster, as in the oceans of global rasters, by default 0.5
+    crs : str, optional
+        One of `crs_grids`, by default "epsg:4326"
+    seed : int, optional
+        The seed of the values, by default 0
+    """
+    x0, y0, res = crs_grids[crs]
+    nodata_value = 0
+    profile = {
+        "driver": "GTiff",
+        "height": side,
+        "width": side,
+        "count": 1,
+        "dtype": dtype,
+        "crs": crs,
+        "transform": from_origin(x0, y0, res, res),
+        "nodata": nodata_value,
+        "compress": "deflate",
+        "BIGTIFF": "IF_SAFER",
+    }
+
+    if layout == "tiled":
+        profile |= {"tiled": True, "blockxsize": 512, "blockysize": 512}
+    else:
+        profile |= {"tiled": False, "blockysize": 1}
+
+    # rows written at a time
+    strip = 512
+
+    rng = np.random.default_rng(seed)
+    empty_cols = int(side * nodata)
+
+    with rasterio.open(filename, "w", **profile) as dst:
+        for row in range(0, side, strip):
+            height = min(strip, side - row)
+            values = rng.integers(1, 100, (height, side)).astype(dtype)
+            values[:, :empty_cols] = nodata_value
+            dst.write(values, 1, window=Window(0, row, side, height))
+
+
+def run_case(in_file: str, out_path: str, workers: int, engine: str, extra: list) -> dict:
+    """Convert a raster in a separate process, measuring its time and peak memory."""
+    shutil.rmtree(out_path, ignore_errors=True)
+
+    cmd = [
+        sys.executable,
+        "-m",
+        "scalenav.rast_convert_par",
+        in_file,
+        "-o_p",
+        out_path,
+        "-w",
+        str(workers),
+        "--engine",
+        engine,
+    ] + extra
+
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    # the usage of the child includes the workers it waited for
+    _, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.perf_counter() - start
+
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"Run failed : {' '.join(cmd)}")
+
+    output_bytes = 0
+    for root, _, files in os.walk(out_path):
+        output_bytes += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+
+    return {
+        "seconds": seconds,
+        # kilobytes on Linux
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+        "output_mb": output_bytes / 2**20,
+    }
+
+
+def machine_info() -> dict:
+    """A description of the machine and the versions of the libraries, stored with the results."""
+    # the benchmarks measure the peak memory with `os.wait4`, they run on Unix
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+    return {
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "memory_gb": round(memory / 2**30, 1),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pyarrow": pyarrow.__version__,
+        "rasterio": rasterio.__version__,
+        "gdal": rasterio.__gdal_version__,
+    }
+
+
+def load_results(filename: str) -> list[dict]:
+    """The records of a results file, with or without the description of its machine."""
+    with open(filename) as f:
+        results = json.load(f)
+
+    return results["results"] if isinstance(results, dict) else results
+
+
+def case_key(record: dict) -> str:
+    """The identifier of a benchmark case, to compare with a baseline."""
+    return f"{record['dataset']}_w{record['workers']}_{record['engine']}"
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float = tolerance) -> list[dict]:
+    """Compare the throughput of the cases with the ones of a baseline.
+
+    Parameters
+    ----------
+    results : list[dict]
+        The records of the current runs
+    baseline : list[dict]
+        The records of the baseline runs
+    tolerance : float, optional
+        The fraction of throughput lost before a case is a regression, by default `tolerance`
+
+    Returns
+    -------
+    list[dict]
+        For each case in both, its 'case', the 'speedup' over the baseline and whether it is a 'regression'.
+    """
+    previous = {case_key(record): record for record in baseline}
+    comparison = []
+
+    for record in results:
+        key = case_key(record)
+        if key not in previous:
+            continue
+        speedup = record["pixels_per_s"] / previous[key]["pixels_per_s"]
+        comparison.append(
+            {
+                "case": key,
+                "speedup": speedup,
+                "peak_rss_ratio": record["peak_rss_mb"] / previous[key]["peak_rss_mb"],
+                "regression": speedup < 1 - tolerance,
+            }
+        )
+
+    return comparison
+
+
+def bench(args=None):
+    """Generate the synthetic rasters, run the cases and write the results."""
+    parser = argparse.ArgumentParser(
+        prog="Rastapar benchmarks",
+        description="Measure the throughput and memory of rastapar on synthetic rasters",
+    )
+    parser.add_argument("--sizes", nargs="+", default=["small"], choices=list(sizes))
+    parser.add_argument("--dtypes", nargs="+", default=["float32"], choices=dtypes)
+    parser.add_argument("--layouts", nargs="+", default=["tiled"], choices=layouts)
+    parser.add_argument("--nodata", nargs="+", default=[0.5], type=float)
+    parser.add_argument("--crs", nargs="+", default=["epsg:4326"], choices=list(crs_grids))
+    parser.add_argument("--workers", "-w", nargs="+", default=[1, 4], type=int)
+    parser.add_argument("--engines", nargs="+", default=["threads", "processes"])
+    parser.add_argument(
+        "--extra",
+        default="",
+        help="Other options given to rastapar, for example '--profile fast-read'.",
+        type=str,
+    )
+    parser.add_argument(
+        "--data_path",
+        default="bench_data",
+        help="A folder keeping the synthetic rasters between runs. Default: %(default)s",
+    )
+    parser.add_argument("--out_path", "-o", default="bench_rastapar.json")
+    parser.add_argument(
+        "--baseline",
+        default=None,
+        help="The results of a previous run to compare with, exits with an error on regressions.",
+    )
+    parser.add_argument("--tolerance", default=tolerance, type=float)
+    parser.add_argument(
+        "--repeat",
+        default=repeat,
+        help="Runs of each case, the fastest one is kept. Default: %(default)s",
+        type=int,
+    )
+    parser.add_argument(
+        "--notes",
+        default="",
+        help="A description of the conditions of the runs, stored with the results.",
+        type=str,
+    )
+
+    args = vars(parser.parse_args(args))
+
+    os.makedirs(args["data_path"], exist_ok=True)
+    out_fold = os.path.join(args["data_path"], "out")
+
+    results = []
+
+    for size, dtype, layout, nodata, crs in itertools.product(
+        args["sizes"], args["dtypes"], args["layouts"], args["nodata"], args["crs"]
+    ):
+        name = dataset_name(size, dtype, layout, nodata, crs)
+        in_file = os.path.join(args["data_path"], name + ".tif")
+
+        if not os.path.exists(in_file):
+            print("Generating : ", in_file)
+            make_raster(in_file, sizes[size], dtype, layout, nodata, crs)
+
+        pixels = sizes[size] ** 2
+        data_mb = pixels * np.dtype(dtype).itemsize / 2**20
+
+        for workers, engine in itertools.product(args["workers"], args["engines"]):
+            record = {
+                "dataset": name,
+                "size": size,
+                "dtype": dtype,
+                "layout": layout,
+                "nodata": nodata,
+                "crs": crs,
+                "workers": workers,
+                "engine": engine,
+                "pixels": pixels,
+            }
+            runs = [
+                run_case(in_file, out_fold, workers, engine, args["extra"].split())
+                for _ in range(max(1, args["repeat"]))
+            ]
+            record |= min(runs, key=lambda run: run["seconds"])
+            record["runs_seconds"] = [run["seconds"] for run in runs]
+            # the largest footprint of the runs, which do not all peak alike
+            record["peak_rss_mb"] = max(run["peak_rss_mb"] for run in runs)
+            record["pixels_per_s"] = pixels / record["seconds"]
+            record["mb_per_s"] = data_mb / record["seconds"]
+
+            print(
+                f"{case_key(record)} : {record['seconds']:.2f} s, "
+                f"{record['pixels_per_s'] / 1e6:.1f} Mpx/s, {record['mb_per_s']:.1f} MB/s, "
+                f"peak RSS {record['peak_rss_mb']:.0f} MB, output {record['output_mb']:.1f} MB"
+            )
+            results.append(record)
+
+    shutil.rmtree(out_fold, ignore_errors=True)
+
+    with open(args["out_path"], "w") as f:
+        json.dump({"machine": machine_info(), "notes": args["notes"], "results": results}, f, indent=2)
+
+    if args["baseline"] is not None:
+        baseline = load_results(args["baseline"])
+
+        comparison = compare(results, baseline, args["tolerance"])
+        for case in comparison:
+            flag = "REGRESSION" if case["regression"] else ""
+            print(f"{case['case']} : x{case['speedup']:.2f} {flag}")
+
+        if any(case["regression"] for case in comparison):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    bench()
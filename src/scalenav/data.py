@@ -1,5 +1,6 @@
 from os.path import exists
-from numpy import array, meshgrid, arange, log
+from numpy import array, meshgrid, arange, log, asarray, frompyfunc, stack, repeat, bincount
+from numpy import uint64 as np_uint64
 from rasterio.transform import xy
 from rasterio import open
 
@@ -11,6 +12,7 @@ from shapely.geometry import Point, box, Polygon
 from pandas import Series, concat, DataFrame
 from math import pi, cos
 import h3
+import h3.api.basic_int as h3_int
 from re import search
 from scalenav.utils import earth_radius_meters, A, alpha
 
@@ -165,22 +167,68 @@ def rast_to_h3_map(x: float = 0.0, y: float = 51.51, ref: str = "m", dist: float
 rast_to_h3 = rast_to_h3_map(x=0, y=0)
 
 
-def centre_cell_to_square(h3_cell: str, neighbs: list[tuple[int]]) -> list[str]:
-    """If a centroid h3 index is known, return the square cover for a cell and grid_param"""
+def _local_ij(cell: int) -> tuple[int, int]:
+    """The local ij coordinates of a cell relative to itself."""
+    return h3_int.cell_to_local_ij(cell, cell)
+
+
+def _local_ij_to_cell(origin: int, i: int, j: int) -> int:
+    """The cell at local ij coordinates relative to an origin, 0 where they can not be resolved, such as across pentagons."""
+    try:
+        return h3_int.local_ij_to_cell(origin, i, j)
+    except h3.H3BaseException:
+        return 0
+
 
-    sql = """SQL
-    select *, array_value h3_gridded
-    h3_local_ij_to_cell(h3_id,neighbs[:][0],neighbs[:][1])
+_cells_local_ij = frompyfunc(_local_ij, 1, 2)
+_cells_local_ij_to_cell = frompyfunc(_local_ij_to_cell, 3, 1)
+
+
+def square_cover(cells, neighbs: list[tuple[int]], values=None):
+    """The square covers of many centre cells at once, and optionally their values split evenly over the cells of each cover.
+    This is the array version of `centre_cell_to_square` over uint64 ids, such as the pixel centre cells of a raster.
+    The h3 bindings have no array functions for local ij coordinates, so each cell and offset is still one call of h3.
+
+    Parameters
+    ----------
+    cells : np.ndarray
+        uint64 ids of the centre cells, at the resolution the offsets were computed for
+    neighbs : list[tuple[int]]
+        The local ij offsets of the cells covering a square, see `rast_to_h3_map`
+    values : np.ndarray, optional
+        Values of the centre cells, by default None
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray] | tuple[np.ndarray, np.ndarray, np.ndarray]
+        The index of the centre cell and the uint64 id of each cell of the covers, and the share of the value of its
+        centre cell if `values` is given. The offsets that can not be resolved, near pentagons, are dropped.
     """
+    cells = asarray(cells, dtype=np_uint64)
+    i, j = _cells_local_ij(cells)
+
+    # one column of the covers per offset
+    covers = stack(
+        [_cells_local_ij_to_cell(cells, i + di, j + dj) for (di, dj) in neighbs], axis=1
+    ).astype(np_uint64)
+
+    index = repeat(arange(len(cells)), len(neighbs))
+    covers = covers.ravel()
+    keep = covers != 0
+    index, covers = index[keep], covers[keep]
+
+    if values is None:
+        return index, covers
 
-    ref_cell_ij = h3.cell_to_local_ij(origin=h3_cell, h=h3_cell)
+    sizes = bincount(index, minlength=len(cells))
+    return index, covers, asarray(values)[index] / sizes[index]
+
+
+def centre_cell_to_square(h3_cell: str, neighbs: list[tuple[int]]) -> list[str]:
+    """If a centroid h3 index is known, return the square cover for a cell and grid_param, see `square_cover` for many cells."""
+    _, covers = square_cover([h3.str_to_int(h3_cell)], neighbs)
 
-    return [
-        h3.local_ij_to_cell(
-            origin=h3_cell, i=cell_i + ref_cell_ij[0], j=cell_j + ref_cell_ij[1]
-        )
-        for (cell_i, cell_j) in neighbs
-    ]
+    return [h3.int_to_str(int(cell)) for cell in covers]
 
 
 def layer_constrain(layer: [DataFrame, GeoDataFrame], constraint: [DataFrame, Series]):
@@ -3,6 +3,7 @@ into methods associated to objects that have a defined structure and therefore a
 
 # from pathlib import Path
 import os 
+import json
 from ibis import table,to_sql,_,duckdb
 import ibis.selectors as s
 from ibis.backends.duckdb import *
@@ -12,6 +13,12 @@ from numpy import random,all,unique
 from duckdb import connect as ddb_connect
 from scalenav.utils import *
 from itertools import chain
+from glob import glob
+from math import floor
+from pyarrow.parquet import read_schema
+from pyproj import CRS
+from shapely.geometry import box
+import h3
 
 configs = {
     "memory_limit" : "500MB"
@@ -233,6 +240,201 @@ def connect(database : str = ':memory:',interactive : bool = True, preload_ext :
     
     return conn
 
+def schema_metadata(path : str) -> dict:
+    """The schema metadata of the first parquet file of a path, a folder or a glob pattern, empty if there is none."""
+    if os.path.isdir(path):
+        files = glob(os.path.join(path,"**","*.parquet"),recursive=True)
+    else:
+        files = glob(path,recursive=True)
+
+    if len(files)==0:
+        return {}
+
+    return read_schema(files[0]).metadata or {}
+
+
+def partition_spec(path : str):
+    """Read how a rastapar output was partitioned from the schema metadata of one of its files.
+
+    Parameters
+    ----------
+    path : str
+        a path to a parquet file, a folder or a glob pattern
+
+    Returns
+    -------
+    str | None
+        The partitioning specification, such as 'h3:3' or 'tile:1.0', or None if the files are not partitioned.
+    """
+    spec = schema_metadata(path).get(b"scalenav:partition")
+
+    return spec.decode() if spec is not None else None
+
+
+def grid_spec(path : str):
+    """Read the grid of the pixel ids of a rastapar output written with `--grid_index` from the schema metadata of one of its files.
+
+    Parameters
+    ----------
+    path : str
+        a path to a parquet file, a folder or a glob pattern
+
+    Returns
+    -------
+    dict | None
+        The 'crs' of the grid and the 'transform', 'width' and 'height' of each of its 'sources', or None for other outputs.
+    """
+    grid = schema_metadata(path).get(b"scalenav:grid")
+
+    return json.loads(grid) if grid is not None else None
+
+
+def encoding_spec(path : str):
+    """Read how the band values of a rastapar output written with `--encoding` were encoded from the schema metadata of one of its files.
+
+    Parameters
+    ----------
+    path : str
+        a path to a parquet file, a folder or a glob pattern
+
+    Returns
+    -------
+    dict | None
+        For each encoded column, its 'type', the 'scale' and 'offset' decoding its codes and the 'source_type' of the raster, or None for other outputs.
+    """
+    encoding = schema_metadata(path).get(b"scalenav:encoding")
+
+    return json.loads(encoding) if encoding is not None else None
+
+
+def decoded_columns(encoding : dict) -> str:
+    """SQL replacing the integer codes of the encoded columns by the values they stand for, `code * scale + offset`.
+    The float16 columns are read as floats by DuckDB and are kept as they are.
+
+    Parameters
+    ----------
+    encoding : dict
+        The encoding of the output, see `encoding_spec`
+
+    Returns
+    -------
+    str
+        A `REPLACE` clause of a `SELECT *`, empty if there is nothing to decode.
+    """
+    exprs = [
+        f"({name}::DOUBLE * {param['scale']!r}::DOUBLE + {param['offset']!r}::DOUBLE)::{'FLOAT' if param['source_type']=='float32' else 'DOUBLE'} as {name}"
+        for name, param in encoding.items()
+        if param["type"]!="float16"
+    ]
+
+    return f"REPLACE ({', '.join(exprs)})" if len(exprs)>0 else ""
+
+
+def grid_coords(grid : dict, pixel_id : str = "pixel_id", source : str = "source") -> tuple[str,str]:
+    """SQL expressions of the coordinates of the pixel centres of a grid index output, from the affine transform of its grid.
+
+    Parameters
+    ----------
+    grid : dict
+        The grid of the output, see `grid_spec`
+    pixel_id : str
+        the column with the pixel ids
+    source : str
+        the column with the name of the source of the rows, used when the output has several sources
+
+    Returns
+    -------
+    tuple[str,str]
+        The SQL expressions of the x and y coordinates, in the CRS of the grid.
+    """
+    exprs = {}
+    for name, src in grid["sources"].items():
+        a, b, c, d, e, f = src["transform"]
+        col = f"({pixel_id} % {src['width']} + 0.5)"
+        row = f"({pixel_id} // {src['width']} + 0.5)"
+        # literals are doubles, not decimals
+        a, b, c, d, e, f = (f"{v!r}::DOUBLE" for v in (a, b, c, d, e, f))
+        exprs[name] = (f"{a}*{col} + {b}*{row} + {c}", f"{d}*{col} + {e}*{row} + {f}")
+
+    if len(exprs)==1:
+        return next(iter(exprs.values()))
+
+    return tuple(
+        f"CASE {source} " + " ".join(f"WHEN '{name.replace("'", "''")}' THEN {expr[i]}" for name, expr in exprs.items()) + " END"
+        for i in range(2)
+    )
+
+
+def grid_view(conn, name : str, path : str, res : int = None, coords = ["lon","lat"]):
+    """Create a view of a grid index output, computing the coordinates of the pixels, and optionally their H3 cells,
+    only when it is queried.
+
+    Parameters
+    ----------
+    conn : ibis.backends.duckdb.Backend
+        an ibis connection to a duckDB database, with the h3 extension loaded if `res` is given
+    name : str
+        a name for the view
+    path : str
+        a path to a parquet file or folder with parquet files written with `--grid_index`
+    res : int
+        if given, an 'h3_id' column with the cells of this resolution is added, which requires a geographic CRS
+    coords : list[str]
+        the column names of the coordinates
+
+    Returns
+    ----------------
+    ibis.Table
+        An ibis table object connected to the view.
+    """
+    grid = grid_spec(path)
+
+    if grid is None:
+        raise ValueError("The files were not written with '--grid_index'.")
+
+    if res is not None and not CRS.from_user_input(grid["crs"]).is_geographic:
+        raise ValueError(f"The H3 cells need longitudes and latitudes, the grid is in {grid['crs']}.")
+
+    x, y = grid_coords(grid)
+    source = os.path.join(path,"**","*.parquet") if os.path.isdir(path) else path
+    h3_id = f", h3_h3_to_string(h3_latlng_to_cell({y},{x},{res})) as h3_id" if res is not None else ""
+
+    conn.raw_sql(f"create or replace view {name} as (select *, {x} as {coords[0]}, {y} as {coords[1]}{h3_id} from read_parquet('{source}'));")
+
+    return conn.table(name)
+
+
+def partition_filter(spec : str, bbox : list) -> str:
+    """SQL condition on the hive partition columns keeping only the partitions that intersect a bbox, 
+    so that DuckDB skips the other directories.
+
+    Parameters
+    ----------
+    spec : str
+        A partitioning specification, 'h3:<res>' or 'tile:<size>'
+    bbox : list
+        [xmin,ymin,xmax,ymax]
+
+    Returns
+    -------
+    str
+        A SQL condition
+    """
+    kind, _, param = spec.partition(":")
+
+    if kind=="tile":
+        size = float(param)
+        return f"lon_tile BETWEEN {floor(bbox[0]/size)} AND {floor(bbox[2]/size)} AND lat_tile BETWEEN {floor(bbox[1]/size)} AND {floor(bbox[3]/size)}"
+    
+    res = int(param)
+    corners = [h3.latlng_to_cell(lat,lng,res) for lng in (bbox[0],bbox[2]) for lat in (bbox[1],bbox[3])]
+    cells = set(h3.geo_to_cells(box(*bbox),res=res)) | set(corners)
+    # cells partially covering the bbox have their centre outside of it
+    cells = set(chain.from_iterable(h3.grid_disk(cell,1) for cell in cells))
+
+    return f"h3_r{res} IN (" + ",".join(f"'{cell}'" for cell in sorted(cells)) + ")"
+
+
 def table(
     conn, 
     name : str, 
@@ -260,6 +462,9 @@ def table(
     Notes
     ---------------
     The function support an additional keyword argument at the moment. You can provide a `bbox` to filter values from the data. The format for the parameter is [xmin,ymin,xmax,ymax]. 
+    If `path` is a rastapar output written with `--partition`, only the partition directories intersecting the bbox are read.
+    If it was written with `--grid_index`, the coordinates are computed from the pixel ids, see `grid_coords`.
+    If it was written with `--encoding`, the band values are decoded, see `decoded_columns`.
     Another parameter is `overwrite` to overwirte an existing backend table with the same name.
 
 
@@ -279,13 +484,37 @@ def table(
             if name in conn.list_tables():
                 return conn.table(name)
 
+    spec = partition_spec(path)
+    grid = grid_spec(path)
+
+    if spec is None:
+        relation = f"'{path}'"
+    else:
+        source = os.path.join(path,"**","*.parquet") if os.path.isdir(path) else path
+        relation = f"read_parquet('{source}', hive_partitioning = true)"
+
+    if grid is not None:
+        # grid index output, the coordinates are rebuilt from the transform of the grid
+        x, y = grid_coords(grid)
+        relation = f"(select *, {x} as {coords[0]}, {y} as {coords[1]} from {relation})"
+
+    encoding = encoding_spec(path)
+
+    if encoding is not None:
+        # quantised band values, decoded when the table is created
+        relation = f"(select * {decoded_columns(encoding)} from {relation})"
+
     if "bbox" in kwargs.keys():
         print("Reading bbox")
-        conn.raw_sql(f"{q_startup} table {name} as (select * from '{path}' where {coords[0]}>{kwargs["bbox"][0]} AND {coords[0]}<{kwargs["bbox"][2]} AND {coords[1]}>{kwargs["bbox"][1]} AND {coords[1]}<{kwargs["bbox"][3]});")
+        if spec is None:
+            conn.raw_sql(f"{q_startup} table {name} as (select * from {relation} where {coords[0]}>{kwargs["bbox"][0]} AND {coords[0]}<{kwargs["bbox"][2]} AND {coords[1]}>{kwargs["bbox"][1]} AND {coords[1]}<{kwargs["bbox"][3]});")
+        else:
+            print("Reading partitions ", spec)
+            conn.raw_sql(f"{q_startup} table {name} as (select * from {relation} where {partition_filter(spec,kwargs["bbox"])} AND {coords[0]}>{kwargs["bbox"][0]} AND {coords[0]}<{kwargs["bbox"][2]} AND {coords[1]}>{kwargs["bbox"][1]} AND {coords[1]}<{kwargs["bbox"][3]});")
         return conn.table(name)
     else : 
         try :
-            conn.raw_sql(f"{q_startup} table {name} as (select * from '{path}');")
+            conn.raw_sql(f"{q_startup} table {name} as (select * from {relation});")
             return conn.table(name)
         except:
             if name in conn.list_tables():
@@ -383,6 +612,7 @@ def change_res(input : ib.Table,levels : int = 1,transform_expr : dict = None) -
         ---------------
         ib.Table
             A downscaled ibis table where the columns identified with a `_var` suffix have been aggregated or disaggregated depending on the direction of the scale change.
+            When aggregating, the `_class` columns of categorical rasters take the majority class and the `_frac` columns the average fraction.
         
     
     """
@@ -431,6 +661,9 @@ def change_res(input : ib.Table,levels : int = 1,transform_expr : dict = None) -
         
         if transform_expr is None:
             transform_expr = { x : ( _[x].sum() ) for x in input.columns if re.search(pattern="_var$",string=x)}
+            # the classes of categorical rasters are not additive : majority class and average fraction of the children
+            transform_expr |= { x : ( _[x].mode() ) for x in input.columns if re.search(pattern="_class$",string=x)}
+            transform_expr |= { x : ( _[x].mean() ) for x in input.columns if re.search(pattern="_frac$",string=x)}
         
         return (
             input
@@ -440,6 +673,56 @@ def change_res(input : ib.Table,levels : int = 1,transform_expr : dict = None) -
             .agg(**transform_expr)
 )
 
+def square_cover(input : ib.Table, neighbs : list[tuple[int]], transform_expr : dict = None) -> ib.Table:
+    """Spread the values of pixels over the H3 cells covering the square of each pixel, in the DuckDB backend.
+    Each pixel is expanded to the cells at the local ij offsets of its centre cell, its `_var` values are divided evenly between them
+    and the shares are summed per cell. The offsets that can not be resolved, near pentagons, are dropped and the values are divided
+    between the remaining cells. This is the set based version of `scalenav.data.centre_cell_to_square`.
+
+        Parameters
+        --------------
+        input : 
+            a table with an `h3_id` column containing the centre cells of the pixels, at the resolution the offsets were computed for
+        neighbs : 
+            the local ij offsets of the cells covering a pixel, such as `scalenav.data.rast_to_h3["1000"]["nn"]` for 1 km pixels,
+            whose centre cells are at the resolution `scalenav.data.rast_to_h3["1000"]["h3_res"]`
+        transform_expr : 
+            A dictionary with column names as keys and aggregations of the shares of the pixels in values, by default the sums of the `_var` columns.
+
+        Returns
+        ---------------
+        ib.Table
+            A table with one row per covered cell.
+    """
+    alias_code = alias_generator()
+
+    if "h3_id" not in input.columns:
+        raise Warning("Project data into h3 first with `project`.")
+
+    offsets = ", ".join(f"({i},{j})" for (i,j) in neighbs)
+    var_cols = [x for x in input.columns if re.search(pattern="_var$",string=x)]
+
+    if transform_expr is None:
+        transform_expr = { x : _[x].sum() for x in var_cols }
+
+    # the offsets are joined to every pixel, each with its share of the values of the pixel among the cells resolved
+    shares = ", ".join(f"{x} / count(*) over (partition by _pixel) as {x}" for x in var_cols)
+    values = ", ".join(var_cols)
+
+    return (
+        input
+        .alias(alias_code)
+        .sql(f"""Select h3_id{", " + shares if len(shares)>0 else ""}
+                FROM
+                    (Select h3_local_ij_to_cell(h3_id, ij[1] + di, ij[2] + dj) as h3_id, _pixel{", " + values if len(values)>0 else ""}
+                    FROM
+                        (SELECT *, h3_cell_to_local_ij(h3_id, h3_id) as ij, row_number() over () as _pixel FROM {alias_code})
+                    CROSS JOIN (VALUES {offsets}) offsets(di, dj))
+                WHERE h3_id IS NOT NULL;""")
+        .group_by("h3_id")
+        .agg(**transform_expr)
+)
+
 def add_centr(input : ib.Table):
     """Add the centroid of a hex cell in the table expression.
     
@@ -767,7 +1050,7 @@ def reduce(table, columns : dict, exclude : bool = True, print_query : bool = Fa
 
     reduce_statement = ",".join([" + ".join([val for val in columns[key]]) + f" as {key}" for key in columns.keys()])
     
-    full_query = f"SELECT *, " + reduce_statement + f" FROM {alias};"
+    full_query = "SELECT *, " + reduce_statement + f" FROM {alias};"
 
     if print_query:
         print("Running query : ", full_query)
@@ -1,26 +1,91 @@
 # rast_convert_par.py
 import itertools
 import os
+import re
+import json
+import hashlib
+import builtins
+import tempfile
+from glob import glob
 
 from rasterio.vrt import WarpedVRT
 from rasterio.crs import CRS
+from rasterio.enums import MaskFlags, Resampling
+from rasterio.windows import Window
 from rasterio import open
 
 import numpy as np
+import h3
+import duckdb
+import shapely
+from geopandas import read_file
 
+import collections
+import resource
+import time
 import concurrent.futures
+import contextlib
+import threading
+from queue import Queue
+import multiprocessing
+from functools import partial
 
-from pyarrow import float32, schema, RecordBatch
-from pyarrow.parquet import ParquetWriter
+from pyarrow import (
+    RecordBatchReader,
+    concat_tables,
+    Table,
+    DictionaryArray,
+    array as pa_array,
+    dictionary,
+    int32,
+    uint64,
+    string,
+    field,
+    schema,
+    from_numpy_dtype,
+)
+from pyarrow.parquet import (
+    ParquetFile,
+    ParquetWriter,
+    SortingColumn,
+    read_metadata,
+    read_table,
+    write_metadata,
+    write_table,
+)
 import pyarrow.compute as pc
+import pyarrow.types as pa_types
 
 from scalenav.rast_converter import (
-    rast_convert_core,
+    rast_convert_arrow,
+    rast_convert_bands,
+    rast_convert_h3,
+    rast_convert_time,
+    class_schema,
+    h3_class_schema,
+    time_schema,
+    band_times,
+    time_chunk_bands,
+    h3_partial_schema,
+    h3_area_partial_schema,
+    h3_cells,
+    h3_parents,
+    raster_schema,
+    bands_schema,
     check_crs,
     check_nodata,
-    check_path,
+    check_paths,
     infer_dtype,
     check_out_crs,
+    coords_transformer,
+    grid_schema,
+    grid_metadata_key,
+    encodings,
+    encoding_metadata_key,
+    encoded_schema,
+    decoded_schema,
+    encode_batch,
+    lap,
 )
 
 from sys import argv
@@ -32,84 +97,2499 @@ dst_crs = CRS.from_epsg(4326)
 
 ##### Process
 
-writer_args = {
-    "write_statistics": False,
+# settings of the parquet writers, 'row_group_size' rows are buffered into each row group
+# and with 'sort_rows' they are sorted on the spatial key within the row groups.
+writer_profiles = {
+    # ingest throughput: light compression, no statistics and few large row groups
+    "fast-write": {
+        "row_group_size": 1_000_000,
+        "compression": "lz4",
+        "use_dictionary": ["source"],
+        "write_statistics": False,
+        "sort_rows": False,
+    },
+    # DuckDB scans: row groups of the size DuckDB parallelises over, sorted rows with
+    # statistics and page index so that filters on 'h3_id' or 'lon', 'lat' skip most of them
+    "fast-read": {
+        "row_group_size": 122_880,
+        "compression": "zstd",
+        "compression_level": 6,
+        "write_statistics": True,
+        "write_page_index": True,
+        "sort_rows": True,
+    },
 }
 
-nodata = 0
-nodata_filter_expr = pc.field("band_var") != nodata
-negative_filter_expr = pc.greater(pc.field("band_var"), 0)
+writer_args = writer_profiles["fast-write"]
 
+# number of windows handed out to a worker at a time
+chunk_size = 4
 
-def process(
+# pixels of the read windows smaller native blocks, such as the single rows of striped rasters, are merged into
+window_target_pixels = 65_536
+
+# largest number of pixels read when estimating the valid pixels of the windows
+weights_max_pixels = 1_000_000
+
+# classes of the windows found by the pre-pass on the masks,
+# the unsure windows are empty in the overviews and are checked at full resolution by the workers
+window_empty, window_mixed, window_full, window_unsure = 0, 1, 2, 3
+window_classes_names = {"empty": window_empty, "mixed": window_mixed, "full": window_full, "unsure": window_unsure}
+
+# aggregations available when projecting on the H3 grid in the workers
+h3_aggs = ["sum", "mean", "count"]
+
+# aggregations of the classes of a categorical raster per H3 cell: wide pixel counts or fractions
+# per class, the majority class, or a long table of the counts and fractions of the classes of each cell
+class_aggs = ["count", "fraction", "majority", "long"]
+
+# fraction of the range of the values added on each side when deriving the scale of an integer encoding
+encoding_margin = 0.01
+
+# number of partial rows a worker keeps before merging them
+h3_compact_rows = 1_000_000
+
+# rows of a partition a worker buffers before writing them into a file
+partition_flush_rows = 1_000_000
+
+# rows a worker buffers over all the partitions before writing the largest one
+partition_buffer_rows = 4_000_000
+
+# key of the schema metadata recording how the output is partitioned
+partition_metadata_key = b"scalenav:partition"
+
+# pixels along the average edge of an H3 cell below which a level of a pyramid is read decimated
+pyramid_pixels_per_edge = 4
+
+# decimated pixels along a side of the windows of the coarse levels of a pyramid
+pyramid_window_pixels = 1024
+
+# rows sorted in memory into each run of the external sort of `consolidate`
+consolidate_run_rows = 4_000_000
+
+# rows read at a time from each run while merging them
+consolidate_merge_rows = 65_536
+
+# largest number of runs merged at once, more runs are merged in several passes
+consolidate_fan_in = 64
+
+# target size of the consolidated files, the rows are spread evenly over the files
+consolidate_file_mb = 256
+
+
+def writer_options(profile: str = "fast-write", **overrides) -> dict:
+    """The settings of the parquet writers for a profile of `writer_profiles`, with the given overrides if not None.
+
+    Parameters
+    ----------
+    profile : str, optional
+        'fast-write' or 'fast-read', by default "fast-write"
+    **overrides
+        Settings replacing the ones of the profile, such as 'compression', 'compression_level' or 'row_group_size'
+
+    Returns
+    -------
+    dict
+        Keyword arguments for `open_writer` and `atomic_write_table`.
+    """
+    if profile not in writer_profiles:
+        raise ValueError(f"Unknown writer profile '{profile}', use one of {list(writer_profiles)}")
+
+    return writer_profiles[profile] | {k: v for k, v in overrides.items() if v is not None}
+
+
+def row_order(schema) -> list[tuple]:
+    """The sort keys of the rows of an output: the H3 cells or the pixel ids if any, the latitude and longitude otherwise."""
+    if "h3_id" in schema.names:
+        return [("h3_id", "ascending")]
+    if "pixel_id" in schema.names:
+        return [("pixel_id", "ascending")]
+    return [("lat", "ascending"), ("lon", "ascending")]
+
+
+def can_estimate_weights(src, band: int = 1) -> bool:
+    """Whether the valid pixels of a raster can be estimated without reading all of its data,
+    that is if it has overviews or a mask that does not derive from the nodata value.
+    """
+    flags = src.mask_flag_enums[band - 1]
+    return len(src.overviews(band)) > 0 or MaskFlags.per_dataset in flags
+
+
+def window_weights(src, windows: list, estimate: bool = True, band: int = 1):
+    """Estimate the number of valid pixels in each window from a decimated read of the raster mask.
+
+    Parameters
+    ----------
+    src : DatasetReader | WarpedVRT
+        The dataset the windows refer to
+    windows : list
+        A list of rasterio windows
+    estimate : bool, optional
+        Whether to read the mask, if False the weight is the area of the window, by default True
+    band : int, optional
+        The band to read the mask of, by default 1
+
+    Returns
+    -------
+    np.ndarray
+        The estimated number of valid pixels of each window.
+    """
+    areas = np.array([win.width * win.height for win in windows], dtype=float)
+
+    if not estimate or len(windows) == 0:
+        return areas
+
+    try:
+        mask, scale = decimated_mask(src, band, Resampling.average)
+    except Exception:
+        return areas
+
+    valid, cells = window_sums(mask / 255.0, windows, scale)
+
+    return areas * valid / cells
+
+
+def decimated_mask(src, band: int, resampling):
+    """Read the mask of a band at a resolution of at most `weights_max_pixels` pixels,
+    from the overviews when there are any.
+
+    Returns
+    -------
+    tuple[np.ndarray, int]
+        The mask and the number of pixels of the dataset along a side of its pixels.
+    """
+    scale = max(1, int(np.ceil(np.sqrt(src.width * src.height / weights_max_pixels))))
+    shape = (int(np.ceil(src.height / scale)), int(np.ceil(src.width / scale)))
+
+    return src.read_masks(band, out_shape=shape, resampling=resampling), scale
+
+
+def window_sums(grid, windows: list, scale: int):
+    """Sum the values of a decimated grid over the cells covering each window.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The sums and the number of cells covering each window.
+    """
+    # integral image of the grid to sum any window in constant time
+    integral = np.zeros((grid.shape[0] + 1, grid.shape[1] + 1))
+    integral[1:, 1:] = grid.cumsum(0).cumsum(1)
+
+    rows_0 = np.array([int(win.row_off) // scale for win in windows])
+    cols_0 = np.array([int(win.col_off) // scale for win in windows])
+    rows_1 = np.array(
+        [-(-int(win.row_off + win.height) // scale) for win in windows]
+    ).clip(max=grid.shape[0])
+    cols_1 = np.array(
+        [-(-int(win.col_off + win.width) // scale) for win in windows]
+    ).clip(max=grid.shape[1])
+
+    sums = (
+        integral[rows_1, cols_1]
+        - integral[rows_0, cols_1]
+        - integral[rows_1, cols_0]
+        + integral[rows_0, cols_0]
+    )
+    cells = np.maximum((rows_1 - rows_0) * (cols_1 - cols_0), 1)
+
+    return sums, cells
+
+
+def window_classes(src, windows: list, estimate: bool = True, band: int = 1, overviews: bool = False):
+    """Classify windows as `window_empty`, `window_full` or `window_mixed` from a decimated read of the mask.
+    GDAL marks a cell of a decimated mask valid as soon as one of its pixels is, so a window is empty
+    when all the cells covering it are invalid. The masks of overviews built with nearest resampling, the default
+    of gdaladdo, miss isolated valid pixels, so with overviews the windows found empty are `window_unsure`,
+    to be checked at full resolution by the workers, see `source_windows`.
+    A window is full when all the cells covering it are valid, which only hints that it has few invalid pixels.
+
+    Parameters
+    ----------
+    src : DatasetReader | WarpedVRT
+        The dataset the windows refer to
+    windows : list
+        A list of rasterio windows
+    estimate : bool, optional
+        Whether the mask can be read cheaply, if False all the windows are mixed, by default True
+    band : int, optional
+        The band to read the mask of, by default 1
+    overviews : bool, optional
+        Whether the decimated mask is read from overviews, by default False
+
+    Returns
+    -------
+    np.ndarray
+        The class of each window.
+    """
+    classes = np.full(len(windows), window_mixed)
+
+    if not estimate or len(windows) == 0:
+        return classes
+
+    try:
+        mask, scale = decimated_mask(src, band, Resampling.average)
+    except Exception:
+        return classes
+
+    valid, cells = window_sums(mask > 0, windows, scale)
+
+    classes[valid == 0] = window_unsure if overviews else window_empty
+    classes[valid == cells] = window_full
+
+    return classes
+
+
+def plan_windows(dataset, target_pixels: int = window_target_pixels, max_pixels: int | None = None) -> list:
+    """The read windows of a dataset, from its native blocks: blocks smaller than `target_pixels` are merged
+    along the rows of blocks then across them, and blocks larger than `max_pixels` are split into bands of rows,
+    so that the windows always start on block boundaries and a read never decodes a block twice but for the splits.
+
+    Parameters
+    ----------
+    dataset : DatasetReader | WarpedVRT
+        The dataset to read
+    target_pixels : int, optional
+        The number of pixels of the merged windows, by default `window_target_pixels`
+    max_pixels : int | None, optional
+        If given, the largest number of pixels of a window, to bound the memory of the workers, by default None
+
+    Returns
+    -------
+    list
+        The rasterio windows covering the dataset.
+    """
+    block_h, block_w = dataset.block_shapes[0]
+    block = block_h * block_w
+
+    if max_pixels is not None and block > max_pixels:
+        rows = max(1, max_pixels // block_w)
+        cols = block_w if rows > 1 or block_w <= max_pixels else max_pixels
+        windows = []
+        for _, window in dataset.block_windows():
+            for row in range(0, int(window.height), rows):
+                for col in range(0, int(window.width), cols):
+                    windows.append(
+                        Window(
+                            window.col_off + col,
+                            window.row_off + row,
+                            min(cols, window.width - col),
+                            min(rows, window.height - row),
+                        )
+                    )
+        return windows
+
+    if block >= target_pixels:
+        return [window for _, window in dataset.block_windows()]
+
+    limit = target_pixels if max_pixels is None else min(target_pixels, max_pixels)
+    blocks_x = min(-(-dataset.width // block_w), max(1, limit // block))
+    blocks_y = max(1, limit // (block * blocks_x))
+    step_h, step_w = block_h * blocks_y, block_w * blocks_x
+
+    return [
+        Window(col, row, min(step_w, dataset.width - col), min(step_h, dataset.height - row))
+        for row in range(0, dataset.height, step_h)
+        for col in range(0, dataset.width, step_w)
+    ]
+
+
+def schedule(windows: list, weights, size: int = chunk_size) -> list[tuple]:
+    """Group consecutive windows into small chunks and order them by decreasing weight,
+    so that the heaviest work is handed out first and the light chunks fill in the idle workers at the end.
+
+    Parameters
+    ----------
+    windows : list
+        A list of rasterio windows
+    weights : np.ndarray
+        The estimated amount of work of each window
+    size : int, optional
+        The number of windows in a chunk, by default `chunk_size`
+
+    Returns
+    -------
+    list[tuple]
+        Chunks of windows.
+    """
+    chunks = list(itertools.batched(windows, size))
+    chunk_weights = [
+        sum(batch) for batch in itertools.batched(weights, size)
+    ]
+    order = sorted(range(len(chunks)), key=lambda i: -chunk_weights[i])
+    return [chunks[i] for i in order]
+
+
+def queued_windows(queue):
+    """Windows handed out from a shared queue, one chunk at a time, until a None sentinel is received.
+    The items of the queue are pairs of a chunk id and a chunk of windows."""
+    for _, chunk in iter(queue.get, None):
+        yield from chunk
+
+
+def parse_partition(partition: str) -> tuple:
+    """Read a partitioning specification, either 'h3:<res>' for the parent H3 cells at a resolution
+    or 'tile:<size>' for lon/lat tiles of a size in degrees.
+
+    Returns
+    -------
+    tuple
+        The kind of partition and its resolution or size.
+    """
+    kind, _, param = partition.partition(":")
+
+    if kind == "h3":
+        return kind, int(param or 3)
+    elif kind == "tile":
+        return kind, float(param or 1)
+
+    raise ValueError(f"Unknown partition '{partition}', use 'h3:<res>' or 'tile:<size>'.")
+
+
+def partition_keys(batch, partition: tuple):
+    """Integer partition key of each row of a batch, from its 'h3_id' or its 'lon' and 'lat' columns."""
+    kind, param = partition
+
+    if kind == "h3":
+        if "h3_id" in batch.schema.names:
+            return h3_parents(batch["h3_id"].to_numpy(), param)
+        return h3_cells(
+            batch["lat"].to_numpy().astype(float),
+            batch["lon"].to_numpy().astype(float),
+            param,
+        )
+
+    lon_tile = np.floor(batch["lon"].to_numpy() / param).astype(np.int64)
+    lat_tile = np.floor(batch["lat"].to_numpy() / param).astype(np.int64)
+    return (lon_tile << 32) + lat_tile
+
+
+def partition_dir(key, partition: tuple) -> str:
+    """Hive style directory of a partition key."""
+    kind, param = partition
+
+    if kind == "h3":
+        return f"h3_r{param}={h3.int_to_str(int(key))}"
+
+    key = int(key)
+    lat_tile = ((key + 2**31) % 2**32) - 2**31
+    lon_tile = (key - lat_tile) >> 32
+    return os.path.join(f"lon_tile={lon_tile}", f"lat_tile={lat_tile}")
+
+
+class PartitionedWriter:
+    """Writes the rows of the batches into hive style partition directories such as 'h3_r3=<cell>/part-<name>-<n>.parquet'
+    so that queries on a region can skip whole directories. The rows of a partition are buffered and sorted
+    before they are written, which makes the row group statistics useful. It follows the interface of `ParquetWriter`.
+
+    Parameters
+    ----------
+    out_fold : str
+        The root folder of the partitions
+    name : str
+        A name unique to the writer, used in the file names
+    schema : pyarrow.Schema
+        The schema of the batches
+    partition : str
+        A partitioning specification, see `parse_partition`
+    """
+
+    def __init__(self, out_fold: str, name: str, schema, partition: str, **kwargs) -> None:
+        self.out_fold = out_fold
+        self.name = name
+        self.partition = parse_partition(partition)
+        self.schema = schema.with_metadata(
+            (schema.metadata or {}) | {partition_metadata_key: partition.encode()}
+        )
+        # the rows of a partition are always sorted
+        self.writer_args = writer_args | {"write_statistics": True} | kwargs | {"sort_rows": True}
+
+        self.buffers = {}
+        self.rows = {}
+        self.files = []
+
+    def write_batch(self, batch):
+        keys = partition_keys(batch, self.partition)
+        uniques, inverse = np.unique(keys, return_inverse=True)
+
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.cumsum(np.bincount(inverse))[:-1]
+
+        for key, indices in zip(uniques, np.split(order, bounds)):
+            self.buffers.setdefault(key, []).append(batch.take(indices))
+            self.rows[key] = self.rows.get(key, 0) + len(indices)
+
+            if self.rows[key] >= partition_flush_rows:
+                self.flush(key)
+
+        while sum(self.rows.values()) > partition_buffer_rows:
+            self.flush(max(self.rows, key=self.rows.get))
+
+    def write_table(self, table):
+        for batch in table.to_batches():
+            self.write_batch(batch)
+
+    def flush(self, key):
+        """Sort the buffered rows of a partition and write them into a new file."""
+        rows = Table.from_batches(self.buffers.pop(key), schema=self.schema)
+        self.rows.pop(key)
+
+        folder = os.path.join(self.out_fold, partition_dir(key, self.partition))
+        os.makedirs(folder, exist_ok=True)
+
+        where = os.path.join(folder, f"part-{self.name}-{len(self.files)}.parquet")
+        atomic_write_table(rows, where, **self.writer_args)
+        self.files.append(where)
+
+    def close(self):
+        for key in list(self.buffers):
+            self.flush(key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def atomic_write_table(table, where: str, sort_rows: bool = False, **kwargs):
+    """Write a table into a temporary file renamed once complete, so a crash never leaves a partial parquet file.
+    With `sort_rows`, the rows are sorted following `row_order` first."""
+    if sort_rows:
+        keys = row_order(table.schema)
+        table = table.sort_by(keys)
+        kwargs["sorting_columns"] = SortingColumn.from_ordering(table.schema, keys)
+
+    write_table(table, where + ".tmp", **kwargs)
+    os.replace(where + ".tmp", where)
+
+
+class AtomicParquetWriter(ParquetWriter):
+    """A `ParquetWriter` writing into a temporary file that is renamed once the writer is closed,
+    so a crash never leaves a partial parquet file to be read later on.
+
+    The small batches of the windows are buffered and coalesced into row groups of `row_group_size` rows,
+    sorted following `row_order` with `sort_rows`.
+    """
+
+    def __init__(
+        self,
+        where: str,
+        schema,
+        row_group_size: int | None = None,
+        sort_rows: bool = False,
+        **kwargs,
+    ) -> None:
+        self.final_where = where
+        self.row_group_size = row_group_size
+        self.sort_keys = row_order(schema) if sort_rows else None
+        self.buffer = []
+        self.buffered = 0
+
+        if sort_rows:
+            kwargs["sorting_columns"] = SortingColumn.from_ordering(schema, self.sort_keys)
+
+        super().__init__(where + ".tmp", schema, **kwargs)
+
+    def write_batch(self, batch, row_group_size=None):
+        if self.row_group_size is None:
+            return super().write_batch(batch, row_group_size)
+
+        self.buffer.append(batch)
+        self.buffered += batch.num_rows
+
+        if self.buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self, last: bool = False):
+        """Write the full row groups of the buffer, or all of it if `last`."""
+        if self.buffered == 0:
+            return
+
+        rows = Table.from_batches(self.buffer, schema=self.schema)
+        if self.sort_keys is not None:
+            rows = rows.sort_by(self.sort_keys)
+
+        full = rows.num_rows if last else rows.num_rows - rows.num_rows % self.row_group_size
+        super().write_table(rows.slice(0, full), row_group_size=self.row_group_size)
+
+        self.buffer = rows.slice(full).to_batches()
+        self.buffered = rows.num_rows - full
+
+    def close(self):
+        was_open = self.is_open
+        if was_open:
+            self.flush(last=True)
+        super().close()
+        if was_open:
+            os.replace(self.final_where + ".tmp", self.final_where)
+
+
+def open_writer(
     out_file: str,
-    src_file: str,
-    windows: itertools.batched,
-    rast_schema: dict,
-    vrt_options: dict,
-    nodata: tuple | float | int,
-    include: bool = False,
-    band: int = 1,
+    rast_schema,
+    partition: str | None = None,
+    options: dict | None = None,
 ):
-    """This function runs a data ingestion process for a provided set of parameters that come from
+    """A writer for the output of a worker: one parquet file, or hive style partitions in the folder of `out_file`.
+    The `options` of the writer default to `writer_args`, see `writer_options`."""
+    if options is None:
+        options = writer_args
+
+    if partition is None:
+        return AtomicParquetWriter(where=out_file, schema=rast_schema, **options)
+    return PartitionedWriter(
+        os.path.dirname(out_file), source_name(out_file), rast_schema, partition, **options
+    )
+
+
+class SharedWriter:
+    """A writer shared by the threads of a run, writing the batches one at a time."""
+
+    def __init__(self, writer) -> None:
+        self.writer = writer
+        self.lock = threading.Lock()
+
+    @property
+    def files(self):
+        return self.writer.files
+
+    def write_batch(self, batch):
+        with self.lock:
+            self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def combine_h3_partials(partials: list[Table]) -> Table:
+    """Merge partial H3 aggregates, summing the values and pixel counts of the cells appearing several times.
+
+    Parameters
+    ----------
+    partials : list[Table]
+        Tables following the `h3_partial_schema` or `h3_area_partial_schema`, or an `h3_class_schema` whose pixel counts are summed per cell and class
+
+    Returns
+    -------
+    Table
+        One table following the schema of the partials with distinct cells.
+    """
+    partial_schema = partials[0].schema
+
+    if "band_class" in partial_schema.names:
+        merged = (
+            concat_tables(partials)
+            .group_by(["h3_id", "band_class"])
+            .aggregate([("pixel_count", "sum")])
+        )
+        return Table.from_arrays(
+            [merged["h3_id"], merged["band_class"], merged["pixel_count_sum"]],
+            schema=partial_schema,
+        )
+
+    merged = (
+        concat_tables(partials)
+        .group_by("h3_id")
+        .aggregate([("band_var", "sum"), ("pixel_count", "sum")])
+    )
+    return Table.from_arrays(
+        [merged["h3_id"], merged["band_var_sum"], merged["pixel_count_sum"]],
+        schema=partial_schema,
+    )
+
+
+def class_values(merged: Table, h3_agg: str = "count") -> Table:
+    """The table of the merged class counts of a categorical raster for one of the `class_aggs`: 'class_<k>_var' pixel counts,
+    which stay additive, 'class_<k>_frac' fractions of the pixels of the cells, the majority 'band_class',
+    or a long table with a row per cell and class."""
+    cells, cell_index = np.unique(merged["h3_id"].to_numpy(), return_inverse=True)
+    codes, class_index = np.unique(merged["band_class"].to_numpy(), return_inverse=True)
+    counts = merged["pixel_count"].to_numpy()
+    totals = np.bincount(cell_index, weights=counts, minlength=len(cells))
+
+    if h3_agg == "long":
+        return Table.from_arrays(
+            [
+                merged["h3_id"],
+                merged["band_class"],
+                pc.cast(merged["pixel_count"], "uint32"),
+                pa_array((counts / totals[cell_index]).astype(np.float32)),
+            ],
+            names=["h3_id", "band_class", "pixel_count", "class_frac"],
+        )
+
+    # the pairs of cell and class are distinct once merged
+    grid = np.zeros((len(cells), len(codes)), dtype=np.uint32)
+    grid[cell_index, class_index] = counts
+
+    if h3_agg == "majority":
+        return Table.from_arrays(
+            [
+                pa_array(cells, type=uint64()),
+                pa_array(codes[grid.argmax(axis=1)], type=merged.schema.field("band_class").type),
+            ],
+            names=["h3_id", "band_class"],
+        )
+
+    if h3_agg == "count":
+        columns = {f"class_{code}_var": grid[:, i] for i, code in enumerate(codes)}
+    elif h3_agg == "fraction":
+        columns = {
+            f"class_{code}_frac": (grid[:, i] / totals).astype(np.float32)
+            for i, code in enumerate(codes)
+        }
+    else:
+        raise ValueError(f"Unknown aggregation '{h3_agg}' of classes, use one of {class_aggs}")
+
+    return Table.from_arrays(
+        [pa_array(cells, type=uint64())] + [pa_array(values) for values in columns.values()],
+        names=["h3_id"] + list(columns),
+    )
+
+
+def h3_values(merged: Table, h3_agg: str = "sum") -> Table:
+    """The 'h3_id', 'band_var' table of merged partial aggregates, for one of the `h3_aggs`,
+    or the table of `class_values` for the class counts of a categorical raster."""
+    if "band_class" in merged.schema.names:
+        return class_values(merged, h3_agg)
+
+    if h3_agg == "sum":
+        band_var = merged["band_var"]
+    elif h3_agg == "mean":
+        band_var = pc.divide(merged["band_var"], pc.cast(merged["pixel_count"], "double"))
+    elif h3_agg == "count":
+        band_var = merged["pixel_count"]
+    else:
+        raise ValueError(f"Unknown aggregation '{h3_agg}', use one of {h3_aggs}")
+
+    return Table.from_arrays([merged["h3_id"], band_var], names=["h3_id", "band_var"])
+
+
+def merge_h3_parts(
+    in_files: list[str],
+    out_file: str,
+    h3_agg: str = "sum",
+    partition: str | None = None,
+    options: dict | None = None,
+):
+    """Final merge step of the partial H3 aggregates written by the workers.
 
     Parameters
     ----------
+    in_files : list[str]
+        Parquet files with partial aggregates, removed once merged
     out_file : str
-        File to write into
-    src_file : str
-        File to read a raster
-    windows : itertools.batched
-        A batch of windows
-    rast_schema : dict
-        The schema of the output table
-    vrt_options : dict
-        Other options for the raster reading step
-    nodata : tuple | float | int
-        No data value of the raster
-    include : bool, optional
-        Whether to include any potential negative values, by default False
-    band : int, optional
-        The band of the input to read from, by default 1
+        The parquet file to write the 'h3_id', 'band_var' table into, or the one of `class_values` for class counts
+    h3_agg : str, optional
+        One of 'sum', 'mean' or 'count', or one of `class_aggs` for class counts, by default "sum"
+    partition : str | None, optional
+        If given, the cells are written into hive style partitions in the folder of `out_file`, see `parse_partition`
+    options : dict | None, optional
+        Settings of the parquet writer, by default `writer_args`, see `writer_options`
+
+    Returns
+    -------
+    int
+        The number of cells written.
+    """
+    partial_schema = ParquetFile(in_files[0]).schema_arrow
+    merged = combine_h3_partials([read_table(file, schema=partial_schema) for file in in_files])
+    cells = h3_values(merged, h3_agg)
+
+    if partition is None:
+        atomic_write_table(cells, out_file, **(writer_args if options is None else options))
+    else:
+        with open_writer(out_file, cells.schema, partition, options) as writer:
+            writer.write_table(cells)
+
+    for file in in_files:
+        os.remove(file)
+
+    return merged.num_rows
+
+
+class SourceCache:
+    """The datasets opened by a worker, with their warped VRT if they need one. Only the last few are kept open,
+    as windows of many files can be handed out to the same worker."""
+
+    def __init__(self, size: int = 4) -> None:
+        self.size = size
+        self.datasets = {}
+
+    def get(self, source: dict):
+        """The warped VRT of a source, or the source itself if it is not warped, opening it if needed."""
+        path = source["path"]
+
+        if path in self.datasets:
+            # move to the end, the most recently used
+            self.datasets[path] = self.datasets.pop(path)
+        else:
+            if len(self.datasets) >= self.size:
+                self._close(next(iter(self.datasets)))
+            src = open(path)
+            if source.get("warp", True):
+                self.datasets[path] = (src, WarpedVRT(src, **source["vrt_options"]))
+            else:
+                self.datasets[path] = (src, src)
+
+        return self.datasets[path][1]
+
+    def _close(self, path: str):
+        src, vrt = self.datasets.pop(path)
+        if vrt is not src:
+            vrt.close()
+        src.close()
+
+    def close(self):
+        for path in list(self.datasets):
+            self._close(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def source_name(src_file: str) -> str:
+    """Name of a source file used in the output file names and the 'source' column."""
+    return src_file.split("/")[-1].split(".")[0]
+
+
+def source_names(src_files: list[str]) -> list[str]:
+    """Unique names of several source files, their `source_name` or, when two files share one such as the tiles
+    'z/x/y.tif' of a folder, their path from the common folder of the files, e.g. 'x/a' and 'y/a'.
+
+    Raises
+    ------
+    ValueError
+        If two files of the same folder share a name, such as 'a.tif' and 'a.vrt'
+    """
+    names = [source_name(src_file) for src_file in src_files]
+    if len(set(names)) == len(names):
+        return names
+
+    folders = [os.path.dirname(os.path.abspath(src_file)) for src_file in src_files]
+    root = os.path.commonpath(folders)
+    names = [
+        "/".join(os.path.relpath(folder, root).split(os.sep) + [name]).removeprefix("./")
+        for folder, name in zip(folders, names)
+    ]
+
+    if len(set(names)) < len(names):
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        raise ValueError(f"Several files have the source names {duplicates}, rename or convert them separately.")
+
+    return names
+
+
+def window_key(window) -> tuple:
+    """A hashable identifier of a window within its dataset."""
+    return (int(window.col_off), int(window.row_off), int(window.width), int(window.height))
+
+
+def source_windows(windows, sources: list[dict], cache: SourceCache | None = None):
+    """Pairs of source and window to process, from an iterable or a queue shared with other workers.
+    Windows that are not paired with the index of their source belong to the first source.
+    With the `cache` of the worker, the 'unsure' windows of a source, see `window_classes`, are skipped
+    when their mask at full resolution is empty in all its 'unsure_bands'."""
+
+    if hasattr(windows, "get"):
+        windows = queued_windows(windows)
+
+    for window in windows:
+        if isinstance(window, tuple):
+            source, window = sources[window[0]], window[1]
+        else:
+            source = sources[0]
+
+        if cache is not None and window_key(window) in source.get("unsure", ()):
+            dataset = cache.get(source)
+            if not any(dataset.read_masks(b, window=window).any() for b in source["unsure_bands"]):
+                continue
+
+        yield source, window
+
+
+def add_source(batch, name: str):
+    """Add a dictionary encoded 'source' column holding the name of the file the batch comes from."""
+    return batch.append_column(
+        "source",
+        DictionaryArray.from_arrays(
+            np.zeros(batch.num_rows, dtype=np.int32), pa_array([name])
+        ),
+    )
+
+
+class MetricsLog:
+    """Records the metrics of the windows converted by a worker as JSON lines, and the totals of the worker
+    once it is done. The lines of all the workers of a run are appended to the same file.
+
+    Parameters
+    ----------
+    path : str
+        The JSON lines file
+    worker : str
+        The name of the worker
     """
 
-    print("Writing into : ", out_file)
+    stages = ["read", "filter", "coords", "convert", "write"]
+
+    def __init__(self, path: str, worker: str) -> None:
+        self.path = path
+        self.worker = worker
+        self.start = time.perf_counter()
+        self.totals = {stage: 0.0 for stage in self.stages} | {
+            "windows": 0,
+            "pixels": 0,
+            "rows": 0,
+        }
+
+    def emit(self, record: dict):
+        # a single write of a short line in append mode is not interleaved with the other workers
+        with builtins.open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def window(self, source: dict, window, metrics: dict, rows: int):
+        """Record the metrics of a window: the seconds of each stage, the pixels read and the rows kept."""
+        for stage in self.stages:
+            self.totals[stage] += metrics.get(stage, 0.0)
+        self.totals["windows"] += 1
+        self.totals["pixels"] += metrics.get("pixels", 0)
+        self.totals["rows"] += rows
+
+        self.emit(
+            {
+                "type": "window",
+                "worker": self.worker,
+                "source": source["name"],
+                "window": [window.col_off, window.row_off, window.width, window.height],
+                "rows": rows,
+            }
+            | {stage: metrics.get(stage, 0.0) for stage in self.stages}
+            | {"pixels": metrics.get("pixels", 0)}
+        )
+
+    def close(self, files: list[str] | None = None):
+        """Record the totals of the worker, with the bytes of the files it wrote and its peak resident memory."""
+        self.emit(
+            {
+                "type": "worker",
+                "worker": self.worker,
+                "pid": os.getpid(),
+                "seconds": time.perf_counter() - self.start,
+                "bytes": sum(os.path.getsize(f) for f in files or [] if os.path.exists(f)),
+                # kilobytes on Linux
+                "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            }
+            | self.totals
+        )
+
+
+def metrics_summary(path: str) -> str:
+    """A table of the totals of the workers recorded in a metrics file, to find where the time goes and the stragglers."""
+    with builtins.open(path) as f:
+        records = [json.loads(line) for line in f]
+    workers = [r for r in records if r["type"] == "worker"]
+    runs = [r for r in records if r["type"] == "run"]
+
+    header = ["worker", "windows", "pixels", "rows"] + MetricsLog.stages + ["seconds", "Mpx/s", "MB", "RSS MB"]
+    lines = [header]
+
+    for r in sorted(workers, key=lambda r: r["worker"]):
+        lines.append(
+            [r["worker"], r["windows"], r["pixels"], r["rows"]]
+            + [f"{r[stage]:.2f}" for stage in MetricsLog.stages]
+            + [
+                f"{r['seconds']:.2f}",
+                f"{r['pixels'] / max(r['seconds'], 1e-9) / 1e6:.1f}",
+                f"{r['bytes'] / 2**20:.1f}",
+                f"{r['peak_rss_mb']:.0f}",
+            ]
+        )
+
+    widths = [max(len(str(line[i])) for line in lines) for i in range(len(header))]
+    summary = "\n".join(
+        "  ".join(str(v).rjust(w) for v, w in zip(line, widths)) for line in lines
+    )
+
+    if len(runs) > 0 and "plan_seconds" in runs[-1]:
+        # the planning runs in the main process before any worker starts
+        summary += f"\nPlanning : {runs[-1]['plan_seconds']:.2f} s of {runs[-1]['seconds']:.2f} s"
+
+    return summary
+
+
+def source_transformer(source: dict):
+    """The transformer of the coordinates of the pixel centres of a source read with `--reproject coords`, None otherwise."""
+    if not source.get("transform_coords", False):
+        return None
+    return coords_transformer(source["vrt_options"]["src_crs"], source["vrt_options"]["crs"])
+
+
+def window_aoi(vrt, source: dict, window):
+    """The area of interest of a source, if any, unless it covers the whole window and no pixel needs masking."""
+    aoi = source.get("aoi")
+    if aoi is None or aoi.contains(shapely.box(*vrt.window_bounds(window))):
+        return None
+    return aoi
+
+
+def read_aoi(bbox: list | None = None, aoi: str | None = None, crs=dst_crs):
+    """The area of interest of a run, from a bounding box and or a vector file.
+
+    Parameters
+    ----------
+    bbox : list | None, optional
+        [xmin, ymin, xmax, ymax] in the output CRS, by default None
+    aoi : str | None, optional
+        A vector file readable by geopandas, the union of its geometries is used, by default None
+    crs : optional
+        The output CRS the vector file is projected to, by default `dst_crs`
+
+    Returns
+    -------
+    shapely geometry | None
+        The area, or the intersection of both if both are given, None if neither is.
+    """
+    areas = []
+
+    if bbox is not None:
+        areas.append(shapely.box(*bbox))
+
+    if aoi is not None:
+        shapes = read_file(aoi)
+        if shapes.crs is not None:
+            shapes = shapes.to_crs(crs)
+        areas.append(shapes.union_all())
+
+    if len(areas) == 0:
+        return None
+
+    return shapely.intersection_all(areas)
+
+
+def window_converter(
+    cache: SourceCache,
+    rast_schema,
+    band: int | list[int] = 1,
+    include: bool = False,
+    nodata_mode: str = "any",
+    h3_res: int | None = None,
+    h3_index: int | None = None,
+):
+    """The function converting a pair of source and window into a record batch for the settings of a run.
+    This is shared by the workers writing files and the streaming reader.
+
+    Parameters
+    ----------
+    cache : SourceCache
+        The datasets opened by the worker
+    rast_schema : pyarrow.Schema
+        The schema of the output table, the name of the source of each row is added if it has a 'source' field.
+        With an `encoded_schema`, the band values are read in their own types and encoded, see `encode_batch`.
+        With a `time_schema`, the 'bands' of each source are read as the timesteps of a time stack, see `plan_sources`
+    band : int | list[int], optional
+        The band or bands to read, by default 1
+    include : bool, optional
+        Whether to include any potential negative values, by default False
+    nodata_mode : str, optional
+        With several bands, 'any' or 'all', by default "any"
+    h3_res : int | None, optional
+        If given, the batches are partial H3 aggregates at this resolution, the class counts per cell
+        with an `h3_class_schema`, the pixels apportioned to the cells they overlap with the
+        `h3_area_partial_schema`, by default None
+    h3_index : int | None, optional
+        If given, the uint64 'h3_id' of the cell of each pixel at this resolution is added, the last field of `rast_schema`, by default None
+
+    Returns
+    -------
+    callable
+        A function of a source, a window and optionally a dict of metrics (see `rast_convert_arrow`) returning a record batch.
+    """
+
+    if h3_index is not None:
+        convert_pixels = window_converter(
+            cache,
+            rast_schema.remove(rast_schema.get_field_index("h3_id")),
+            band=band,
+            include=include,
+            nodata_mode=nodata_mode,
+        )
+
+        def convert(source, window, metrics=None):
+            out = convert_pixels(source, window, metrics)
+            cells = h3_cells(out["lat"].to_numpy(), out["lon"].to_numpy(), h3_index)
+            return out.append_column("h3_id", pa_array(cells, type=uint64()))
+
+        return convert
+
+    if rast_schema is not None and encoding_metadata_key in (rast_schema.metadata or {}):
+        convert_values = window_converter(
+            cache,
+            decoded_schema(rast_schema),
+            band=band,
+            include=include,
+            nodata_mode=nodata_mode,
+        )
+
+        def convert(source, window, metrics=None):
+            return encode_batch(convert_values(source, window, metrics), rast_schema)
+
+        return convert
+
+    if h3_res is not None:
+        # the counts of the classes of a categorical raster
+        classes = rast_schema if rast_schema is not None and "band_class" in rast_schema.names else None
+        area_weights = rast_schema is not None and rast_schema.equals(h3_area_partial_schema)
+
+        def convert(source, window, metrics=None):
+            vrt = cache.get(source)
+            return rast_convert_h3(
+                vrt,
+                transform=vrt.window_transform,
+                win=window,
+                band=band,
+                nodata=source["nodata"],
+                include=include,
+                h3_res=h3_res,
+                aoi=window_aoi(vrt, source, window),
+                metrics=metrics,
+                transformer=source_transformer(source),
+                decimation=source.get("decimation", 1),
+                class_schema=classes,
+                area_weights=area_weights,
+            )
+
+        return convert
+
+    provenance = "source" in rast_schema.names
+    kernel_schema = (
+        rast_schema.remove(rast_schema.get_field_index("source"))
+        if provenance
+        else rast_schema
+    )
+
+    if "time" in rast_schema.names:
+
+        def convert(source, window, metrics=None):
+            vrt = cache.get(source)
+            out = rast_convert_time(
+                vrt,
+                transform=vrt.window_transform,
+                win=window,
+                bands=source["bands"],
+                times=source["times"],
+                nodata=source["nodata"],
+                include=include,
+                rast_schema=kernel_schema,
+                aoi=window_aoi(vrt, source, window),
+                metrics=metrics,
+                transformer=source_transformer(source),
+            )
+            return add_source(out, source["name"]) if provenance else out
+
+        return convert
+
+    if isinstance(band, list):
+        kernel = partial(
+            rast_convert_bands,
+            bands=band,
+            include=include,
+            nodata_mode=nodata_mode,
+            rast_schema=kernel_schema,
+        )
+    else:
+        kernel = partial(
+            rast_convert_arrow,
+            band=band,
+            include=include,
+            rast_schema=kernel_schema,
+        )
+
+    def convert(source, window, metrics=None):
+        vrt = cache.get(source)
+        out = kernel(
+            vrt,
+            transform=vrt.window_transform,
+            win=window,
+            nodata=source["nodata"],
+            aoi=window_aoi(vrt, source, window),
+            metrics=metrics,
+            transformer=source_transformer(source),
+        )
+        return add_source(out, source["name"]) if provenance else out
+
+    return convert
+
+
+def process(
+    out_file: str,
+    src_file: str | list[dict],
+    windows,
+    rast_schema: dict,
+    vrt_options: dict = {},
+    nodata: tuple | float | int = None,
+    include: bool = False,
+    band: int | list[int] = 1,
+    h3_res: int | None = None,
+    nodata_mode: str = "any",
+    partition: str | None = None,
+    checkpoint: bool = False,
+    options: dict | None = None,
+    writer: SharedWriter | None = None,
+    metrics: str | None = None,
+):
+    """This function runs a data ingestion process for a provided set of parameters that come from
+
+    Parameters
+    ----------
+    out_file : str
+        File to write into
+    src_file : str | list[dict]
+        File to read a raster, or a list of sources with their 'path', 'name', 'vrt_options' and 'nodata'
+    windows : iterable | Queue
+        A batch of windows, or a queue shared with other workers handing out chunks of windows until a None sentinel.
+        With several sources, each window is paired with the index of its source.
+    rast_schema : dict
+        The schema of the output table, the name of the source of each row is written if it has a 'source' field
+    vrt_options : dict
+        Other options for the raster reading step, when a single file is given
+    nodata : tuple | float | int
+        No data value of the raster, one per band if several bands are read, when a single file is given
+    include : bool, optional
+        Whether to include any potential negative values, by default False
+    band : int | list[int], optional
+        The band of the input to read from, by default 1. With a list of bands, all of them are read in one pass
+        and written in a wide table with a 'band_<i>_var' column per band.
+    h3_res : int | None, optional
+        If given, pixels are aggregated into the H3 cells of this resolution and partial aggregates
+        following `h3_partial_schema` are written instead of the pixels, by default None
+    nodata_mode : str, optional
+        With several bands, 'any' drops the pixels where any band is invalid and 'all' the pixels where all the bands are, by default "any"
+    partition : str | None, optional
+        If given, the rows are written into hive style partitions in the folder of `out_file`, see `parse_partition`
+    checkpoint : bool, optional
+        Whether to write one fragment per chunk of windows taken from the queue and record it
+        in a manifest, so that an interrupted run can be resumed, by default False
+    options : dict | None, optional
+        Settings of the parquet writers, by default `writer_args`, see `writer_options`
+    writer : SharedWriter | None, optional
+        A writer shared with other threads to write the rows into instead of `out_file`, by default None
+    metrics : str | None, optional
+        If given, a JSON lines file to append the metrics of the windows and of the worker to, see `MetricsLog`
+    """
+
+    if writer is None:
+        print("Writing into : ", out_file)
+
+    if isinstance(src_file, str):
+        sources = [
+            {
+                "path": src_file,
+                "name": source_name(src_file),
+                "vrt_options": vrt_options,
+                "nodata": nodata,
+            }
+        ]
+    else:
+        sources = src_file
+
+    with SourceCache() as cache:
+
+        convert = window_converter(
+            cache,
+            rast_schema,
+            band=band,
+            include=include,
+            nodata_mode=nodata_mode,
+            h3_res=h3_res,
+        )
+
+        log = None if metrics is None else MetricsLog(metrics, source_name(out_file))
+
+        if not checkpoint:
+            files, _ = write_windows(
+                out_file,
+                source_windows(windows, sources, cache),
+                convert,
+                rast_schema,
+                h3_mode=h3_res is not None,
+                partition=partition,
+                options=options,
+                writer=writer,
+                log=log,
+            )
+            if log is not None:
+                # the bytes of a shared writer are only known once all the threads are done
+                log.close(files if writer is None else None)
+            return
+
+        # one fragment per chunk, recorded in the manifest of the worker once written
+        folder = os.path.dirname(out_file)
+        name = source_name(out_file)
+        manifest = os.path.join(folder, f"_manifest_{name}.jsonl")
+
+        written = []
+
+        for chunk_id, chunk in iter(windows.get, None):
+            files, rows = write_windows(
+                os.path.join(folder, f"{name}_c{chunk_id}.parquet"),
+                source_windows(chunk, sources, cache),
+                convert,
+                rast_schema,
+                h3_mode=h3_res is not None,
+                partition=partition,
+                options=options,
+                log=log,
+            )
+            record_chunk(manifest, chunk_id, files, rows)
+            written.extend(files)
+
+        if log is not None:
+            log.close(written)
+
+
+def write_windows(
+    out_file: str,
+    tasks,
+    convert,
+    rast_schema,
+    h3_mode: bool = False,
+    partition: str | None = None,
+    options: dict | None = None,
+    writer: SharedWriter | None = None,
+    log: MetricsLog | None = None,
+):
+    """Convert pairs of source and window and write them into an output.
+
+    Parameters
+    ----------
+    out_file : str
+        File to write into
+    tasks : iterable
+        Pairs of source and window
+    convert : callable
+        Function converting a source and window into a record batch
+    rast_schema : pyarrow.Schema
+        The schema of the output table
+    h3_mode : bool, optional
+        Whether the batches are partial H3 aggregates, merged before they are written, by default False
+    partition : str | None, optional
+        If given, the rows are written into hive style partitions in the folder of `out_file`, see `parse_partition`
+    options : dict | None, optional
+        Settings of the parquet writers, by default `writer_args`, see `writer_options`
+    writer : SharedWriter | None, optional
+        A writer shared with other threads to write the rows into instead of `out_file`, by default None
+    log : MetricsLog | None, optional
+        If given, the metrics of each window are recorded in it, by default None
+
+    Returns
+    -------
+    tuple[list[str], int]
+        The files written and their number of rows.
+    """
+
+    if h3_mode:
+        partials = []
+        pending = 0
+
+        for source, window in tasks:
+            metrics = None if log is None else {}
+            out = convert(source, window, metrics)
+            start = time.perf_counter()
+
+            if out.num_rows > 0:
+                partials.append(Table.from_batches([out]))
+                pending += out.num_rows
+
+            if pending > h3_compact_rows:
+                partials = [combine_h3_partials(partials)]
+                pending = partials[0].num_rows
+
+            if log is not None:
+                lap(metrics, "write", start)
+                log.window(source, window, metrics, out.num_rows)
+
+        if len(partials) > 0:
+            cells = combine_h3_partials(partials)
+        else:
+            cells = (h3_partial_schema if rast_schema is None else rast_schema).empty_table()
+
+        atomic_write_table(cells, out_file)
+        return [out_file], cells.num_rows
+
+    rows = 0
+
+    if writer is None:
+        writer = open_writer(out_file, rast_schema, partition, options)
+    else:
+        # closed by its owner once all the threads are done
+        writer = contextlib.nullcontext(writer)
+
+    with writer as writer:
+
+        for source, window in tasks:
+            metrics = None if log is None else {}
+            out = convert(source, window, metrics)
+            start = time.perf_counter()
+
+            if out.num_rows > 0:
+                writer.write_batch(out)
+                rows += out.num_rows
+
+            if log is not None:
+                lap(metrics, "write", start)
+                log.window(source, window, metrics, out.num_rows)
+
+    return writer.files if partition is not None else [out_file], rows
+
+
+def record_chunk(manifest: str, chunk_id: int, files: list[str], rows: int):
+    """Append a finished chunk and its fragments to the manifest of a worker. The line is flushed to disk
+    before the next chunk starts, so a chunk is only ever recorded once all its fragments are complete."""
+    with builtins.open(manifest, "a") as f:
+        f.write(
+            json.dumps(
+                {
+                    "chunk": chunk_id,
+                    "fragments": [
+                        os.path.relpath(file, os.path.dirname(manifest)) for file in files
+                    ],
+                    "rows": rows,
+                }
+            )
+            + "\n"
+        )
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_manifest(out_fold: str) -> dict:
+    """Read the header and the finished chunks recorded by the workers of a checkpointed run.
+
+    Parameters
+    ----------
+    out_fold : str
+        The output folder of the run
+
+    Returns
+    -------
+    dict
+        The header of the run, with the finished chunks as a dict of chunk ids to fragments under 'chunks',
+        or an empty dict if the folder holds no manifest.
+    """
+    header_file = os.path.join(out_fold, "_manifest.json")
+
+    if not os.path.exists(header_file):
+        return {}
+
+    with builtins.open(header_file) as f:
+        header = json.load(f)
+
+    header["chunks"] = {}
+
+    for manifest in glob(os.path.join(out_fold, "_manifest_*.jsonl")):
+        with builtins.open(manifest) as f:
+            for line in f:
+                # a line cut by a crash is not a finished chunk
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                header["chunks"][record["chunk"]] = [
+                    os.path.join(out_fold, fragment) for fragment in record["fragments"]
+                ]
+
+    return header
+
+
+def clean_fragments(out_fold: str, finished: set, names: list[str]):
+    """Remove the temporary files and the fragments of unfinished chunks left by an interrupted run.
+    Only the fragments of the workers of the run, whose files are named after `names`, are removed,
+    the files of other inputs or tools in the folder are left alone. The fragments of partitioned runs
+    are named 'part-<name>_c<chunk>-<n>.parquet' by `PartitionedWriter`."""
+    fragment = re.compile("^(?:part-)?(?:" + "|".join(map(re.escape, names)) + r")_c(\d+)[-.]")
+
+    for file in glob(os.path.join(out_fold, "**", "*.parquet*"), recursive=True):
+        chunk = fragment.match(os.path.basename(file))
+        if chunk is None:
+            continue
+        if file.endswith(".tmp") or int(chunk.group(1)) not in finished:
+            os.remove(file)
+
+
+def run_fingerprint(**params) -> str:
+    """Hash of the parameters of a run, checked before resuming it."""
+    return hashlib.sha1(
+        json.dumps(params, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def unify_schemas(schemas: list):
+    """Common schema of the tables of several rasters, promoting the value types that differ between files."""
+    first = schemas[0]
+
+    if all(sch.equals(first) for sch in schemas):
+        return first
+
+    fields = [first.field(0), first.field(1)]
+    for i in range(2, len(first)):
+        np_dtype = np.result_type(*[sch.field(i).type.to_pandas_dtype() for sch in schemas])
+        fields.append(field(first.field(i).name, from_numpy_dtype(np_dtype)))
+
+    return schema(fields, metadata=first.metadata)
+
+
+def select_times(times, time_range: tuple | None = None):
+    """Mask of the times within a (start, end) range, both included, given as ISO dates such as '2020-01-01'
+    for datetimes or as numbers for raw time coordinates and band numbers."""
+    if time_range is None:
+        return np.ones(len(times), dtype=bool)
+
+    if times.dtype.kind == "M":
+        start, end = (np.datetime64(t) for t in time_range)
+    else:
+        start, end = (float(t) for t in time_range)
+
+    return (times >= start) & (times <= end)
+
+
+def encoding_params(sources: list[dict], band: int | list[int], encoding: str) -> tuple[float, float]:
+    """The scale and offset spreading the range of the values of the bands over the codes of an integer encoding.
+    The range comes from the valid values of the rasters read at a resolution of at most `weights_max_pixels` pixels,
+    from the overviews when there are any, widened by `encoding_margin` on each side, and the values out of it are
+    clipped to the extreme codes.
+
+    Parameters
+    ----------
+    sources : list[dict]
+        The sources from `plan_sources`
+    band : int | list[int]
+        The band or bands read
+    encoding : str
+        'uint16' or 'int16'
+
+    Returns
+    -------
+    tuple[float, float]
+        The scale and offset of the codes.
+    """
+    lows, highs = [], []
+    for source in sources:
+        with open(source["path"]) as src:
+            # no statistics are computed by GDAL, nor saved next to the rasters
+            step = max(1, int(np.ceil(np.sqrt(src.width * src.height / weights_max_pixels))))
+            shape = (int(np.ceil(src.height / step)), int(np.ceil(src.width / step)))
+            for b in np.atleast_1d(band):
+                values = src.read(int(b), out_shape=shape, masked=True).compressed()
+                values = values[np.isfinite(values)]
+                if len(values) > 0:
+                    lows.append(float(values.min()))
+                    highs.append(float(values.max()))
+
+    if len(lows) == 0:
+        return 1.0, 0.0
+
+    # the decimated values can miss the extreme values
+    margin = (max(highs) - min(lows)) * encoding_margin
+    low, high = min(lows) - margin, max(highs) + margin
+
+    codes = np.iinfo(encoding)
+    scale = (high - low) / (int(codes.max) - int(codes.min))
+    if scale == 0 or not np.isfinite(scale):
+        scale = 1.0
+
+    return scale, low - codes.min * scale
+
+
+def grid_index_schema(rast_schema, sources: list[dict], crs):
+    """The `grid_schema` of an output, with the CRS and the grid of the pixel ids of each source in its metadata,
+    from which `scalenav.oop.grid_coords` rebuilds the coordinates. With `--reproject coords`, the grid of
+    a source is its own, in its 'crs'."""
+    names = [source["name"] for source in sources]
+    if len(set(names)) < len(names):
+        # the grids are keyed by the 'source' column of the rows
+        raise ValueError("The sources of a grid index output need unique names, see `source_names`.")
+
+    grid = {
+        "crs": CRS.from_user_input(crs).to_string(),
+        "sources": {source["name"]: source["grid"] for source in sources},
+    }
+    out = grid_schema(rast_schema)
+    return out.with_metadata(out.metadata | {grid_metadata_key: json.dumps(grid).encode()})
+
+
+def plan_sources(
+    src_files: list[str],
+    vrt_options: dict,
+    band: int = 1,
+    bands: list[int] | None = None,
+    all_bands: bool = False,
+    in_crs: str | None = None,
+    nodata_mode: str = "any",
+    skip_empty: bool = True,
+    aoi=None,
+    reproject: str = "warp",
+    time: bool = False,
+    time_range: tuple | None = None,
+    window_pixels: int = window_target_pixels,
+    window_mb: float | None = None,
+    max_window_mb: float | None = None,
+) -> dict:
+    """Check the sources and get the needed info once for use down the road: their CRS, nodata values,
+    the schema of the output and the windows to read, weighted by their estimated number of valid pixels.
+
+    Parameters
+    ----------
+    src_files : list[str]
+        Raster files
+    vrt_options : dict
+        Options of the warped VRT, with the output 'crs'
+    band : int, optional
+        The band to read, by default 1
+    bands : list[int] | None, optional
+        Several bands to read in one pass, by default None
+    all_bands : bool, optional
+        Whether to read all the bands, by default False
+    in_crs : str | None, optional
+        CRS of the inputs without one, by default None
+    nodata_mode : str, optional
+        With several bands, 'any' or 'all', by default "any"
+    skip_empty : bool, optional
+        Whether to drop the windows found empty by `window_classes`, by default True
+    aoi : shapely geometry, optional
+        An area of interest in the output CRS, see `read_aoi`. Only the windows intersecting it are kept
+        and the pixels outside of it are masked, by default None
+    reproject : str, optional
+        How the sources in another CRS than the output are reprojected: 'warp' resamples their pixels into the output CRS
+        with a `WarpedVRT`, 'coords' keeps their pixels and only transforms the coordinates of the pixel centres.
+        The sources already in the output CRS are always read as they are, by default "warp"
+    time : bool, optional
+        Whether the bands are the timesteps of a time stack, read into a `time_schema` with a row per pixel and timestep.
+        The 'bands' of each source and their 'times', see `band_times`, are recorded in the source, by default False
+    time_range : tuple | None, optional
+        With `time`, only the bands with a time within this (start, end) range are read,
+        ISO dates for datetimes or numbers otherwise, see `select_times`, by default None
+    window_pixels : int, optional
+        The number of pixels small native blocks are merged into, see `plan_windows`, by default `window_target_pixels`
+    window_mb : float | None, optional
+        If given, the size of the values read in a window small blocks are merged into, instead of `window_pixels`, by default None
+    max_window_mb : float | None, optional
+        If given, the largest size of the values read in a window, larger blocks are split, by default None
+
+    Returns
+    -------
+    dict
+        The 'sources', the 'windows' as pairs of source index and window, their 'weights',
+        the 'rast_schema', the 'band' or list of bands read, the largest 'band_count' of the files,
+        the number of windows of each of the 'classes' and the number of windows 'outside' the area of interest.
+
+    Raises
+    ------
+    IOError
+        If the band parameter exceeds the bands of a file
+    ValueError
+        If two files in the same folder share a source name, see `source_names`
+    """
+
+    sources = []
+    schemas = []
+    windows = []
+    weights = []
+    band_count = 0
+    classes = {cls: 0 for cls in window_classes_names}
+    outside = 0
+
+    for src_file, name in zip(src_files, source_names(src_files)):
+        with open(src_file) as src:
+
+            if all_bands and bands is None:
+                bands = list(src.indexes)
+
+            if bands is not None:
+                band = bands
+
+            band_count = max(band_count, src.count)
+
+            if time:
+                times = band_times(src)
+                selected = select_times(times, time_range)
+                if not selected.any():
+                    continue
+                band = [b for b, keep in zip(src.indexes, selected) if keep]
+
+            if max(np.atleast_1d(band)) > src.count:
+                raise IOError(
+                    "Band parameter exceeds available bands.",
+                    "Available bands : ",
+                    src.count,
+                    src_file,
+                )
+
+            src_crs = check_crs(src, in_crs=in_crs)
+
+            if time:
+                nodata = check_nodata(src, band=band[0])
+                schemas.append(time_schema(infer_dtype(src, band=band[0]), from_numpy_dtype(times.dtype)))
+            elif isinstance(band, list):
+                nodata = [check_nodata(src, band=b) for b in band]
+                # one column per band, each with its own inferred type
+                schemas.append(bands_schema(src, band))
+            else:
+                nodata = check_nodata(src, band=band)
+                schemas.append(raster_schema(infer_dtype(src, band=band)))
+
+            source = {
+                "path": src_file,
+                "name": name,
+                "vrt_options": vrt_options | {"src_crs": src_crs},
+                "nodata": nodata,
+            }
+
+            if time:
+                source["bands"] = band
+                source["times"] = times[selected]
+
+            same_crs = src_crs is not None and CRS.from_user_input(src_crs) == CRS.from_user_input(
+                vrt_options["crs"]
+            )
+            # the pixels are only warped if needed, otherwise they are read as they are
+            source["warp"] = not same_crs and (reproject == "warp" or src_crs is None)
+            # and with 'coords' only the coordinates of their centres are transformed
+            source["transform_coords"] = not same_crs and not source["warp"]
+
+            if source["warp"]:
+                dataset = WarpedVRT(src, **source["vrt_options"])
+            else:
+                dataset = contextlib.nullcontext(src)
+
+            # windows, weighted by their estimated number of valid pixels
+            with dataset as vrt:
+                # bytes of the values of a pixel of the bands read, a window of a time stack reads a chunk of them at once
+                pixel_bytes = sum(
+                    np.dtype(src.dtypes[int(b) - 1]).itemsize
+                    for b in np.atleast_1d(band)[: time_chunk_bands if time else None]
+                )
+                target = window_pixels if window_mb is None else int(window_mb * 2**20 / pixel_bytes)
+                largest = None if max_window_mb is None else int(max_window_mb * 2**20 / pixel_bytes)
+                src_windows = plan_windows(vrt, target_pixels=target, max_pixels=largest)
+                # the grid of the pixel ids of a grid index output
+                source["grid"] = {
+                    "crs": CRS.from_user_input(vrt_options["crs"] if source["warp"] else src_crs).to_string(),
+                    "transform": list(vrt.transform)[:6],
+                    "width": vrt.width,
+                    "height": vrt.height,
+                }
+
+                if aoi is not None:
+                    if source["transform_coords"]:
+                        # the pixels are masked in the CRS of the source
+                        to_source = coords_transformer(vrt_options["crs"], src_crs)
+                        src_aoi = shapely.transform(
+                            aoi, lambda xy: np.column_stack(to_source.transform(xy[:, 0], xy[:, 1]))
+                        )
+                    else:
+                        src_aoi = aoi
+                    # the area within the source is simpler to mask the pixels with
+                    source["aoi"] = src_aoi.intersection(shapely.box(*vrt.bounds))
+                    bounds = np.array([vrt.window_bounds(window) for window in src_windows])
+                    inside = shapely.intersects(
+                        source["aoi"], shapely.box(*bounds.reshape(-1, 4).T)
+                    )
+                    outside += int((~inside).sum())
+                    src_windows = [window for window, k in zip(src_windows, inside) if k]
+
+                first_band = int(np.atleast_1d(band)[0])
+                estimate = can_estimate_weights(src, band=first_band)
+                src_weights = window_weights(
+                    vrt, src_windows, estimate=estimate, band=first_band
+                )
+
+                # with 'any', a window empty in one band has no row, with 'all' it must be empty in every band
+                # and a timestep is a row of its own, a window is empty when it is empty at every timestep
+                classify = [first_band] if nodata_mode == "any" and not time else np.atleast_1d(band)
+                by_band = [
+                    window_classes(
+                        vrt, src_windows, estimate=estimate, band=int(b), overviews=len(src.overviews(int(b))) > 0
+                    )
+                    for b in classify
+                ]
+                src_classes = np.full(len(src_windows), window_mixed)
+                src_classes[np.all(np.equal(by_band, window_full), axis=0)] = window_full
+                # empty in every band, in some only as far as the overviews tell
+                blank = np.isin(by_band, [window_empty, window_unsure])
+                src_classes[np.all(blank, axis=0) & np.any(np.equal(by_band, window_unsure), axis=0)] = window_unsure
+                src_classes[np.all(np.equal(by_band, window_empty), axis=0)] = window_empty
+
+            for cls in classes:
+                classes[cls] += int((src_classes == window_classes_names[cls]).sum())
+
+            if skip_empty:
+                keep = src_classes != window_empty
+                unsure = {window_key(w) for w, cls in zip(src_windows, src_classes) if cls == window_unsure}
+                if len(unsure) > 0:
+                    source["unsure"] = unsure
+                    source["unsure_bands"] = [int(b) for b in classify]
+                src_windows = [window for window, k in zip(src_windows, keep) if k]
+                src_weights = src_weights[keep]
+
+            weights.append(src_weights)
+            windows.extend((len(sources), window) for window in src_windows)
+            sources.append(source)
+
+    if len(sources) == 0:
+        raise IOError("No band of the rasters is within the time range.", time_range)
+
+    rast_schema = unify_schemas(schemas)
+
+    if len(sources) > 1:
+        # provenance of the rows
+        rast_schema = rast_schema.append(field("source", dictionary(int32(), string())))
+
+    return {
+        "sources": sources,
+        "windows": windows,
+        "weights": np.concatenate(weights),
+        "rast_schema": rast_schema,
+        "band": band,
+        "band_count": band_count,
+        "classes": classes,
+        "outside": outside,
+    }
+
+
+# datasets kept open by a worker of the pool of `rast_to_arrow` between chunks
+_worker_cache = None
+
+
+def convert_chunk(
+    chunk,
+    sources: list[dict],
+    rast_schema,
+    band: int | list[int] = 1,
+    include: bool = False,
+    nodata_mode: str = "any",
+    h3_index: int | None = None,
+    h3_res: int | None = None,
+):
+    """Convert a chunk of windows in a worker of the pool of `rast_to_arrow` or of `rast_to_h3_pyramid`."""
+    global _worker_cache
+    if _worker_cache is None:
+        _worker_cache = SourceCache()
+
+    convert = window_converter(
+        _worker_cache,
+        rast_schema,
+        band=band,
+        include=include,
+        nodata_mode=nodata_mode,
+        h3_index=h3_index,
+        h3_res=h3_res,
+    )
+
+    batches = (convert(source, window) for source, window in source_windows(chunk, sources, _worker_cache))
+    return [batch for batch in batches if batch.num_rows > 0]
+
+
+def rast_to_arrow(
+    in_path: str | list[str],
+    band: int = 1,
+    bands: list[int] | None = None,
+    all_bands: bool = False,
+    in_crs: str | None = None,
+    out_crs: str = "epsg:4326",
+    include: bool = False,
+    nodata_mode: str = "any",
+    bbox: list | None = None,
+    aoi: str | None = None,
+    grid_index: bool = False,
+    reproject: str = "warp",
+    h3_index: int | None = None,
+    time: bool = False,
+    time_range: tuple | None = None,
+    window_pixels: int = window_target_pixels,
+    window_mb: float | None = None,
+    max_window_mb: float | None = None,
+    skip_empty: bool = True,
+    workers: int = 0,
+    prefetch: int | None = None,
+    chunk_size: int = chunk_size,
+) -> RecordBatchReader:
+    """Stream rasters as arrow record batches without writing them to disk, with the same engine as `rastapar`.
+    The windows are read in order, lazily as the batches are consumed. The reader can be given directly to DuckDB,
+    for example `conn.read_arrow(reader)` or `duckdb.sql("select * from reader")`, or read with `reader.read_pandas()`.
+
+    Parameters
+    ----------
+    in_path : str | list[str]
+        Paths to rasters, folders with rasters or glob patterns
+    band : int, optional
+        The band to read, by default 1
+    bands : list[int] | None, optional
+        Several bands to read in one pass into 'band_<i>_var' columns, by default None
+    all_bands : bool, optional
+        Whether to read all the bands of the rasters when `bands` is not given, by default False
+    in_crs : str | None, optional
+        CRS of the inputs if not available, by default None
+    out_crs : str, optional
+        CRS of the output, by default "epsg:4326"
+    include : bool, optional
+        Whether to include any potential negative values, by default False
+    nodata_mode : str, optional
+        With several bands, 'any' or 'all', by default "any"
+    bbox : list | None, optional
+        Only the pixels inside [xmin, ymin, xmax, ymax] in the output CRS are read, by default None
+    aoi : str | None, optional
+        Only the pixels inside the geometries of this vector file are read, by default None
+    grid_index : bool, optional
+        Whether to give the ids of the pixels instead of their coordinates, see `grid_index_schema`, by default False
+    reproject : str, optional
+        'warp' or 'coords', see `plan_sources`, by default "warp"
+    h3_index : int | None, optional
+        If given, the workers add the uint64 'h3_id' of the cell of each pixel at this resolution, by default None
+    time : bool, optional
+        Whether to read the bands as the timesteps of a time stack, with a 'time' column, by default False
+    time_range : tuple | None, optional
+        With `time`, the (start, end) range of the timesteps to read, see `select_times`, by default None
+    window_pixels : int, optional
+        The number of pixels small native blocks are merged into, see `plan_windows`, by default `window_target_pixels`
+    window_mb : float | None, optional
+        If given, the size of the values read in a merged window instead of `window_pixels`, see `plan_sources`, by default None
+    max_window_mb : float | None, optional
+        If given, the largest size of the values read in a window, see `plan_sources`, by default None
+    skip_empty : bool, optional
+        Whether to drop the windows found empty by `window_classes`, by default True
+    workers : int, optional
+        The number of processes converting windows in parallel, 0 converts them in the calling process, by default 0
+    prefetch : int | None, optional
+        The largest number of chunks being converted ahead of the consumer, which bounds the memory used, by default twice the workers
+    chunk_size : int, optional
+        The number of windows converted at once by a worker, by default `chunk_size`
+
+    Returns
+    -------
+    RecordBatchReader
+        A reader of the batches of valid pixels.
+    """
+
+    src_files = check_paths(in_path)
+
+    if len(src_files) == 0:
+        raise IOError("No input files recognised.")
+
+    out_crs = check_out_crs(out_crs)
+
+    if h3_index is not None and out_crs != dst_crs:
+        raise ValueError("Projecting on the H3 grid requires an 'epsg:4326' output CRS.")
+
+    plan = plan_sources(
+        src_files,
+        {"crs": out_crs},
+        band=band,
+        bands=bands,
+        all_bands=all_bands,
+        in_crs=in_crs,
+        nodata_mode=nodata_mode,
+        aoi=read_aoi(bbox=bbox, aoi=aoi, crs=out_crs),
+        reproject=reproject,
+        time=time,
+        time_range=time_range,
+        window_pixels=window_pixels,
+        window_mb=window_mb,
+        max_window_mb=max_window_mb,
+        skip_empty=skip_empty,
+    )
+    sources = plan["sources"]
+    rast_schema = plan["rast_schema"]
+
+    if grid_index:
+        if h3_index is not None:
+            raise ValueError("The H3 cells of a grid index output are computed when it is read.")
+        rast_schema = grid_index_schema(rast_schema, sources, out_crs)
+
+    if h3_index is not None:
+        rast_schema = rast_schema.append(field("h3_id", uint64()))
+
+    settings = {
+        "band": plan["band"],
+        "include": include,
+        "nodata_mode": nodata_mode,
+        "h3_index": h3_index,
+    }
+
+    if prefetch is None:
+        prefetch = 2 * max(workers, 1)
+
+    def batches():
+        if workers == 0:
+            with SourceCache() as cache:
+                convert = window_converter(cache, rast_schema, **settings)
+                for source, window in source_windows(plan["windows"], sources, cache):
+                    out = convert(source, window)
+                    if out.num_rows > 0:
+                        yield out
+            return
+
+        chunks = itertools.batched(plan["windows"], chunk_size)
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+        try:
+            # only `prefetch` chunks are converted ahead of the consumer
+            pending = collections.deque(
+                executor.submit(convert_chunk, chunk, sources, rast_schema, **settings)
+                for chunk in itertools.islice(chunks, prefetch)
+            )
+            while len(pending) > 0:
+                done = pending.popleft().result()
+                for chunk in itertools.islice(chunks, 1):
+                    pending.append(
+                        executor.submit(
+                            convert_chunk, chunk, sources, rast_schema, **settings
+                        )
+                    )
+                yield from done
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    return RecordBatchReader.from_batches(rast_schema, batches())
+
+
+def rast_to_duckdb(
+    in_path: str | list[str],
+    database: str,
+    table: str,
+    h3_res: int | None = None,
+    h3_agg: str | None = "sum",
+    **kwargs,
+) -> int:
+    """Convert rasters straight into a table of a DuckDB database, without intermediate parquet files.
+    The batches of `rast_to_arrow` are appended through a single connection as the workers produce them,
+    and the number of batches waiting is bounded by its `prefetch`. The database can then be opened
+    with `scalenav.oop.ScalenavProcess`.
+
+    Parameters
+    ----------
+    in_path : str | list[str]
+        Paths to rasters, folders with rasters or glob patterns
+    database : str
+        The DuckDB database file, created if needed
+    table : str
+        The name of the table to create or replace, quoted as it is
+    h3_res : int | None, optional
+        If given, the H3 cells of the pixels at this resolution are computed by the workers, by default None
+    h3_agg : str | None, optional
+        With `h3_res`, the values are aggregated per cell with one of 'sum', 'mean' or 'count' into a table of
+        'h3_id' and the value columns. If None, the 'h3_id' of each pixel is added to its row, by default "sum"
+    **kwargs
+        Other options of `rast_to_arrow`, such as 'band', 'out_crs' or 'workers'
+
+    Returns
+    -------
+    int
+        The number of rows of the table.
+    """
+    reader = rast_to_arrow(in_path, h3_index=h3_res, **kwargs)
+
+    if h3_res is None:
+        query = "select * from rastapar_batches"
+    elif h3_agg is None:
+        # the string ids of the H3 extension
+        query = "select * replace (lower(hex(h3_id)) as h3_id) from rastapar_batches"
+    else:
+        if h3_agg not in h3_aggs:
+            raise ValueError(f"Unknown aggregation '{h3_agg}', use one of {h3_aggs}")
+        agg = {"sum": "sum", "mean": "avg", "count": "count"}[h3_agg]
+        values = ", ".join(
+            f"{agg}({name}) as {name}" for name in reader.schema.names if name.endswith("_var")
+        )
+        query = f"select lower(hex(h3_id)) as h3_id, {values} from rastapar_batches group by h3_id"
+
+    # quoted, the default names come from file names such as '2020-pop.tif'
+    name = '"' + table.replace('"', '""') + '"'
+
+    with duckdb.connect(database) as conn:
+        conn.register("rastapar_batches", reader)
+        conn.execute(f"create or replace table {name} as ({query})")
+        return conn.execute(f"select count(*) from {name}").fetchone()[0]
+
+
+def pyramid_decimation(source: dict, h3_res: int, band: int = 1) -> int:
+    """The decimation of the reads of a source for an H3 resolution: the coarsest that keeps at least
+    `pyramid_pixels_per_edge` pixels along the edge of a cell, down to the nearest overview of the raster if it has any,
+    so that GDAL reads the overview as it is."""
+    # the grid of the source is in degrees, about 111 km at the equator
+    pixel_km = abs(source["grid"]["transform"][0]) * 111.32
+    edge_km = h3.average_hexagon_edge_length(h3_res, unit="km")
+    decimation = max(1, int(edge_km / (pixel_km * pyramid_pixels_per_edge)))
+
+    with open(source["path"]) as src:
+        factors = [f for f in src.overviews(band) if f <= decimation]
+
+    return max(factors) if len(factors) > 0 else decimation
+
+
+def pyramid_windows(windows: list, sources: list[dict], decimations: list[int]) -> list[tuple]:
+    """The windows of a level of a pyramid: for a decimated source, the tiles of `pyramid_window_pixels`
+    decimated pixels covering its planned windows, so that the empty and outside windows stay skipped."""
+    tiles = []
+    seen = set()
+
+    for i, window in windows:
+        decimation = decimations[i]
+        if decimation == 1:
+            tiles.append((i, window))
+            continue
+
+        side = pyramid_window_pixels * decimation
+        key = (i, int(window.row_off) // side, int(window.col_off) // side)
+        if key in seen:
+            continue
+        seen.add(key)
+
+        grid = sources[i]["grid"]
+        row, col = key[1] * side, key[2] * side
+        tiles.append(
+            (i, Window(col, row, min(side, grid["width"] - col), min(side, grid["height"] - row)))
+        )
+
+    return tiles
+
+
+def rast_to_h3_pyramid(
+    in_path: str | list[str],
+    out_path: str,
+    resolutions: list[int],
+    h3_agg: str = "sum",
+    band: int = 1,
+    in_crs: str | None = None,
+    include: bool = False,
+    bbox: list | None = None,
+    aoi: str | None = None,
+    workers: int = 0,
+    chunk_size: int = chunk_size,
+    options: dict | None = None,
+    skip_empty: bool = True,
+) -> dict:
+    """Aggregate rasters into the H3 cells of several resolutions in one job, as a dataset partitioned
+    by resolution, 'h3_res=<r>/part-0.parquet' with the 'h3_id', 'band_var' columns.
+
+    The pixels are read once per resolution, decimated by `pyramid_decimation` so that the coarse levels
+    only read a small fraction of the pixels, from the overviews of the rasters when they have some.
+    A decimated pixel stands for the average of the valid pixels it covers, so the sums and counts of the
+    coarse levels are estimates, the finest levels are read at full resolution and are exact.
+
+    Parameters
+    ----------
+    in_path : str | list[str]
+        Paths to rasters, folders with rasters or glob patterns
+    out_path : str
+        The folder of the pyramid, created if needed
+    resolutions : list[int]
+        The H3 resolutions to aggregate into
+    h3_agg : str, optional
+        One of 'sum', 'mean' or 'count', by default "sum"
+    band : int, optional
+        The band to read, by default 1
+    in_crs : str | None, optional
+        CRS of the inputs if not available, by default None
+    include : bool, optional
+        Whether to include any potential negative values, by default False
+    bbox : list | None, optional
+        Only the pixels inside [xmin, ymin, xmax, ymax] in EPSG:4326 are read, by default None
+    aoi : str | None, optional
+        Only the pixels inside the geometries of this vector file are read, by default None
+    workers : int, optional
+        The number of processes converting the windows, 0 to convert them in the calling process, by default 0
+    chunk_size : int, optional
+        The number of windows converted at once by a worker, by default `chunk_size`
+    options : dict | None, optional
+        Settings of the parquet writer, by default `writer_args`, see `writer_options`
+    skip_empty : bool, optional
+        Whether to drop the windows found empty by `window_classes`, by default True
+
+    Returns
+    -------
+    dict
+        The number of cells written per resolution.
+    """
+    if h3_agg not in h3_aggs:
+        raise ValueError(f"Unknown aggregation '{h3_agg}', use one of {h3_aggs}")
+
+    src_files = check_paths(in_path)
+    if len(src_files) == 0:
+        raise IOError("No input files recognised.")
+
+    plan = plan_sources(
+        src_files,
+        {"crs": dst_crs},
+        band=band,
+        in_crs=in_crs,
+        aoi=read_aoi(bbox=bbox, aoi=aoi, crs=dst_crs),
+        skip_empty=skip_empty,
+    )
+
+    if options is None:
+        options = writer_args
+
+    cells = {}
+
+    with contextlib.ExitStack() as stack:
+        executor = None
+        if workers > 0:
+            executor = stack.enter_context(
+                concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+            )
+
+        for h3_res in sorted(resolutions):
+            decimations = [pyramid_decimation(source, h3_res, band) for source in plan["sources"]]
+            sources = [
+                source | {"decimation": decimation}
+                for source, decimation in zip(plan["sources"], decimations)
+            ]
+            windows = pyramid_windows(plan["windows"], sources, decimations)
+            print(
+                "H3 resolution ", h3_res, " : ", len(windows), " windows, decimation ", max(decimations)
+            )
+
+            convert = partial(
+                convert_chunk,
+                sources=sources,
+                rast_schema=h3_partial_schema,
+                band=plan["band"],
+                include=include,
+                h3_res=h3_res,
+            )
+            chunks = itertools.batched(windows, chunk_size)
+            results = map(convert, chunks) if executor is None else executor.map(convert, chunks)
+
+            partials = [h3_partial_schema.empty_table()]
+            rows = 0
+            for batches in results:
+                partials.append(Table.from_batches(batches, schema=h3_partial_schema))
+                rows += partials[-1].num_rows
+                if rows > h3_compact_rows:
+                    partials = [combine_h3_partials(partials)]
+                    rows = partials[0].num_rows
+
+            level = h3_values(combine_h3_partials(partials), h3_agg)
+            folder = os.path.join(out_path, f"h3_res={h3_res}")
+            os.makedirs(folder, exist_ok=True)
+            atomic_write_table(level, os.path.join(folder, "part-0.parquet"), **options)
+            cells[h3_res] = level.num_rows
+
+    return cells
+
+
+def parquet_files(in_paths: str | list[str]) -> list[str]:
+    """Resolve parquet files, folders and glob patterns into a sorted list of parquet files,
+    leaving out the hidden files such as '_metadata' and the temporary files of the writers."""
+    if isinstance(in_paths, str):
+        in_paths = [in_paths]
+
+    files = set()
+    for in_path in in_paths:
+        if os.path.isdir(in_path):
+            in_path = os.path.join(in_path, "**", "*.parquet")
+        files.update(
+            x
+            for x in glob(in_path, recursive=True)
+            if os.path.isfile(x) and x.endswith(".parquet") and not os.path.basename(x).startswith("_")
+        )
+
+    return sorted(files)
+
+
+def check_out_path(in_files: list[str], out_path: str):
+    """Raise an error if the output folder, whose old outputs are removed before writing, contains one of the inputs."""
+    out_path = os.path.realpath(out_path)
+    for file in in_files:
+        if os.path.commonpath([out_path, os.path.realpath(file)]) == out_path:
+            raise ValueError(f"The output folder {out_path} contains the input {file}, write into another folder.")
+
+
+def morton_keys(x, y, bounds: tuple):
+    """Z-order keys of coordinates, interleaving the bits of their positions on a 2^32 grid over the `bounds`
+    (xmin, ymin, xmax, ymax), so that pixels close on the ground have close keys."""
+    xmin, ymin, xmax, ymax = bounds
+    scale = float(2**32 - 1)
+
+    def spread(v, span):
+        v = (np.clip((v - span[0]) / max(span[1] - span[0], 1e-12), 0, 1) * scale).astype(np.uint64)
+        for shift, bits in [
+            (16, 0x0000FFFF0000FFFF),
+            (8, 0x00FF00FF00FF00FF),
+            (4, 0x0F0F0F0F0F0F0F0F),
+            (2, 0x3333333333333333),
+            (1, 0x5555555555555555),
+        ]:
+            v = (v | (v << np.uint64(shift))) & np.uint64(bits)
+        return v
+
+    return spread(np.asarray(x, dtype=float), (xmin, xmax)) | (
+        spread(np.asarray(y, dtype=float), (ymin, ymax)) << np.uint64(1)
+    )
+
+
+def consolidate_key(schema) -> str | None:
+    """The column the rows are sorted on when consolidated, 'h3_id' or 'pixel_id', None for a Z-order of 'lon', 'lat'."""
+    for name in ["h3_id", "pixel_id"]:
+        if name in schema.names:
+            return name
+    return None
+
+
+def sorted_runs(in_files: list[str], key: str | None, bounds, run_dir: str, run_rows: int) -> list[str]:
+    """First pass of the external sort: read the rows into runs of `run_rows` rows sorted on a '_key' column."""
+    runs = []
+    buffer = []
+    buffered = 0
+
+    def write_run():
+        rows = concat_tables(buffer)
+        if key is None:
+            keys = morton_keys(rows["lon"].to_numpy(), rows["lat"].to_numpy(), bounds)
+        else:
+            keys = rows[key].to_numpy()
+        rows = rows.append_column("_key", pa_array(keys, type=uint64())).sort_by("_key")
+        where = os.path.join(run_dir, f"run_{len(runs)}.parquet")
+        write_table(rows, where, compression="lz4", write_statistics=False)
+        runs.append(where)
+
+    for in_file in in_files:
+        for batch in ParquetFile(in_file).iter_batches(batch_size=consolidate_merge_rows):
+            buffer.append(Table.from_batches([batch]))
+            buffered += batch.num_rows
+            if buffered >= run_rows:
+                write_run()
+                buffer, buffered = [], 0
+
+    if buffered > 0:
+        write_run()
+
+    return runs
+
+
+def merge_runs(runs: list[str], batch_rows: int = consolidate_merge_rows):
+    """K-way merge of runs sorted on '_key', yielding sorted tables. At most `batch_rows` rows of each run are held:
+    the rows up to the smallest of the last keys of the heads of the runs are final and are merged, which
+    consumes at least one head at each step."""
+    readers = [ParquetFile(run).iter_batches(batch_size=batch_rows) for run in runs]
+    heads = [next(reader, None) for reader in readers]
+
+    while True:
+        live = [i for i, head in enumerate(heads) if head is not None]
+        if len(live) == 0:
+            return
+
+        bound = min(heads[i]["_key"][-1].as_py() for i in live)
+        parts = []
+        for i in live:
+            keys = heads[i]["_key"].to_numpy()
+            n = int(np.searchsorted(keys, bound, side="right"))
+            parts.append(Table.from_batches([heads[i].slice(0, n)]))
+            heads[i] = heads[i].slice(n) if n < len(keys) else next(readers[i], None)
+
+        yield concat_tables(parts).sort_by("_key")
+
+
+def consolidate(
+    in_path: str | list[str],
+    out_path: str,
+    file_mb: float = consolidate_file_mb,
+    options: dict | None = None,
+    run_rows: int = consolidate_run_rows,
+) -> list[str]:
+    """Merge the files written by the workers of `rastapar` into a dataset of sorted, evenly sized files
+    with a '_metadata' summary, by an external sort with bounded memory: the rows are sorted into runs
+    of `run_rows` rows written to disk, which are then merged `consolidate_fan_in` at a time.
+
+    The rows are sorted on 'h3_id' or 'pixel_id' if there is one, on a Z-order of 'lon', 'lat' otherwise,
+    so that the statistics of the row groups let queries on a region skip most of them.
+
+    Parameters
+    ----------
+    in_path : str | list[str]
+        Parquet files, folders or glob patterns, with the same columns
+    out_path : str
+        The folder to write 'part-<n>.parquet' and '_metadata' into, created if needed, which must not contain any of the inputs
+    file_mb : float, optional
+        The target size of a file, by default `consolidate_file_mb`
+    options : dict | None, optional
+        Settings of the parquet writer, by default the 'fast-read' profile, see `writer_options`
+    run_rows : int, optional
+        The number of rows sorted in memory at a time, by default `consolidate_run_rows`
+
+    Returns
+    -------
+    list[str]
+        The consolidated files.
+    """
+    in_files = parquet_files(in_path)
+    if len(in_files) == 0:
+        raise IOError("No parquet files recognised.")
+    check_out_path(in_files, out_path)
+
+    metas = [read_metadata(file) for file in in_files]
+    rows_schema = metas[0].schema.to_arrow_schema()
+    for file, meta in zip(in_files, metas):
+        if not meta.schema.to_arrow_schema().equals(rows_schema):
+            raise ValueError(f"The columns of {file} differ from the ones of {in_files[0]}.")
+
+    # the files are no longer partitioned
+    metadata = {k: v for k, v in (rows_schema.metadata or {}).items() if k != partition_metadata_key}
+    rows_schema = rows_schema.with_metadata(metadata)
+
+    total_rows = sum(meta.num_rows for meta in metas)
+    total_bytes = sum(os.path.getsize(file) for file in in_files)
+    n_files = max(1, int(np.ceil(total_bytes / (file_mb * 2**20))))
+    file_rows = max(1, -(-total_rows // n_files))
+
+    key = consolidate_key(rows_schema)
+    bounds = None
+    if key is None:
+        # one column at a time, the statistics are not always written
+        ranges = {"lon": [], "lat": []}
+        for file, meta in zip(in_files, metas):
+            if meta.num_rows > 0:
+                for name in ranges:
+                    ranges[name].append(pc.min_max(read_table(file, columns=[name])[name]))
+        bounds = (
+            min([r["min"].as_py() for r in ranges["lon"]], default=0),
+            min([r["min"].as_py() for r in ranges["lat"]], default=0),
+            max([r["max"].as_py() for r in ranges["lon"]], default=0),
+            max([r["max"].as_py() for r in ranges["lat"]], default=0),
+        )
+
+    if options is None:
+        options = writer_options("fast-read")
+    # the rows arrive sorted
+    options = options | {"sort_rows": False}
+    if key is not None:
+        options["sorting_columns"] = SortingColumn.from_ordering(rows_schema, [(key, "ascending")])
+
+    os.makedirs(out_path, exist_ok=True)
+    for old in glob(os.path.join(out_path, "part-*.parquet")):
+        os.remove(old)
 
-    with open(src_file) as src:
+    out_files = []
 
-        with WarpedVRT(src, **vrt_options) as vrt:
+    with tempfile.TemporaryDirectory(dir=out_path, prefix="_runs") as run_dir:
+        runs = sorted_runs(in_files, key, bounds, run_dir, run_rows)
 
-            win_transfrom = vrt.window_transform
+        # intermediate passes keep the number of runs read at once bounded
+        level = 0
+        while len(runs) > consolidate_fan_in:
+            merged = []
+            for group in itertools.batched(runs, consolidate_fan_in):
+                where = os.path.join(run_dir, f"merge_{level}_{len(merged)}.parquet")
+                with ParquetWriter(where, ParquetFile(group[0]).schema_arrow, compression="lz4") as writer:
+                    for rows in merge_runs(group):
+                        writer.write_table(rows)
+                for run in group:
+                    os.remove(run)
+                merged.append(where)
+            runs = merged
+            level += 1
 
-            with ParquetWriter(
-                where=out_file, schema=rast_schema, **writer_args
-            ) as writer:
+        writer = None
+        written = 0
+        try:
+            for rows in merge_runs(runs):
+                rows = rows.drop_columns("_key").replace_schema_metadata(metadata)
+                while rows.num_rows > 0:
+                    if writer is None:
+                        out_files.append(os.path.join(out_path, f"part-{len(out_files)}.parquet"))
+                        writer = AtomicParquetWriter(out_files[-1], rows_schema, **options)
+                        written = 0
+                    n = min(rows.num_rows, file_rows - written)
+                    # batch by batch, to be coalesced into row groups of `row_group_size`
+                    for batch in rows.slice(0, n).to_batches():
+                        writer.write_batch(batch)
+                    written += n
+                    rows = rows.slice(n)
+                    if written == file_rows:
+                        writer.close()
+                        writer = None
+        finally:
+            if writer is not None:
+                writer.close()
 
-                for window in windows:
+    collector = []
+    for file in out_files:
+        meta = read_metadata(file)
+        meta.set_file_path(os.path.basename(file))
+        collector.append(meta)
+    write_metadata(rows_schema, os.path.join(out_path, "_metadata"), metadata_collector=collector)
 
-                    out = rast_convert_core(
-                        vrt, transform=win_transfrom, win=window, band=band
-                    )
-                    # out = out.filter(nodata_filter_expr)
-
-                    out.drop(index=out.loc[out.band_var == nodata].index, inplace=True)
-
-                    if not include:
-                        # out = out.filter(negative_filter_expr)
-                        out.drop(index=out.loc[out.band_var <= 0].index, inplace=True)
-
-                    if out.shape[0] > 0:
-                        writer.write(
-                            # out
-                            RecordBatch.from_pandas(
-                                df=out,
-                                schema=rast_schema,
-                                preserve_index=False,
-                                nthreads=1,
-                            )
-                        )
-                    # gc.collect()
-                    # del out
+    return out_files
+
+
+def consolidate_cli(args=None):
+    """The 'rastapar consolidate' command, see `consolidate`."""
+    parser = argparse.ArgumentParser(
+        prog="Rast Converter consolidate",
+        description="Merge the parquet files of a rastapar run into sorted, evenly sized files with a '_metadata' summary",
+    )
+
+    parser.add_argument(
+        "in_path",
+        nargs="+",
+        help="Parquet files, folders or glob patterns to merge.",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--out_path",
+        "-o_p",
+        nargs="?",
+        default="rast_convert_consolidated",
+        help="A folder to save into. Default: %(default)s",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--file_mb",
+        nargs="?",
+        default=consolidate_file_mb,
+        help="Target size of the files in MB. Default: %(default)s",
+        type=float,
+    )
+
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        default="fast-read",
+        choices=list(writer_profiles),
+        help="Settings of the parquet writers. Default: %(default)s",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--run_rows",
+        nargs="?",
+        default=consolidate_run_rows,
+        help="Number of rows sorted in memory at a time, which bounds the memory used. Default: %(default)s",
+        type=int,
+    )
+
+    args = vars(parser.parse_args(args))
+
+    out_files = consolidate(
+        args["in_path"],
+        args["out_path"],
+        file_mb=args["file_mb"],
+        options=writer_options(args["profile"]),
+        run_rows=args["run_rows"],
+    )
+    print("Consolidated into ", len(out_files), " files in ", args["out_path"])
 
 
 def rast_converter(args=None):
@@ -126,6 +2606,12 @@ def rast_converter(args=None):
         If inputs are not properly specified
     """
 
+    if args is None:
+        args = argv[1:]
+
+    if args[:1] == ["consolidate"]:
+        return consolidate_cli(args[1:])
+
     parser = argparse.ArgumentParser(
         prog="Rast Converter",
         description="Convert rasters to parquet files efficiently",
@@ -134,8 +2620,8 @@ def rast_converter(args=None):
 
     parser.add_argument(
         "in_path",
-        nargs="?",
-        help="A path to a raster for processing.",
+        nargs="+",
+        help="Paths to rasters, folders with rasters or glob patterns for processing.",
         type=str,
     )
 
@@ -157,6 +2643,44 @@ def rast_converter(args=None):
         type=int,
     )
 
+    parser.add_argument(
+        "--bands",
+        nargs="+",
+        default=None,
+        help="Several bands to read in a single pass and write into one table with a 'band_<i>_var' column per band.",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--all_bands",
+        action="store_true",
+        help="Read all the bands of the raster in a single pass.",
+    )
+
+    parser.add_argument(
+        "--nodata_mode",
+        nargs="?",
+        default="any",
+        choices=["any", "all"],
+        help="With several bands, drop the pixels where any band or where all the bands are nodata. Default: %(default)s",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--time",
+        action="store_true",
+        help="Read the bands as the timesteps of a time stack, such as the time dimension of a NetCDF file, into a row per pixel and timestep with a 'time' column.",
+    )
+
+    parser.add_argument(
+        "--time_range",
+        "--time-range",
+        nargs=2,
+        default=None,
+        help="With --time, only read the timesteps between these two times, as ISO dates such as 2020-01-01 or as numbers.",
+        type=str,
+    )
+
     parser.add_argument(
         "--in_crs",
         "-i_c",
@@ -175,6 +2699,37 @@ def rast_converter(args=None):
         type=str,
     )
 
+    parser.add_argument(
+        "--no_skip_empty",
+        action="store_true",
+        help="Read every window, including the ones the masks of the rasters find empty.",
+    )
+
+    parser.add_argument(
+        "--reproject",
+        nargs="?",
+        default="warp",
+        choices=["warp", "coords"],
+        help="Resample the pixels of the rasters in another CRS into the output CRS, or keep them and only transform the coordinates of their centres. Default: %(default)s",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--bbox",
+        nargs=4,
+        default=None,
+        help="Only convert the pixels inside this bounding box, given as xmin ymin xmax ymax in the output CRS.",
+        type=float,
+    )
+
+    parser.add_argument(
+        "--aoi",
+        nargs="?",
+        default=None,
+        help="Only convert the pixels inside the geometries of this vector file.",
+        type=str,
+    )
+
     parser.add_argument(
         "--include_negative",
         "-i_n",
@@ -184,6 +2739,154 @@ def rast_converter(args=None):
         type=bool,
     )
 
+    parser.add_argument(
+        "--grid_index",
+        action="store_true",
+        help="Write the ids of the pixels in the output grid instead of their coordinates, with the grid in the metadata of the files.",
+    )
+
+    parser.add_argument(
+        "--h3_res",
+        "--h3-res",
+        nargs="?",
+        default=None,
+        help="Aggregate the pixels into the H3 cells of this resolution inside the workers and write 'h3_id', 'band_var'.",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--h3_pyramid",
+        nargs="+",
+        default=None,
+        help="Aggregate the pixels into the H3 cells of each of these resolutions in one job, reading the coarse ones from decimated reads or overviews, into 'h3_res=<r>' folders.",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--h3_agg",
+        nargs="?",
+        default=None,
+        choices=list(dict.fromkeys(h3_aggs + class_aggs)),
+        help="Aggregation of the pixel values per H3 cell, with --categorical of the classes of the pixels. Default: sum, count with --categorical",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--categorical",
+        action="store_true",
+        help="The band holds integer class codes, written in a 'band_class' column of the native type with dictionary encoding. With --h3_res, the pixels of each class are counted per cell.",
+    )
+
+    parser.add_argument(
+        "--h3_area_weights",
+        action="store_true",
+        help="With --h3_res, apportion the value of each pixel to the cells it overlaps in proportion to the overlapping areas, instead of assigning it to the cell of its centre. The pixel counts become fractional.",
+    )
+
+    parser.add_argument(
+        "--encoding",
+        nargs="?",
+        default=None,
+        choices=list(encodings),
+        help="Store the band values as float16, or as uint16 or int16 codes decoded as code * scale + offset, recorded in the schema metadata and decoded by scalenav.oop.table.",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--scale",
+        nargs="?",
+        default=None,
+        help="The step between two codes of an integer --encoding. Default: the range of the values in the statistics of the rasters over the range of the codes.",
+        type=float,
+    )
+
+    parser.add_argument(
+        "--offset",
+        nargs="?",
+        default=None,
+        help="The value of the code 0 of an integer --encoding, by default the one mapping the lowest value to the lowest code.",
+        type=float,
+    )
+
+    parser.add_argument(
+        "--partition",
+        nargs="?",
+        default=None,
+        help="Write hive style partitions keyed by the parent H3 cell, 'h3:<res>', or by lon/lat tiles, 'tile:<degrees>'.",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        default=None,
+        choices=list(writer_profiles),
+        help="Settings of the parquet writers, for the throughput of the ingestion or the speed of later scans. Default: fast-write",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--compression",
+        nargs="?",
+        default=None,
+        choices=["zstd", "lz4", "snappy", "gzip", "none"],
+        help="Compression codec of the output, overriding the one of the profile.",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--compression_level",
+        nargs="?",
+        default=None,
+        help="Compression level of the codec, overriding the one of the profile.",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--row_group_size",
+        nargs="?",
+        default=None,
+        help="Number of rows of the row groups of the output, overriding the one of the profile.",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--metrics",
+        nargs="?",
+        default=None,
+        const="_metrics.jsonl",
+        help="Record the time spent in each stage, per window and per worker, in a JSON lines file and print a summary. A file name without a folder is written in the output folder. Default without a value: %(const)s",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--duckdb",
+        nargs="?",
+        default=None,
+        help="Write into a table of this DuckDB database instead of parquet files, without intermediate files.",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--table",
+        nargs="?",
+        default=None,
+        help="The table of the DuckDB database, created or replaced. Default: the name of the input file.",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        action="store_true",
+        help="Write one fragment per chunk of windows and record it in a manifest so that the run can be resumed.",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume a checkpointed run in the output folder, skipping the chunks it finished.",
+    )
+
     parser.add_argument(
         "--workers",
         "-w",
@@ -193,16 +2896,96 @@ def rast_converter(args=None):
         type=int,
     )
 
+    parser.add_argument(
+        "--engine",
+        nargs="?",
+        default=None,
+        choices=["threads", "processes"],
+        help="Run the workers in threads sharing one writer, or in processes. Default: threads when no raster needs warping, processes otherwise.",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--window_pixels",
+        nargs="?",
+        default=window_target_pixels,
+        help="Merge the native blocks smaller than this number of pixels, such as the rows of striped rasters, into read windows of about this size. Default: %(default)s",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--window_mb",
+        nargs="?",
+        default=None,
+        help="Merge the native blocks into read windows of about this size of values in MB, instead of --window_pixels.",
+        type=float,
+    )
+
+    parser.add_argument(
+        "--max_window_mb",
+        nargs="?",
+        default=None,
+        help="Split the native blocks whose values take more than this size in MB, to bound the memory of the workers.",
+        type=float,
+    )
+
+    parser.add_argument(
+        "--chunk_size",
+        nargs="?",
+        default=chunk_size,
+        help="The number of windows a worker takes from the shared queue at a time. Default: %(default)s",
+        type=int,
+    )
+
     args = vars(parser.parse_args(args))
 
     #### Process parameters
-    src_file = args["in_path"]
+    src_files = check_paths(args["in_path"])
     out_fold = args["out_path"]
     band = args["band"]
+    bands = args["bands"]
+    all_bands = args["all_bands"]
+    nodata_mode = args["nodata_mode"]
+    time_stack = args["time"] or args["time_range"] is not None
+    time_range = args["time_range"]
     in_crs = args["in_crs"]
     out_crs = args["out_crs"]
     include = args["include_negative"]  # exclude non positive values by default
     num_workers = args["workers"]
+    engine = args["engine"]
+    bbox = args["bbox"]
+    aoi_file = args["aoi"]
+    metrics = args["metrics"]
+    grid_index = args["grid_index"]
+    reproject = args["reproject"]
+    skip_empty = not args["no_skip_empty"]
+    windows_per_chunk = args["chunk_size"]
+    window_sizes = {
+        "window_pixels": args["window_pixels"],
+        "window_mb": args["window_mb"],
+        "max_window_mb": args["max_window_mb"],
+    }
+    h3_res = args["h3_res"]
+    h3_agg = args["h3_agg"]
+    categorical = args["categorical"]
+    encoding = args["encoding"]
+    area_weights = args["h3_area_weights"]
+    h3_pyramid = args["h3_pyramid"]
+    partition = args["partition"]
+    resume = args["resume"]
+    checkpoint = args["checkpoint"] or resume
+    database = args["duckdb"]
+    options = writer_options(
+        args["profile"] or "fast-write",
+        compression=args["compression"],
+        compression_level=args["compression_level"],
+        row_group_size=args["row_group_size"],
+    )
+
+    if len(src_files) == 0:
+        raise IOError("No input files recognised.")
+
+    print("Reading in from ", len(src_files), " files.")
 
     if out_crs is not None:
         out_crs = check_out_crs(out_crs)
@@ -211,6 +2994,97 @@ def rast_converter(args=None):
 
     print("Output CRS : ", str(out_crs))
 
+    if h3_res is not None and out_crs != dst_crs:
+        raise ValueError("Projecting on the H3 grid requires an 'epsg:4326' output CRS.")
+
+    if partition is not None:
+        parse_partition(partition)
+
+    if grid_index and (partition is not None or h3_res is not None):
+        raise ValueError("A grid index output can not be partitioned nor aggregated into H3 cells.")
+
+    if h3_agg is None:
+        h3_agg = "count" if categorical else "sum"
+
+    if categorical:
+        if h3_agg not in class_aggs:
+            raise ValueError(f"The classes of a categorical raster are aggregated with one of {class_aggs}")
+        if bands is not None or all_bands or time_stack or h3_pyramid is not None or database is not None:
+            raise ValueError("A categorical raster is read one band at a time into parquet files.")
+    elif h3_agg not in h3_aggs:
+        raise ValueError(f"Unknown aggregation '{h3_agg}', use one of {h3_aggs}")
+
+    if encoding is not None and (
+        categorical or h3_res is not None or h3_pyramid is not None or database is not None
+    ):
+        raise ValueError("Only the pixel values written into parquet files are encoded.")
+
+    if area_weights and (h3_res is None or categorical or h3_pyramid is not None or database is not None):
+        raise ValueError("Area weights apportion the values of a band to the H3 cells of --h3_res in parquet files.")
+
+    aoi = read_aoi(bbox=bbox, aoi=aoi_file, crs=out_crs)
+
+    if h3_pyramid is not None:
+        if out_crs != dst_crs or isinstance(bands, list) or all_bands:
+            raise ValueError("An H3 pyramid reads a single band in an 'epsg:4326' output CRS.")
+        if not os.path.exists(out_fold):
+            os.mkdir(out_fold)
+        cells = rast_to_h3_pyramid(
+            src_files,
+            out_fold,
+            h3_pyramid,
+            h3_agg=h3_agg,
+            band=band,
+            in_crs=in_crs,
+            include=include,
+            bbox=bbox,
+            aoi=aoi_file,
+            workers=num_workers,
+            chunk_size=windows_per_chunk,
+            options=options,
+            skip_empty=skip_empty,
+        )
+        print("Cells per resolution : ", cells)
+        return
+
+    if database is not None:
+        if partition is not None or checkpoint:
+            raise ValueError("A DuckDB output can not be partitioned nor checkpointed.")
+        # the table is written by DuckDB, in the calling process
+        parquet_flags = ["profile", "compression", "compression_level", "row_group_size", "metrics", "engine"]
+        ignored = [f"--{name}" for name in parquet_flags if args[name] is not None]
+        if len(ignored) > 0:
+            parser.error(f"{', '.join(ignored)} can not be used with --duckdb.")
+        table = args["table"]
+        if table is None:
+            table = source_name(src_files[0]) if len(src_files) == 1 else "rast_convert"
+        rows = rast_to_duckdb(
+            src_files,
+            database,
+            table,
+            h3_res=h3_res,
+            h3_agg=h3_agg,
+            band=band,
+            bands=bands,
+            all_bands=all_bands,
+            in_crs=in_crs,
+            out_crs=out_crs,
+            include=include,
+            nodata_mode=nodata_mode,
+            bbox=bbox,
+            aoi=aoi_file,
+            grid_index=grid_index,
+            reproject=reproject,
+            time=time_stack,
+            time_range=time_range,
+            skip_empty=skip_empty,
+            workers=num_workers,
+            chunk_size=windows_per_chunk,
+            **window_sizes,
+        )
+        print("Rows written to ", database, ".", table, " : ", rows)
+        return
+
     # options here : https://rasterio.readthedocs.io/en/stable/api/rasterio.vrt.html#rasterio.vrt.WarpedVRT
     vrt_options = {
         "crs": out_crs,
@@ -219,87 +3093,282 @@ def rast_converter(args=None):
     if not os.path.exists(out_fold):
         os.mkdir(out_fold)
 
-    filename = src_file.split("/")[-1].split(".")[0]
+    if metrics is not None:
+        if os.path.dirname(metrics) == "":
+            metrics = os.path.join(out_fold, metrics)
+        if os.path.exists(metrics):
+            os.remove(metrics)
+        run_start = time.perf_counter()
 
-    out_files = ""
+    if len(src_files) == 1:
+        filename = source_name(src_files[0])
+    else:
+        filename = "rast_convert"
 
-    with open(src_file) as src:
+    plan_start = time.perf_counter()
+    plan = plan_sources(
+        src_files,
+        vrt_options,
+        band=band,
+        bands=bands,
+        all_bands=all_bands,
+        in_crs=in_crs,
+        nodata_mode=nodata_mode,
+        aoi=aoi,
+        reproject=reproject,
+        time=time_stack,
+        time_range=time_range,
+        skip_empty=skip_empty,
+        **window_sizes,
+    )
+    sources = plan["sources"]
+    windows = plan["windows"]
+    plan_seconds = time.perf_counter() - plan_start
 
-        # print(src.count)
-        if band > src.count:
-            raise IOError(
-                "Band parameter exceeds available bands.",
-                "Available bands : ",
-                src.count,
-            )
-        if src.count == 1:
-            out_files = [
-                out_fold + "/" + filename + "_" + str(i) + ".parquet"
-                for i in range(num_workers)
-            ]
-        elif src.count > 1:
-            out_files = [
-                out_fold
-                + "/"
-                + filename
-                + "_band_"
-                + str(band)
-                + "_"
-                + str(i)
-                + ".parquet"
-                for i in range(num_workers)
-            ]
-        # check the source and get the needed info once for user down the road.
-        src_crs = check_crs(src, in_crs=in_crs)
-        vrt_options["src_crs"] = src_crs
+    if aoi is not None:
+        print("Windows outside the area of interest : ", plan["outside"])
+    band = plan["band"]
 
-        print("Input CRS : ", src_crs)
+    n_windows = sum(plan["classes"].values())
+    print(
+        "Windows skipped as empty : ",
+        plan["classes"]["empty"],
+        "/",
+        n_windows,
+        f"({plan['classes']['empty'] / max(n_windows, 1):.1%}), full : ",
+        plan["classes"]["full"],
+        ", empty in the overviews, checked by the workers : ",
+        plan["classes"]["unsure"],
+    )
+    print(f"Planning : {plan_seconds:.2f} s")
 
-        nodata = check_nodata(src)
-        print("No data value : ", nodata)
+    if (isinstance(band, list) or time_stack) and h3_res is not None:
+        raise ValueError("Aggregating into H3 cells reads a single band.")
 
-        # windows
-        windows = [
-            window for _, window in WarpedVRT(src, **vrt_options).block_windows()
-        ]
+    if time_stack:
+        print("Timesteps : ", sum(len(source["times"]) for source in sources))
 
-        # computing individual batch size for each core
-        batch_size = int(np.ceil(len(windows) / (num_workers)))
-        print("Batch size : ", batch_size)
+    if len(sources) == 1:
+        print("Input CRS : ", sources[0]["vrt_options"]["src_crs"])
+        print("No data value : ", sources[0]["nodata"])
 
-        # dividing into batches
-        batches = itertools.batched(windows, batch_size)
+    chunks = schedule(windows, plan["weights"], size=windows_per_chunk)
+    print("Windows : ", len(windows), " in ", len(chunks), " chunks")
 
-        # inferring the dtype
-        band_var_dtype = infer_dtype(src)
+    rast_schema = plan["rast_schema"]
+    print("Variable types infered : ", rast_schema.types[2:])
 
-        print("Variable type infered : ", band_var_dtype)
+    if categorical:
+        if not pa_types.is_integer(rast_schema.field("band_var").type):
+            raise ValueError("The classes of a categorical raster are integers.", rast_schema.field("band_var").type)
+        # the few distinct codes are cheap to dictionary encode
+        dictionary_columns = options.get("use_dictionary", True)
+        if dictionary_columns is not True:
+            options = options | {"use_dictionary": list(dictionary_columns or []) + ["band_class"]}
 
-        # making the raster with the information
-        rast_schema = schema(
-            [("lon", float32()), ("lat", float32()), ("band_var", band_var_dtype)]
-        )
+    if h3_res is not None:
+        print("Aggregating into H3 cells at resolution : ", h3_res)
+        if categorical:
+            rast_schema = h3_class_schema(rast_schema.field("band_var").type)
+        elif area_weights:
+            rast_schema = h3_area_partial_schema
+        else:
+            rast_schema = h3_partial_schema
+    elif categorical:
+        rast_schema = class_schema(rast_schema)
 
-        rast_schema.with_metadata(
-            {
-                "lon": "Longitude coordinate",
-                "lat": "Latitude coordinate",
-                "band_var": "Value associated",
-            }
+    if encoding is not None:
+        scale, offset = args["scale"], args["offset"]
+        if encoding != "float16" and (scale is None or offset is None):
+            auto_scale, auto_offset = encoding_params(sources, band, encoding)
+            scale = auto_scale if scale is None else scale
+            offset = auto_offset if offset is None else offset
+        rast_schema = encoded_schema(rast_schema, encoding, scale=scale, offset=offset)
+        print("Encoding : ", encoding, "" if encoding == "float16" else f"scale {scale}, offset {offset}")
+
+    if grid_index:
+        rast_schema = grid_index_schema(rast_schema, sources, out_crs)
+        # the ids mostly increase by one along the rows of a window, which delta encoding reduces to a few bits
+        dictionary_columns = options.get("use_dictionary", True)
+        if dictionary_columns is True:
+            dictionary_columns = rast_schema.names
+        options = options | {
+            "column_encoding": {"pixel_id": "DELTA_BINARY_PACKED"},
+            "use_dictionary": [c for c in dictionary_columns or [] if c != "pixel_id"],
+        }
+
+    if time_stack:
+        out_files = [
+            out_fold + "/" + filename + "_time_" + str(i) + ".parquet"
+            for i in range(num_workers)
+        ]
+    elif isinstance(band, list):
+        out_files = [
+            out_fold + "/" + filename + "_bands_" + str(i) + ".parquet"
+            for i in range(num_workers)
+        ]
+    elif plan["band_count"] == 1:
+        out_files = [
+            out_fold + "/" + filename + "_" + str(i) + ".parquet"
+            for i in range(num_workers)
+        ]
+    else:
+        out_files = [
+            out_fold + "/" + filename + "_band_" + str(band) + "_" + str(i) + ".parquet"
+            for i in range(num_workers)
+        ]
+
+    finished = {}
+
+    if checkpoint:
+        # the fragments of unfinished chunks are removed from the output folder
+        check_out_path(src_files, out_fold)
+        fingerprint = run_fingerprint(
+            src_files=src_files,
+            band=band,
+            out_crs=out_crs,
+            in_crs=in_crs,
+            include=include,
+            nodata_mode=nodata_mode,
+            h3_res=h3_res,
+            partition=partition,
+            bbox=bbox,
+            aoi=aoi_file,
+            grid_index=grid_index,
+            reproject=reproject,
+            time=time_stack,
+            time_range=time_range,
+            skip_empty=skip_empty,
+            categorical=categorical,
+            area_weights=area_weights,
+            encoding=(rast_schema.metadata or {}).get(encoding_metadata_key, b"").decode(),
+            chunk_size=windows_per_chunk,
+            chunks=len(chunks),
+            **window_sizes,
         )
+        manifest = read_manifest(out_fold) if resume else {}
+
+        if len(manifest) > 0:
+            if manifest["fingerprint"] != fingerprint:
+                raise IOError(
+                    "The run in the output folder used other parameters, it can not be resumed."
+                )
+            finished = manifest["chunks"]
+            print("Resuming, chunks already finished : ", len(finished), "/", len(chunks))
+        else:
+            for old in glob(os.path.join(out_fold, "_manifest_*.jsonl")):
+                os.remove(old)
+            with builtins.open(os.path.join(out_fold, "_manifest.json"), "w") as f:
+                json.dump({"fingerprint": fingerprint, "chunks": len(chunks)}, f)
+
+        clean_fragments(out_fold, set(finished), [source_name(file) for file in out_files])
+
+    if engine is None:
+        # GDAL reads and the kernels release the GIL, the warping does not.
+        warping = any(source["warp"] for source in sources)
+        engine = "processes" if warping else "threads"
+
+    print("Engine : ", engine)
+
+    # The workers take chunks of windows from a shared queue
+    # until they receive a sentinel, so idle workers pick up the remaining work.
+    with contextlib.ExitStack() as stack:
+        writer = None
+
+        if engine == "threads":
+            queue = Queue()
+            if not checkpoint and h3_res is None:
+                # closed after the pool, once all the threads are done
+                writer = stack.enter_context(
+                    SharedWriter(open_writer(out_files[0], rast_schema, partition, options))
+                )
+                print("Writing into : ", out_files[0] if partition is None else out_fold)
+            executor = stack.enter_context(
+                concurrent.futures.ThreadPoolExecutor(max_workers=num_workers)
+            )
+        else:
+            queue = stack.enter_context(multiprocessing.Manager()).Queue()
+            executor = stack.enter_context(
+                concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+            )
+
+        for chunk_id, chunk in enumerate(chunks):
+            if chunk_id not in finished:
+                queue.put((chunk_id, chunk))
+        for _ in range(num_workers):
+            queue.put(None)
 
-    # We map the process() function over the list of
-    # windows.
-    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
         futures = []
-        for w, v, win in zip(out_files, [src_file] * num_workers, batches):
+        for w in out_files:
             futures.append(
                 executor.submit(
-                    process, w, v, win, rast_schema, vrt_options, nodata, include, band
+                    process,
+                    w,
+                    sources,
+                    queue,
+                    rast_schema,
+                    vrt_options,
+                    None,
+                    include,
+                    band,
+                    h3_res,
+                    nodata_mode,
+                    None if h3_res is not None else partition,
+                    checkpoint,
+                    options,
+                    writer,
+                    metrics,
                 )
             )
-        # Wait for all tasks to complete
-        concurrent.futures.wait(futures)
+        # Wait for all tasks to complete, raising the errors of the workers
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+    if h3_res is not None:
+        if checkpoint:
+            # the fragments of all the chunks, including the ones from before resuming
+            out_files = list(
+                itertools.chain.from_iterable(read_manifest(out_fold)["chunks"].values())
+            )
+        # the workers that received no batch did not write anything
+        out_files = [f for f in out_files if os.path.exists(f)]
+        h3_file = out_fold + "/" + filename + "_h3_" + str(h3_res) + ".parquet"
+        n_cells = merge_h3_parts(
+            out_files, h3_file, h3_agg=h3_agg, partition=partition, options=options
+        )
+        print("Cells written : ", n_cells, " into ", h3_file if partition is None else out_fold)
+
+        if checkpoint:
+            # the fragments are merged, the run can not be resumed anymore
+            for manifest_file in glob(os.path.join(out_fold, "_manifest*")):
+                os.remove(manifest_file)
+
+    if metrics is not None:
+        output_bytes = 0
+        for root, _, files in os.walk(out_fold):
+            output_bytes += sum(
+                os.path.getsize(os.path.join(root, f)) for f in files if f.endswith(".parquet")
+            )
+        MetricsLog(metrics, "run").emit(
+            {
+                "type": "run",
+                "seconds": time.perf_counter() - run_start,
+                "engine": engine,
+                "workers": num_workers,
+                "windows": len(windows),
+                "windows_skipped": plan["classes"]["empty"] + plan["outside"],
+                "windows_unsure": plan["classes"]["unsure"],
+                "plan_seconds": plan_seconds,
+                "bytes": output_bytes,
+                # the largest of the worker processes, or of this one with threads
+                "peak_rss_mb": max(
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+                )
+                / 1024,
+            }
+        )
+        print(metrics_summary(metrics))
 
 
 if __name__ == "__main__":
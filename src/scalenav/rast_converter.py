@@ -1,21 +1,65 @@
-"""Conversion of rasters into tables. This module provides a command line tool and a function that both *ingest* a raster file and produce a 3 column parquet 
-table with coordinates and band value.
+"""Conversion of rasters into tables. This module provides the functions that *ingest* a raster file and produce a 3 column parquet 
+table with coordinates and band value. The command line tool running them in parallel, `rastapar`, is in `rast_convert_par`.
 
 See the data_ingestion notebook for templates of this.
 """
 
-import argparse
-from os.path import exists, isdir, isfile
-from re import search
+from os.path import isdir, isfile
+from threading import local
+from time import perf_counter
+from json import dumps, loads
+from functools import lru_cache
+from re import search, match
 from glob import glob
-from numpy import meshgrid, arange, array, nan, dtype
+from numpy import (
+    meshgrid,
+    arange,
+    array,
+    dtype,
+    isnan,
+    nonzero,
+    float64,
+    ones_like,
+    unique,
+    bincount,
+    frompyfunc,
+    uint64 as np_uint64,
+    logical_and,
+    logical_or,
+    rint,
+    concatenate,
+    repeat,
+    flatnonzero,
+    indices,
+    datetime64,
+    lexsort,
+    diff,
+    append,
+    iinfo,
+    clip,
+    stack,
+    zeros,
+    roll,
+    sign,
+    maximum,
+    take_along_axis,
+    abs as np_abs,
+    cos,
+    radians,
+    where,
+    int32,
+)
 
 from pandas import DataFrame
+import shapely
+from shapely import STRtree
+import h3.api.basic_int as h3_int
 from pyproj import Transformer
 
 from rasterio.transform import xy
-from rasterio import open
-from rasterio.vrt import WarpedVRT
+from rasterio.enums import Resampling
+from affine import Affine
+from rasterio.features import geometry_mask
 from rasterio.io import DatasetReader
 from rasterio.crs import CRS
 
@@ -25,15 +69,22 @@ from pyarrow import (
     schema,
     field,
     uint16,
-    table,
-    Table,
-    table,
+    int16,
     from_numpy_dtype,
+    RecordBatch,
+    array as pa_array,
+    uint64,
 )
-from pyarrow.parquet import ParquetWriter
+from pyarrow import float64 as pa_float64
+
+# extensions of the raster files recognised
+raster_pattern = r"(.ti[f]{1,2}$)|(.nc$)"
 
+# bands of a time stack read at once from a window
+time_chunk_bands = 16
 
-from tqdm import tqdm
+# seconds in the units of the CF time coordinates, '<unit> since <date>'
+time_units = {"seconds": 1, "minutes": 60, "hours": 3_600, "days": 86_400}
 
 
 def check_path(in_path: str):
@@ -61,7 +112,7 @@ def check_path(in_path: str):
 
     if isfile(in_path):
         return (
-            in_path if search(pattern=r"(.ti[f]{1,2}$)|(.nc$)", string=in_path) else ""
+            in_path if search(pattern=raster_pattern, string=in_path) else ""
         )
 
     if isdir(in_path):
@@ -75,20 +126,57 @@ def check_path(in_path: str):
     ]
 
 
-def check_nodata(source: DatasetReader):
+def check_paths(in_paths: str | list[str]) -> list[str]:
+    """Resolve a mix of raster files, folders with rasters and glob patterns into a sorted list of raster files.
+
+    Parameters
+    ----------
+    in_paths : str | list[str]
+        Paths to raster files, folders or glob patterns, such as 'tiles/*.tif'
+
+    Returns
+    -------
+    list[str]
+        The distinct raster files found.
+    """
+
+    if isinstance(in_paths, str):
+        in_paths = [in_paths]
+
+    files = []
+
+    for in_path in in_paths:
+        if isfile(in_path) or isdir(in_path):
+            found = check_path(in_path)
+        else:
+            found = [
+                x
+                for x in glob(in_path, recursive=True)
+                if isfile(x) and search(pattern=raster_pattern, string=x)
+            ]
+
+        files.extend([found] if isinstance(found, str) else found)
+
+    return sorted(set(x for x in files if x != ""))
+
+
+def check_nodata(source: DatasetReader, band: int = 1):
     """Checking the nodata field in a raster, assume it's 0 if not present
 
     Parameters
     ----------
     source : DatasetReader
         A raster data source
+    band : int, optional
+        The band to check, by default 1
 
     Returns
     -------
     numeric
         Based on whether a nodata values can be read from the source, return this value or 0 if not
     """
-    return source.nodatavals[0] if source.nodatavals[0] is not None else 0
+    nodata = source.nodatavals[band - 1]
+    return nodata if nodata is not None else 0
 
 
 def check_crs(source: DatasetReader, in_crs: str):
@@ -109,20 +197,22 @@ def check_crs(source: DatasetReader, in_crs: str):
     return source.crs if source.crs is not None else in_crs
 
 
-def infer_dtype(source: DatasetReader):
+def infer_dtype(source: DatasetReader, band: int = 1):
     """Simple function to avoid failures when data type is not recongnised, default assign float32()
 
     Parameters
     ----------
     source : DatasetReader
         A raster data source
+    band : int, optional
+        The band to infer the type of, by default 1
 
     Returns
     -------
     np.dtype
         A type for the data schema specification, default is float32()
     """
-    np_dtype = source.dtypes[0]
+    np_dtype = source.dtypes[band - 1]
     try:
         return from_numpy_dtype(dtype(np_dtype))  # the numpy function
     except:
@@ -179,174 +269,1295 @@ def rast_convert_core(src: DatasetReader, transform, win=None, band: int = 1):
     )
 
 
-#  checking inputs from the cl
-def check_out_crs(val):
-    """Check the requested out crs is valid
+def raster_schema(band_var_dtype=None):
+    """The schema of the tables produced from a raster, with float32 coordinates and a band value.
 
     Parameters
     ----------
-    val : str
-        A string representing a CRS, for example 'epsg:4326'
+    band_var_dtype : pyarrow.DataType, optional
+        The type of the band values, by default float32()
 
     Returns
     -------
-    rasterio.CRS
-        A CRS object
+    pyarrow.Schema
+        A schema with the 'lon', 'lat' and 'band_var' columns.
     """
-    try:
-        return CRS.from_string(val)
-    except:
-        return CRS.from_string("epsg:4326")
+    if band_var_dtype is None:
+        band_var_dtype = float32()
+
+    return schema(
+        [("lon", float32()), ("lat", float32()), ("band_var", band_var_dtype)]
+    ).with_metadata(
+        {
+            "lon": "Longitude coordinate",
+            "lat": "Latitude coordinate",
+            "band_var": "Value associated",
+        }
+    )
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(
-        prog="Rast Converter",
-        description="Convert rasters to parquet files efficiently",
-        epilog="",
+# key of the schema metadata recording the grid of the pixel ids of a grid index output
+grid_metadata_key = b"scalenav:grid"
+
+
+def grid_schema(rast_schema):
+    """The schema of a grid index output, with the 'lon' and 'lat' columns replaced by a 'pixel_id',
+    the row of the pixel times the width of the grid plus its column.
+
+    Parameters
+    ----------
+    rast_schema : pyarrow.Schema
+        A schema from `raster_schema` or `bands_schema`
+
+    Returns
+    -------
+    pyarrow.Schema
+        A schema with the 'pixel_id' and the value columns.
+    """
+    metadata = {
+        k: v for k, v in (rast_schema.metadata or {}).items() if k not in (b"lon", b"lat")
+    }
+    return schema(
+        [field("pixel_id", uint64())]
+        + [f for f in rast_schema if f.name not in ("lon", "lat")]
+    ).with_metadata(
+        metadata | {b"pixel_id": b"Row of the pixel times the width of the grid plus its column"}
     )
 
-    parser.add_argument(
-        "in_path",
-        nargs="?",
-        help="A path to a file or folder with rasters.",
-        type=str,
+
+# encodings of the band values, quantised in the workers: float16, or integers decoded as value * scale + offset
+encodings = {"float16": float16(), "uint16": uint16(), "int16": int16()}
+
+# key of the schema metadata recording the encoding of the value columns
+encoding_metadata_key = b"scalenav:encoding"
+
+
+def value_columns(rast_schema) -> list[str]:
+    """The names of the band value columns of a schema, 'band_var' or the 'band_<i>_var' of several bands."""
+    return [name for name in rast_schema.names if match(r"band(_\d+)?_var$", name)]
+
+
+def encoded_schema(rast_schema, encoding: str, scale: float = 1.0, offset: float = 0.0):
+    """The schema of an output with its band values encoded into a smaller type. The decoding parameters of each
+    value column are recorded in the schema metadata, so that `scalenav.oop.table` decodes them transparently.
+
+    Parameters
+    ----------
+    rast_schema : pyarrow.Schema
+        A schema from `raster_schema`, `bands_schema`, `time_schema` or `grid_schema`
+    encoding : str
+        One of the keys of `encodings`
+    scale : float, optional
+        The step between two integer codes, ignored for float16, by default 1.0
+    offset : float, optional
+        The value of the code 0, ignored for float16, by default 0.0
+
+    Returns
+    -------
+    pyarrow.Schema
+        The same schema with the value columns of the encoded type.
+    """
+    if encoding not in encodings:
+        raise ValueError(f"Unknown encoding '{encoding}', use one of {list(encodings)}")
+
+    if encoding == "float16":
+        scale, offset = 1.0, 0.0
+
+    columns = value_columns(rast_schema)
+    params = {
+        name: {
+            "type": encoding,
+            "scale": float(scale),
+            "offset": float(offset),
+            "source_type": dtype(rast_schema.field(name).type.to_pandas_dtype()).name,
+        }
+        for name in columns
+    }
+    return schema(
+        [field(f.name, encodings[encoding]) if f.name in params else f for f in rast_schema]
+    ).with_metadata((rast_schema.metadata or {}) | {encoding_metadata_key: dumps(params).encode()})
+
+
+def decoded_schema(rast_schema):
+    """The schema of an encoded output before the encoding, with the value columns of the types of the raster.
+
+    Parameters
+    ----------
+    rast_schema : pyarrow.Schema
+        A schema from `encoded_schema`
+
+    Returns
+    -------
+    pyarrow.Schema
+        The schema the band values are read into.
+    """
+    metadata = dict(rast_schema.metadata or {})
+    params = loads(metadata.pop(encoding_metadata_key))
+
+    return schema(
+        [
+            field(f.name, from_numpy_dtype(dtype(params[f.name]["source_type"]))) if f.name in params else f
+            for f in rast_schema
+        ]
+    ).with_metadata(metadata)
+
+
+def encode_batch(batch: RecordBatch, rast_schema) -> RecordBatch:
+    """Encode the band values of a record batch, rounding them to the nearest code and clipping them to the range of the codes.
+
+    Parameters
+    ----------
+    batch : pyarrow.RecordBatch
+        A batch of the `decoded_schema`
+    rast_schema : pyarrow.Schema
+        The schema from `encoded_schema`
+
+    Returns
+    -------
+    pyarrow.RecordBatch
+        The batch with the encoded value columns.
+    """
+    params = loads(rast_schema.metadata[encoding_metadata_key])
+    columns = []
+
+    for f in rast_schema:
+        column = batch.column(f.name)
+        if f.name in params:
+            values = column.to_numpy(zero_copy_only=False)
+            param = params[f.name]
+            if param["type"] == "float16":
+                values = values.astype(param["type"])
+            else:
+                codes = iinfo(param["type"])
+                values = clip(
+                    rint((values - param["offset"]) / param["scale"]), codes.min, codes.max
+                ).astype(param["type"])
+            column = pa_array(values, type=f.type)
+        columns.append(column)
+
+    return RecordBatch.from_arrays(columns, schema=rast_schema)
+
+
+def class_schema(rast_schema):
+    """The schema of the pixels of a categorical raster, with the 'band_var' column renamed 'band_class'
+    so that its codes are not mistaken for additive values by `scalenav.oop.change_res`.
+
+    Parameters
+    ----------
+    rast_schema : pyarrow.Schema
+        A schema from `raster_schema` or `grid_schema`, with the native integer type of the raster
+
+    Returns
+    -------
+    pyarrow.Schema
+        The same schema with a 'band_class' column.
+    """
+    metadata = {k: v for k, v in (rast_schema.metadata or {}).items() if k != b"band_var"}
+    return schema(
+        [field("band_class", f.type) if f.name == "band_var" else f for f in rast_schema]
+    ).with_metadata(metadata | {b"band_class": b"Class of the pixel"})
+
+
+def h3_class_schema(class_type=None):
+    """The schema of the partial aggregates of a categorical raster: the number of pixels of each class in each H3 cell.
+
+    Parameters
+    ----------
+    class_type : pyarrow.DataType, optional
+        The native type of the classes, by default uint8()
+
+    Returns
+    -------
+    pyarrow.Schema
+        A schema with the 'h3_id', 'band_class' and 'pixel_count' columns.
+    """
+    if class_type is None:
+        class_type = from_numpy_dtype(dtype("uint8"))
+
+    return schema([("h3_id", uint64()), ("band_class", class_type), ("pixel_count", uint64())])
+
+
+def band_column(band: int) -> str:
+    """Name of the column holding the values of a band in multi band tables."""
+    return f"band_{band}_var"
+
+
+def bands_schema(source: DatasetReader, bands: list[int]):
+    """The schema of the wide tables produced from several bands of a raster,
+    with float32 coordinates and one column per band of the type inferred by `infer_dtype`.
+
+    Parameters
+    ----------
+    source : DatasetReader
+        A raster data source
+    bands : list[int]
+        The bands to read
+
+    Returns
+    -------
+    pyarrow.Schema
+        A schema with the 'lon', 'lat' and 'band_<i>_var' columns.
+    """
+    return schema(
+        [("lon", float32()), ("lat", float32())]
+        + [(band_column(band), infer_dtype(source, band=band)) for band in bands]
+    ).with_metadata(
+        {
+            "lon": "Longitude coordinate",
+            "lat": "Latitude coordinate",
+        }
+        | {band_column(band): f"Value associated in band {band}" for band in bands}
     )
 
-    parser.add_argument(
-        "--out_path",
-        "-o_p",
-        nargs="?",
-        default="rast_convert.parquet",
-        help="A '.parquet' file to save into. Will be created or overwriten on execution. Default: %(default)s",
-        type=str,
+
+def time_schema(band_var_dtype=None, time_dtype=None):
+    """The schema of the long tables produced from a time stack, a `raster_schema` with a row per pixel
+    and timestep and the 'time' of the band each row comes from.
+
+    Parameters
+    ----------
+    band_var_dtype : pyarrow.DataType, optional
+        The type of the band values, by default float32()
+    time_dtype : pyarrow.DataType, optional
+        The type of the times, see `band_times`, by default int64()
+
+    Returns
+    -------
+    pyarrow.Schema
+        A schema with the 'lon', 'lat', 'band_var' and 'time' columns.
+    """
+    if time_dtype is None:
+        time_dtype = from_numpy_dtype(dtype("int64"))
+
+    rast_schema = raster_schema(band_var_dtype)
+    return rast_schema.append(field("time", time_dtype)).with_metadata(
+        rast_schema.metadata | {b"time": b"Time of the band"}
     )
 
-    parser.add_argument(
-        "--in_crs",
-        "-i_c",
-        nargs="?",
-        default=None,
-        help="CRS of the input if it is not providee in the data. Default: %(default)s",
-        type=str,
+
+def band_times(source: DatasetReader, dim: str = "time"):
+    """The time of each band of a time stack, from the 'NETCDF_DIM_<dim>' tags GDAL gives the bands of a NetCDF file.
+    With CF units such as 'days since 2000-01-01', the times are datetimes, otherwise the raw coordinate values.
+    Without these tags the bands are numbered from 1.
+
+    Parameters
+    ----------
+    source : DatasetReader
+        A raster data source
+    dim : str, optional
+        The name of the time dimension, by default "time"
+
+    Returns
+    -------
+    np.ndarray
+        One datetime64[s], float or integer value per band.
+    """
+    values = [source.tags(band).get(f"NETCDF_DIM_{dim}") for band in source.indexes]
+
+    if any(value is None for value in values):
+        return array(source.indexes)
+
+    values = array(values, dtype=float64)
+    units = match(r"\s*(\w+) since (.+)", source.tags().get(f"{dim}#units", ""))
+
+    if units is None or units.group(1).lower() not in time_units:
+        return values
+
+    try:
+        origin = datetime64(units.group(2).strip().replace(" ", "T").rstrip("Z"), "s")
+    except ValueError:
+        return values
+
+    seconds = rint(values * time_units[units.group(1).lower()]).astype("timedelta64[s]")
+    return origin + seconds
+
+
+def pixel_centres(transform, rows, cols):
+    """Coordinates of pixel centres computed directly from the coefficients of an affine transform.
+    Equivalent to `rasterio.transform.xy` with the default 'center' offset, but vectorized over numpy arrays.
+
+    Parameters
+    ----------
+    transform : affine.Affine
+        The transform of the grid the rows and columns refer to.
+    rows : np.ndarray
+        Row indices of the pixels
+    cols : np.ndarray
+        Column indices of the pixels
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The x and y coordinates as float64 arrays.
+    """
+    cols_c = cols.astype(float64) + 0.5
+    rows_c = rows.astype(float64) + 0.5
+
+    xs = transform.a * cols_c + transform.b * rows_c + transform.c
+    ys = transform.d * cols_c + transform.e * rows_c + transform.f
+
+    return xs, ys
+
+
+def pixel_ids(rows, cols, win=None, width: int = 0):
+    """Pixel ids of rows and columns of a window in the grid of a raster, `row * width + col`.
+
+    Parameters
+    ----------
+    rows : np.ndarray
+        Row indices of the pixels in the window
+    cols : np.ndarray
+        Column indices of the pixels in the window
+    win : a rasterio window, optional
+        The window the rows and columns refer to, by default None for the whole raster
+    width : int
+        The number of columns of the raster
+
+    Returns
+    -------
+    np.ndarray
+        The uint64 pixel ids.
+    """
+    row_off, col_off = (0, 0) if win is None else (int(win.row_off), int(win.col_off))
+    return (rows.astype(np_uint64) + np_uint64(row_off)) * np_uint64(width) + (
+        cols.astype(np_uint64) + np_uint64(col_off)
     )
 
-    parser.add_argument(
-        "--out_crs",
-        "-o_c",
-        nargs="?",
-        default=None,
-        help="The crs for the output. Default: %(default)s",
-        type=str,
+
+# transformers of coordinates of each thread
+_transformers = local()
+
+
+def coords_transformer(src_crs, dst_crs) -> Transformer:
+    """Transformer of coordinates from one CRS to another, with x, y axis order. They are cached
+    per thread as creating them is slow and they are not meant to be shared between threads.
+
+    Parameters
+    ----------
+    src_crs : str | CRS
+        The CRS of the coordinates
+    dst_crs : str | CRS
+        The CRS to transform them into
+
+    Returns
+    -------
+    Transformer
+        The cached transformer.
+    """
+    cache = _transformers.__dict__.setdefault("cache", {})
+    key = (str(src_crs), str(dst_crs))
+
+    if key not in cache:
+        cache[key] = Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+    return cache[key]
+
+
+def coordinate_arrays(
+    rast_schema, transform, rows, cols, win=None, width: int = 0, transformer=None
+) -> list:
+    """The coordinate columns of the pixels kept: 'lon' and 'lat', or 'pixel_id' with a `grid_schema`.
+    With a `transformer`, the coordinates of the pixel centres are transformed in one vectorized call."""
+    if "pixel_id" in rast_schema.names:
+        return [pa_array(pixel_ids(rows, cols, win=win, width=width), type=uint64())]
+
+    xs, ys = pixel_centres(transform, rows, cols)
+
+    if transformer is not None and len(xs) > 0:
+        xs, ys = transformer.transform(xs, ys)
+
+    return [
+        pa_array(xs, type=rast_schema.field("lon").type),
+        pa_array(ys, type=rast_schema.field("lat").type),
+    ]
+
+
+def valid_mask(band_, nodata=None, include: bool = False):
+    """Boolean mask of the pixels worth keeping in a band array.
+
+    Parameters
+    ----------
+    band_ : np.ndarray
+        Values read from a raster
+    nodata : float | int, optional
+        No data value of the raster, NaN values are always masked, by default None
+    include : bool, optional
+        Whether to keep negative and 0 values, by default False
+
+    Returns
+    -------
+    np.ndarray
+        A boolean array of the shape of the input, True where the pixel is valid.
+    """
+    if band_.dtype.kind == "f":
+        mask = ~isnan(band_)
+    else:
+        mask = ones_like(band_, dtype=bool)
+
+    if nodata is not None and not isnan(nodata):
+        mask &= band_ != nodata
+
+    if not include:
+        mask &= band_ > 0
+
+    return mask
+
+
+def lap(metrics: dict | None, stage: str, start: float) -> float:
+    """Add the time elapsed since `start` to a stage of the metrics of a window, if any, and return the current time."""
+    now = perf_counter()
+    if metrics is not None:
+        metrics[stage] = metrics.get(stage, 0.0) + now - start
+    return now
+
+
+def aoi_mask(aoi, shape: tuple, transform):
+    """Boolean mask of the pixels whose centre is inside an area of interest.
+
+    Parameters
+    ----------
+    aoi : shapely geometry
+        The area of interest, in the CRS of the raster
+    shape : tuple
+        The number of rows and columns of the pixels
+    transform : affine.Affine
+        The transform of the pixels
+
+    Returns
+    -------
+    np.ndarray
+        A boolean array of the given shape, True inside the area.
+    """
+    return geometry_mask([aoi], out_shape=shape, transform=transform, invert=True)
+
+
+def read_window(
+    src: DatasetReader, transform, win=None, band: int | list[int] = 1, decimation: int = 1
+):
+    """Read the values of a window and resolve the transform of the pixels that were read.
+
+    Parameters
+    ----------
+    src : DatasetReader
+        Data read from a filestream
+    transform : a rasterio transform
+        The `window_transform` method of the source if a window is given, an affine transform otherwise.
+    win : a rasterio window, optional
+        default None
+    band : int | list[int], optional
+        A band, or a list of bands read in one call, by default 1
+    decimation : int, optional
+        If above 1, the window is read with pixels of this many pixels along a side, averaging
+        the valid ones, from the overviews of the raster when it has some, by default 1
+
+    Returns
+    -------
+    tuple[np.ndarray, affine.Affine]
+        The values, with a leading band dimension if a list of bands is given, and the transform of the window.
+    """
+    if decimation > 1:
+        height, width = (win.height, win.width) if win is not None else src.shape
+        shape = (-(-int(height) // decimation), -(-int(width) // decimation))
+        values = src.read(indexes=band, window=win, out_shape=shape, resampling=Resampling.average)
+        transform = transform(win) if win is not None else transform
+        return values, transform * Affine.scale(width / shape[1], height / shape[0])
+
+    if win is not None:
+        return src.read(indexes=band, window=win), transform(win)
+    return src.read(indexes=band), transform
+
+
+def rast_convert_arrow(
+    src: DatasetReader,
+    transform,
+    win=None,
+    band: int = 1,
+    nodata=None,
+    include: bool = False,
+    rast_schema=None,
+    aoi=None,
+    metrics: dict | None = None,
+    transformer=None,
+):
+    """Arrow native version of `rast_convert_core`. The nodata and non positive values are masked
+    before the coordinates are computed, so only the pixels that are kept are ever converted.
+    No pandas objects are created.
+
+    Parameters
+    ----------
+    src : DatasetReader
+        Data read from a filestream
+    transform : a rasterio transform
+        The `window_transform` method of the source if a window is given, an affine transform otherwise.
+    win : a rasterio window, optional
+        default None
+    band : int, optional
+        by default 1
+    nodata : float | int, optional
+        No data value of the raster, by default None
+    include : bool, optional
+        Whether to keep negative and 0 values, by default False
+    rast_schema : pyarrow.Schema, optional
+        The schema of the output, by default `raster_schema` with the dtype of the band.
+        With a `grid_schema`, the pixel ids are written instead of the coordinates.
+    aoi : shapely geometry, optional
+        If given, only the pixels with their centre inside this area are kept, by default None
+    metrics : dict | None, optional
+        If given, the seconds spent reading, filtering, computing the coordinates and converting to arrow
+        are added to its 'read', 'filter', 'coords' and 'convert' keys, and the pixels read to 'pixels', by default None
+    transformer : pyproj.Transformer, optional
+        If given, the coordinates of the pixel centres are transformed with it, so that the pixels of a raster
+        can be kept as they are instead of being warped into the output CRS, by default None
+
+    Returns
+    -------
+    pyarrow.RecordBatch
+        A record batch with the 'lon', 'lat' and 'band_var' columns for the valid pixels of the window.
+    """
+
+    start = perf_counter()
+    band_, transform = read_window(src, transform, win=win, band=band)
+    start = lap(metrics, "read", start)
+
+    if rast_schema is None:
+        rast_schema = raster_schema(infer_dtype(src))
+
+    mask = valid_mask(band_, nodata=nodata, include=include)
+
+    if aoi is not None:
+        mask &= aoi_mask(aoi, mask.shape, transform)
+
+    start = lap(metrics, "filter", start)
+
+    rows, cols = nonzero(mask)
+    coords = coordinate_arrays(
+        rast_schema, transform, rows, cols, win=win, width=src.width, transformer=transformer
     )
+    start = lap(metrics, "coords", start)
 
-    parser.add_argument(
-        "--include_negative",
-        "-i_n",
-        nargs="?",
-        default=False,
-        help="Whether the data to process includes relevant negative or 0 values. Can have a significant impact on running time and output size.",
-        type=bool,
+    # the codes of a categorical raster are in a 'band_class' column, see `class_schema`
+    value = "band_class" if "band_class" in rast_schema.names else "band_var"
+    out = RecordBatch.from_arrays(
+        coords + [pa_array(band_[mask], type=rast_schema.field(value).type)],
+        schema=rast_schema,
     )
+    lap(metrics, "convert", start)
+
+    if metrics is not None:
+        metrics["pixels"] = metrics.get("pixels", 0) + mask.size
+
+    return out
+
+
+def rast_convert_bands(
+    src: DatasetReader,
+    transform,
+    win=None,
+    bands: list[int] = [1],
+    nodata: list = [None],
+    include: bool = False,
+    nodata_mode: str = "any",
+    rast_schema=None,
+    aoi=None,
+    metrics: dict | None = None,
+    transformer=None,
+):
+    """Multi band version of `rast_convert_arrow`. All the bands of the window are read in one call
+    and written in one wide table with a column per band.
 
-    args = vars(parser.parse_args())
+    Parameters
+    ----------
+    src : DatasetReader
+        Data read from a filestream
+    transform : a rasterio transform
+        The `window_transform` method of the source if a window is given, an affine transform otherwise.
+    win : a rasterio window, optional
+        default None
+    bands : list[int], optional
+        The bands to read, by default [1]
+    nodata : list, optional
+        The no data value of each band, by default [None]
+    include : bool, optional
+        Whether to keep negative and 0 values, by default False
+    nodata_mode : str, optional
+        'any' drops the pixels where any band is invalid, 'all' only drops the pixels where all the bands are invalid
+        and keeps the invalid values of the other pixels as nulls, by default "any"
+    rast_schema : pyarrow.Schema, optional
+        The schema of the output, by default `bands_schema` of the source.
+        With a `grid_schema`, the pixel ids are written instead of the coordinates.
+    aoi : shapely geometry, optional
+        If given, only the pixels with their centre inside this area are kept, by default None
+    metrics : dict | None, optional
+        If given, the seconds spent in each step are added to it, see `rast_convert_arrow`, by default None
+    transformer : pyproj.Transformer, optional
+        If given, the coordinates of the pixel centres are transformed with it, see `rast_convert_arrow`, by default None
 
-    in_path = args["in_path"]
-    in_crs = args["in_crs"]
-    out_path = args["out_path"]
-    out_crs = args["out_crs"]  # epsg:4326 by default.
-    include = args["include_negative"]  # exclude non positive values by default
+    Returns
+    -------
+    pyarrow.RecordBatch
+        A record batch with the 'lon', 'lat' and 'band_<i>_var' columns for the valid pixels of the window.
+    """
 
-    if not search(pattern=r".parquet$", string=out_path):
-        raise ValueError("Provide a 'parquet' filename to write the outputs.")
+    start = perf_counter()
+    bands_, transform = read_window(src, transform, win=win, band=list(bands))
+    start = lap(metrics, "read", start)
+
+    if rast_schema is None:
+        rast_schema = bands_schema(src, bands)
+
+    masks = [
+        valid_mask(band_, nodata=nodata_, include=include)
+        for band_, nodata_ in zip(bands_, nodata)
+    ]
 
-    if out_crs is not None:
-        out_crs = check_out_crs(out_crs)
+    if nodata_mode == "any":
+        mask = logical_and.reduce(masks)
+    elif nodata_mode == "all":
+        mask = logical_or.reduce(masks)
     else:
-        out_crs = in_crs
+        raise ValueError("nodata_mode should be one of 'any' or 'all'.")
 
-    print("Output CRS : ", str(out_crs))
+    if aoi is not None:
+        mask &= aoi_mask(aoi, mask.shape, transform)
 
-    vrt_options = {
-        # 'resampling': Resampling.cubic,
-        "crs": out_crs,
-        # 'transform': dst_transform,
-        # 'height': dst_height,
-        # 'width': dst_width,
-    }
+    start = lap(metrics, "filter", start)
 
-    rast_schema = schema(
-        [("lon", float32()), ("lat", float32()), ("band_var", float32())]
+    rows, cols = nonzero(mask)
+    coords = coordinate_arrays(
+        rast_schema, transform, rows, cols, win=win, width=src.width, transformer=transformer
+    )
+    start = lap(metrics, "coords", start)
+
+    out = RecordBatch.from_arrays(
+        coords
+        + [
+            pa_array(
+                band_[mask],
+                type=rast_schema.field(band_column(band)).type,
+                mask=None if nodata_mode == "any" else ~band_mask[mask],
+            )
+            for band, band_, band_mask in zip(bands, bands_, masks)
+        ],
+        schema=rast_schema,
     )
+    lap(metrics, "convert", start)
 
-    rast_schema.with_metadata(
-        {
-            "lon": "Longitude coordinate",
-            "lat": "Latitude coordinate",
-            "band_var": "Value associated",
-        }
+    if metrics is not None:
+        metrics["pixels"] = metrics.get("pixels", 0) + mask.size
+
+    return out
+
+
+h3_partial_schema = schema(
+    [("h3_id", uint64()), ("band_var", pa_float64()), ("pixel_count", uint64())]
+)
+
+# the partial aggregates of pixels apportioned to the cells they overlap, counting fractions of pixels
+h3_area_partial_schema = schema(
+    [("h3_id", uint64()), ("band_var", pa_float64()), ("pixel_count", pa_float64())]
+)
+
+# boundaries of H3 cells kept by a worker, see `h3_hexagon`
+hexagon_cache_size = 65_536
+
+def rast_convert_time(
+    src: DatasetReader,
+    transform,
+    win=None,
+    bands: list[int] = [1],
+    times=None,
+    nodata=None,
+    include: bool = False,
+    rast_schema=None,
+    aoi=None,
+    metrics: dict | None = None,
+    transformer=None,
+):
+    """Time stack version of `rast_convert_arrow`, writing a row per valid pixel and timestep.
+    The bands of the window are read `time_chunk_bands` at a time and the coordinates of its pixels
+    are computed once for all the timesteps.
+
+    Parameters
+    ----------
+    src : DatasetReader
+        Data read from a filestream
+    transform : a rasterio transform
+        The `window_transform` method of the source if a window is given, an affine transform otherwise.
+    win : a rasterio window, optional
+        default None
+    bands : list[int], optional
+        The bands of the timesteps to read, by default [1]
+    times : np.ndarray, optional
+        The time of each band, see `band_times`, by default the band numbers
+    nodata : float | int, optional
+        No data value of the raster, by default None
+    include : bool, optional
+        Whether to keep negative and 0 values, by default False
+    rast_schema : pyarrow.Schema, optional
+        The schema of the output, by default a `time_schema`.
+        With a `grid_schema`, the pixel ids are written instead of the coordinates.
+    aoi : shapely geometry, optional
+        If given, only the pixels with their centre inside this area are kept, by default None
+    metrics : dict | None, optional
+        If given, the seconds spent in each step are added to it, see `rast_convert_arrow`, by default None
+    transformer : pyproj.Transformer, optional
+        If given, the coordinates of the pixel centres are transformed with it, see `rast_convert_arrow`, by default None
+
+    Returns
+    -------
+    pyarrow.RecordBatch
+        A record batch with the 'lon', 'lat', 'band_var' and 'time' columns of the valid pixels of the window.
+    """
+    if times is None:
+        times = array(bands)
+
+    if rast_schema is None:
+        rast_schema = time_schema(infer_dtype(src, band=bands[0]), from_numpy_dtype(times.dtype))
+
+    window_transform = transform(win) if win is not None else transform
+    height, width = (int(win.height), int(win.width)) if win is not None else src.shape
+    region = None if aoi is None else aoi_mask(aoi, (height, width), window_transform)
+
+    coords = None
+    pixels, values, counts = [], [], []
+
+    for first in range(0, len(bands), time_chunk_bands):
+        start = perf_counter()
+        chunk = list(bands[first : first + time_chunk_bands])
+        bands_, _ = read_window(src, transform, win=win, band=chunk)
+        start = lap(metrics, "read", start)
+
+        for band_ in bands_:
+            mask = valid_mask(band_, nodata=nodata, include=include)
+            if region is not None:
+                mask &= region
+            flat = flatnonzero(mask)
+            pixels.append(flat)
+            values.append(band_.ravel()[flat])
+            counts.append(len(flat))
+
+        start = lap(metrics, "filter", start)
+
+        if coords is None and sum(counts) > 0:
+            # the coordinates of every pixel of the window, shared by the timesteps
+            rows, cols = indices((height, width))
+            coords = [
+                column.to_numpy(zero_copy_only=False)
+                for column in coordinate_arrays(
+                    rast_schema,
+                    window_transform,
+                    rows.ravel(),
+                    cols.ravel(),
+                    win=win,
+                    width=src.width,
+                    transformer=transformer,
+                )
+            ]
+            lap(metrics, "coords", start)
+
+    start = perf_counter()
+    taken = concatenate(pixels) if len(pixels) > 0 else array([], dtype="int64")
+    if coords is None:
+        # 'lon' and 'lat' or 'pixel_id'
+        coord_columns = [array([]) for _ in range(len(rast_schema) - 2)]
+    else:
+        coord_columns = [column[taken] for column in coords]
+
+    out = RecordBatch.from_arrays(
+        [
+            pa_array(column, type=rast_schema.field(i).type)
+            for i, column in enumerate(coord_columns)
+        ]
+        + [
+            pa_array(
+                concatenate(values) if len(values) > 0 else array([]),
+                type=rast_schema.field("band_var").type,
+            ),
+            pa_array(repeat(times, counts), type=rast_schema.field("time").type),
+        ],
+        schema=rast_schema,
     )
+    lap(metrics, "convert", start)
 
-    if in_path[len(in_path) - 1] != "/":
-        in_path = in_path + "/"
+    if metrics is not None:
+        metrics["pixels"] = metrics.get("pixels", 0) + height * width * len(bands)
 
-    in_paths = [
-        str(x)
-        for x in glob(in_path + "**", recursive=True)
-        if search(pattern=r"(.ti[f]{1,2}$)|(.nc$)", string=x)
-    ]
+    return out
+
+
+_latlng_to_cell = frompyfunc(h3_int.latlng_to_cell, 3, 1)
+
+
+def h3_cells(lats, lons, res: int):
+    """H3 cells of arrays of coordinates, as integer ids.
+
+    Parameters
+    ----------
+    lats : np.ndarray
+        Latitudes in degrees
+    lons : np.ndarray
+        Longitudes in degrees
+    res : int
+        The H3 resolution
+
+    Returns
+    -------
+    np.ndarray
+        The uint64 cell ids, `h3_h3_to_string` gives the string representation in DuckDB.
+    """
+    if len(lats) == 0:
+        return array([], dtype=np_uint64)
+    return _latlng_to_cell(lats, lons, res).astype(np_uint64)
+
+
+_cell_to_parent = frompyfunc(h3_int.cell_to_parent, 2, 1)
+
+
+def h3_parents(cells, res: int):
+    """Parents of an array of integer H3 cell ids at a coarser resolution, as integer ids."""
+    if len(cells) == 0:
+        return array([], dtype=np_uint64)
+    return _cell_to_parent(cells.astype(object), res).astype(np_uint64)
+
+
+def h3_aggregate(cells, values, pixel_area: float = 1.0):
+    """Sum values and count pixels per H3 cell.
+
+    Parameters
+    ----------
+    cells : np.ndarray
+        uint64 cell ids
+    values : np.ndarray
+        Values associated to each cell id
+    pixel_area : float, optional
+        The number of pixels of the raster each value stands for, when it was read decimated, by default 1.0
+
+    Returns
+    -------
+    pyarrow.RecordBatch
+        A batch following `h3_partial_schema` with one row per distinct cell.
+    """
+    ids, inverse = unique(cells, return_inverse=True)
+    counts = bincount(inverse, minlength=len(ids))
+
+    if pixel_area != 1.0:
+        values = values * pixel_area
+        counts = rint(counts * pixel_area)
+
+    return RecordBatch.from_arrays(
+        [
+            pa_array(ids, type=uint64()),
+            pa_array(bincount(inverse, weights=values, minlength=len(ids))),
+            pa_array(counts.astype(np_uint64), type=uint64()),
+        ],
+        schema=h3_partial_schema,
+    )
+
+
+@lru_cache(maxsize=hexagon_cache_size)
+def h3_hexagon(cell: int):
+    """The (lng, lat) vertices of the boundary of an H3 cell. They are cached as the cells along the edges
+    of a window are shared with the neighbouring windows."""
+    return array([(lng, lat) for lat, lng in h3_int.cell_to_boundary(cell)])
+
+
+def local_longitudes(lons, lon0: float):
+    """Longitudes shifted by whole turns within 180 degrees of `lon0`, a frame continuous across the antimeridian around `lon0`."""
+    return lon0 + (lons - lon0 + 180) % 360 - 180
+
+
+def polygon_areas(xy, counts):
+    """The areas of a batch of polygons, padded to the same number of vertices.
+
+    Parameters
+    ----------
+    xy : np.ndarray
+        The (n, m, 2) vertices of the polygons, the ones after `counts` are ignored
+    counts : np.ndarray
+        The number of vertices of each polygon
+
+    Returns
+    -------
+    np.ndarray
+        The areas, positive whatever the orientation of the polygons.
+    """
+    m = xy.shape[1]
+    following = (arange(m)[None, :] + 1) % maximum(counts, 1)[:, None]
+    xs, ys = xy[..., 0], xy[..., 1]
+    terms = xs * take_along_axis(ys, following, 1) - take_along_axis(xs, following, 1) * ys
+    return np_abs(where(arange(m)[None, :] < counts[:, None], terms, 0.0).sum(1)) / 2
+
+
+def clipped_areas(xy, counts, quads):
+    """The areas of the intersections of pairs of polygons and convex quadrilaterals, clipping each polygon
+    by the 4 sides of its quadrilateral one after the other (Sutherland-Hodgman), for all the pairs at once.
+
+    Parameters
+    ----------
+    xy : np.ndarray
+        The (n, m, 2) vertices of the polygons, padded after `counts`
+    counts : np.ndarray
+        The number of vertices of each polygon
+    quads : np.ndarray
+        The (n, 4, 2) vertices of the convex quadrilaterals, in order
+
+    Returns
+    -------
+    np.ndarray
+        The areas of the intersections.
+    """
+    # the sides of clockwise quadrilaterals have their inside on the right
+    turn = quads[:, :, 0] * roll(quads[:, :, 1], -1, 1) - roll(quads[:, :, 0], -1, 1) * quads[:, :, 1]
+    orientation = sign(turn.sum(1))[:, None]
+
+    for k in range(4):
+        start, side = quads[:, k], quads[:, (k + 1) % 4] - quads[:, k]
+        m = xy.shape[1]
+        following = take_along_axis(xy, ((arange(m)[None, :] + 1) % maximum(counts, 1)[:, None])[..., None], 1)
+
+        def inside(points):
+            return orientation * (
+                side[:, 0:1] * (points[..., 1] - start[:, 1:2]) - side[:, 1:2] * (points[..., 0] - start[:, 0:1])
+            )
+
+        here, there = inside(xy), inside(following)
+        valid = arange(m)[None, :] < counts[:, None]
+        crossing = where(here == there, 0.0, here / where(here == there, 1.0, here - there))
+        # each vertex inside is kept, followed by the crossing of its side if the next vertex is on the other side
+        points = stack([xy, xy + crossing[..., None] * (following - xy)], axis=2).reshape(len(xy), 2 * m, 2)
+        kept = stack([(here >= 0) & valid, ((here >= 0) != (there >= 0)) & valid], axis=2).reshape(len(xy), 2 * m)
+
+        position = kept.cumsum(1) - 1
+        counts = position[:, -1] + 1
+        xy = zeros((len(xy), max(int(counts.max(initial=0)), 1), 2))
+        xy[nonzero(kept)[0], position[kept]] = points[kept]
+
+    return polygon_areas(xy, counts)
+
+
+def window_cells(bounds: tuple, h3_res: int):
+    """The H3 cells with their centre within two edge lengths of a box, which includes all the cells it overlaps.
+    The box can extend past the antimeridian, in a local longitude frame.
+
+    Parameters
+    ----------
+    bounds : tuple
+        (xmin, ymin, xmax, ymax) in degrees
+    h3_res : int
+        The H3 resolution
+
+    Returns
+    -------
+    np.ndarray
+        uint64 cell ids.
+    """
+    edge = 2 * h3_int.average_hexagon_edge_length(h3_res, unit="km") / 111.32
+    ymin, ymax = max(bounds[1] - edge, -90.0), min(bounds[3] + edge, 90.0)
+    lon_edge = edge / max(cos(radians(max(abs(ymin), abs(ymax)))), 1e-2)
+    xmin, xmax = bounds[0] - lon_edge, bounds[2] + lon_edge
+
+    if xmax - xmin >= 360:
+        xmin, xmax = -180.0, 180.0
+
+    # the parts of the box past the antimeridian are shifted back by a turn
+    boxes = [(max(xmin, -180.0), min(xmax, 180.0))]
+    if xmin < -180:
+        boxes.append((xmin + 360, 180.0))
+    if xmax > 180:
+        boxes.append((-180.0, xmax - 360))
+
+    cells = [h3_int.geo_to_cells(shapely.box(x0, ymin, x1, ymax), h3_res) for x0, x1 in boxes if x1 > x0]
+    return array([cell for part in cells for cell in part], dtype=np_uint64)
+
+
+def h3_area_weights(transform, shape: tuple, h3_res: int, src_crs: str | None = None):
+    """The fractions of the area of the pixels of a window overlapping each H3 cell, a sparse matrix from the pixels to the cells.
+    The fractions of each pixel sum to 1, so that apportioning values with them conserves their sum.
+    The pixels whose 4 corners are in the same cell are within it, only the other ones are intersected with the cells,
+    see `clipped_areas`, in a longitude frame local to the window so that the cells crossing the antimeridian are not split.
+
+    Parameters
+    ----------
+    transform : affine.Affine
+        The transform of the window
+    shape : tuple
+        The height and width of the window
+    h3_res : int
+        The H3 resolution
+    src_crs : str | None, optional
+        The CRS of the grid if it is not EPSG:4326, by default None
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+        For each pair of a pixel and a cell it overlaps, the flat index of the pixel in the window, the index of the cell
+        and the fraction of the pixel in the cell, and the uint64 ids of the cells.
+    """
+    height, width = shape
+    rows, cols = indices((height + 1, width + 1)).reshape(2, -1).astype(float64)
+    xs = transform.a * cols + transform.b * rows + transform.c
+    ys = transform.d * cols + transform.e * rows + transform.f
+
+    if src_crs is not None:
+        xs, ys = coords_transformer(src_crs, "EPSG:4326").transform(xs, ys)
+
+    lon0 = float(xs.mean())
+    xs = local_longitudes(xs, lon0).reshape(height + 1, width + 1)
+    ys = ys.reshape(height + 1, width + 1)
+
+    corners = h3_cells(ys.ravel(), xs.ravel(), h3_res).reshape(height + 1, width + 1)
+    top_left = corners[:-1, :-1]
+    inner = (top_left == corners[:-1, 1:]) & (top_left == corners[1:, :-1]) & (top_left == corners[1:, 1:])
+    inner_index = flatnonzero(inner)
+
+    # the pixels crossing the edges of the cells
+    edge_index = flatnonzero(~inner)
+    r, c = edge_index // width, edge_index % width
+    quads = stack(
+        [
+            stack([xs[r, c], xs[r, c + 1], xs[r + 1, c + 1], xs[r + 1, c]], axis=-1),
+            stack([ys[r, c], ys[r, c + 1], ys[r + 1, c + 1], ys[r + 1, c]], axis=-1),
+        ],
+        axis=-1,
+    )
+    candidates = unique(
+        concatenate([corners.ravel(), window_cells((xs.min(), ys.min(), xs.max(), ys.max()), h3_res)])
+    )
+
+    # the vertices of the cells, padded with their first one
+    boundaries = [h3_hexagon(int(cell)) for cell in candidates]
+    sizes = array([len(b) for b in boundaries], dtype=int)
+    offsets = concatenate([[0], sizes.cumsum()[:-1]]).astype(int)
+    vertices = concatenate(boundaries) if len(boundaries) > 0 else zeros((0, 2))
+    hexagons = repeat(vertices[offsets][:, None, :], sizes.max(initial=1), axis=1)
+    hexagons[repeat(arange(len(sizes)), sizes), arange(len(vertices)) - repeat(offsets, sizes)] = vertices
+    hexagons[..., 0] = local_longitudes(hexagons[..., 0], lon0)
+
+    # the pairs of pixels and cells with overlapping bounding boxes
+    tree = STRtree(
+        shapely.box(hexagons[..., 0].min(1), hexagons[..., 1].min(1), hexagons[..., 0].max(1), hexagons[..., 1].max(1))
+    )
+    pair_index, pair_cell = tree.query(
+        shapely.box(quads[..., 0].min(1), quads[..., 1].min(1), quads[..., 0].max(1), quads[..., 1].max(1))
+    )
+    overlaps = clipped_areas(hexagons[pair_cell], sizes[pair_cell], quads[pair_index])
+    keep = overlaps > 0
+    pair_index, pair_cell, overlaps = pair_index[keep], pair_cell[keep], overlaps[keep]
+    # normalised by the area covered rather than the area of the pixel, for the sums to be conserved exactly
+    covered = bincount(pair_index, weights=overlaps, minlength=len(edge_index))
+
+    cells, cell_index = unique(
+        concatenate([top_left.ravel()[inner_index], candidates[pair_cell]]), return_inverse=True
+    )
+    pixel_index = concatenate([inner_index, edge_index[pair_index]])
+    fractions = concatenate([ones_like(inner_index, dtype=float64), overlaps / covered[pair_index]])
+
+    return pixel_index.astype(int32), cell_index.astype(int32), fractions, cells
+
+
+def h3_area_aggregate(weights: tuple, values, mask, pixel_area: float = 1.0):
+    """Apportion the values of the valid pixels of a window to the H3 cells they overlap, and sum the values and fractions of pixels per cell.
+
+    Parameters
+    ----------
+    weights : tuple
+        The overlap weights of the window, see `h3_area_weights`
+    values : np.ndarray
+        The values of the pixels of the window
+    mask : np.ndarray
+        The valid pixels of the window
+    pixel_area : float, optional
+        The number of pixels of the raster each value stands for, when it was read decimated, by default 1.0
+
+    Returns
+    -------
+    pyarrow.RecordBatch
+        A batch following `h3_area_partial_schema` with one row per cell overlapped by a valid pixel.
+    """
+    pixel_index, cell_index, fractions, cells = weights
+    fractions = where(mask.ravel()[pixel_index], fractions * pixel_area, 0.0)
+    values = values.ravel()[pixel_index].astype(float64)
+
+    sums = bincount(cell_index, weights=where(fractions > 0, values * fractions, 0.0), minlength=len(cells))
+    counts = bincount(cell_index, weights=fractions, minlength=len(cells))
+    keep = counts > 0
+
+    return RecordBatch.from_arrays(
+        [
+            pa_array(cells[keep], type=uint64()),
+            pa_array(sums[keep]),
+            pa_array(counts[keep]),
+        ],
+        schema=h3_area_partial_schema,
+    )
 
-    print("Reading in from ", len(in_paths), " files.")
 
-    # in_paths = check_paths(in_path)
+def h3_class_aggregate(cells, classes, class_schema=None):
+    """Count the pixels of each class per H3 cell.
 
-    if len(in_paths) == 0:
-        raise IOError("No input files recognised.")
+    Parameters
+    ----------
+    cells : np.ndarray
+        uint64 cell ids
+    classes : np.ndarray
+        The class of each pixel
+    class_schema : pyarrow.Schema, optional
+        The schema of the output, by default `h3_class_schema` of the type of the classes
 
-    # add clock using https://tqdm.github.io/docs/tqdm/
+    Returns
+    -------
+    pyarrow.RecordBatch
+        A batch following `class_schema` with one row per distinct cell and class.
+    """
+    if class_schema is None:
+        class_schema = h3_class_schema(from_numpy_dtype(classes.dtype))
 
-    with ParquetWriter(out_path, rast_schema) as writer:
-        for path in in_paths:
-            with open(path) as src:
-                # check the source and get the needed info once for user down the road.
-                src_crs = check_crs(src, in_crs=in_crs)
-                print("Input CRS : ", src_crs)
+    if len(cells) == 0:
+        return RecordBatch.from_pylist([], schema=class_schema)
 
-                nodata = check_nodata(src)
-                print("No data value : ", nodata)
-                with WarpedVRT(src, **vrt_options) as vrt:
+    order = lexsort((classes, cells))
+    cells, classes = cells[order], classes[order]
+    starts = flatnonzero(
+        concatenate([[True], (cells[1:] != cells[:-1]) | (classes[1:] != classes[:-1])])
+    )
 
-                    # At this point 'vrt' is a full dataset with dimensions,
-                    # CRS, and spatial extent matching 'vrt_options'.
-                    # Process the dataset in chunks.  Likely not very efficient.
+    return RecordBatch.from_arrays(
+        [
+            pa_array(cells[starts], type=uint64()),
+            pa_array(classes[starts], type=class_schema.field("band_class").type),
+            pa_array(diff(append(starts, len(cells))).astype(np_uint64), type=uint64()),
+        ],
+        schema=class_schema,
+    )
 
-                    win_transfrom = vrt.window_transform
 
-                    for _, window in tqdm(vrt.block_windows()):
+def rast_convert_h3(
+    src: DatasetReader,
+    transform,
+    win=None,
+    band: int = 1,
+    nodata=None,
+    include: bool = False,
+    h3_res: int = 8,
+    aoi=None,
+    metrics: dict | None = None,
+    transformer=None,
+    decimation: int = 1,
+    class_schema=None,
+    area_weights: bool = False,
+):
+    """Aggregate the valid pixels of a raster window into the H3 cells containing their centres,
+    or apportion them to the cells they overlap.
 
-                        out = rast_convert_core(
-                            src=vrt,
-                            transform=win_transfrom,
-                            win=window,
-                            # nodata=nodata,include=include
-                        )
+    Parameters
+    ----------
+    src : DatasetReader
+        Data read from a filestream, in EPSG:4326 unless a `transformer` is given
+    transform : a rasterio transform
+        The `window_transform` method of the source if a window is given, an affine transform otherwise.
+    win : a rasterio window, optional
+        default None
+    band : int, optional
+        by default 1
+    nodata : float | int, optional
+        No data value of the raster, by default None
+    include : bool, optional
+        Whether to keep negative and 0 values, by default False
+    h3_res : int, optional
+        The H3 resolution, by default 8
+    aoi : shapely geometry, optional
+        If given, only the pixels with their centre inside this area are kept, by default None
+    metrics : dict | None, optional
+        If given, the seconds spent in each step are added to it, see `rast_convert_arrow`,
+        with the H3 indexing and aggregation under 'convert', by default None
+    transformer : pyproj.Transformer, optional
+        If given, the coordinates of the pixel centres are transformed into EPSG:4326 with it, by default None
+    decimation : int, optional
+        If above 1, the window is read decimated, see `read_window`, and the sums and pixel counts
+        are scaled by the number of pixels each decimated pixel stands for, by default 1
+    class_schema : pyarrow.Schema, optional
+        If given, the values are the classes of a categorical raster and the pixels of each class are counted
+        per cell following this `h3_class_schema`, see `h3_class_aggregate`, by default None
+    area_weights : bool, optional
+        Whether to apportion the value of each pixel to the cells it overlaps in proportion to the area of the overlaps,
+        see `h3_area_weights`, rather than assign it to the cell of its centre, by default False
+
+    Returns
+    -------
+    pyarrow.RecordBatch
+        Partial aggregates following `h3_partial_schema`: the sum of values and number of pixels per cell,
+        or `h3_area_partial_schema` with area weights.
+    """
+    start = perf_counter()
+    full_transform = transform(win) if win is not None else transform
+    band_, transform = read_window(src, transform, win=win, band=band, decimation=decimation)
+    start = lap(metrics, "read", start)
+
+    mask = valid_mask(band_, nodata=nodata, include=include)
+
+    if aoi is not None:
+        mask &= aoi_mask(aoi, mask.shape, transform)
+
+    start = lap(metrics, "filter", start)
+
+    pixel_area = abs(transform.determinant / full_transform.determinant)
+
+    if area_weights:
+        if not mask.any():
+            return RecordBatch.from_pylist([], schema=h3_area_partial_schema)
+        src_crs = str(transformer.source_crs) if transformer is not None else None
+        weights = h3_area_weights(transform, mask.shape, h3_res, src_crs)
+        start = lap(metrics, "coords", start)
+        out = h3_area_aggregate(weights, band_, mask, pixel_area)
+    else:
+        rows, cols = nonzero(mask)
+        xs, ys = pixel_centres(transform, rows, cols)
 
-                        out.drop(
-                            index=out.loc[out.band_var == nodata].index, inplace=True
-                        )
-                        out.dropna(inplace=True)
+        if transformer is not None and len(xs) > 0:
+            xs, ys = transformer.transform(xs, ys)
 
-                        if not include:
-                            out.drop(
-                                index=out.loc[out.band_var <= 0].index, inplace=True
-                            )
+        start = lap(metrics, "coords", start)
 
-                        if out.shape[0] != 0:
-                            writer.write_table(
-                                Table.from_pandas(
-                                    df=out,
-                                    schema=rast_schema,
-                                    preserve_index=False,
-                                    safe=True,
-                                )
-                            )
+        if class_schema is not None:
+            out = h3_class_aggregate(h3_cells(ys, xs, h3_res), band_[mask], class_schema)
+        else:
+            out = h3_aggregate(h3_cells(ys, xs, h3_res), band_[mask].astype(float64), pixel_area)
+    lap(metrics, "convert", start)
+
+    if metrics is not None:
+        metrics["pixels"] = metrics.get("pixels", 0) + mask.size
+
+    return out
+
+
+#  checking inputs from the cl
+def check_out_crs(val):
+    """Check the requested out crs is valid
+
+    Parameters
+    ----------
+    val : str
+        A string representing a CRS, for example 'epsg:4326'
+
+    Returns
+    -------
+    rasterio.CRS
+        A CRS object
+    """
+    try:
+        return CRS.from_string(val)
+    except:
+        return CRS.from_string("epsg:4326")
+
+
+if __name__ == "__main__":
+    # The serial command line tool has been retired in favour of `rastapar`,
+    # which reads files, folders and glob patterns in parallel.
+    import warnings
+    from scalenav.rast_convert_par import rast_converter
+
+    warnings.warn(
+        "Running scalenav.rast_converter is deprecated, use the 'rastapar' command instead.",
+        DeprecationWarning,
+    )
+    rast_converter()
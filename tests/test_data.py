@@ -1 +1,37 @@
-# test the data ingestion
\ No newline at end of file
+# test the data ingestion
+import h3
+
+import pytest
+import numpy as np
+
+from scalenav.data import rast_to_h3, square_cover, centre_cell_to_square
+
+from tests.test_utils import *
+
+
+def test_square_cover():
+    """The batch covers are the ones of `centre_cell_to_square` and the values of the pixels are split between their cells."""
+    cover = rast_to_h3["1000"]
+    cells = [h3.latlng_to_cell(lat, lng, cover["h3_res"]) for (lng, lat) in zip(x, y)]
+    values = np.array(band_var)
+
+    index, covers, shares = square_cover([h3.str_to_int(cell) for cell in cells], cover["nn"], values)
+
+    for k, cell in enumerate(cells):
+        assert [h3.int_to_str(int(c)) for c in covers[index == k]] == centre_cell_to_square(cell, cover["nn"])
+
+    assert len(covers) == len(cells) * len(cover["nn"])
+    assert shares.sum() == pytest.approx(values.sum())
+
+
+def test_square_cover_pentagon():
+    """Near a pentagon the offsets that can not be resolved are dropped and the values are split between the other cells."""
+    cover = rast_to_h3["10"]
+    cells = [h3.str_to_int(cell) for cell in h3.grid_disk(h3.get_pentagons(cover["h3_res"])[0], 1)]
+    values = np.arange(1, len(cells) + 1, dtype=float)
+
+    index, covers, shares = square_cover(cells, cover["nn"], values)
+
+    assert len(covers) < len(cells) * len(cover["nn"])
+    assert shares.sum() == pytest.approx(values.sum())
+    assert np.allclose(shares * np.bincount(index)[index], values[index])
@@ -12,6 +12,7 @@ import pandas as pd
 
 import scalenav.oop as snoo
 import scalenav.scale_nav as sn
+from scalenav.data import rast_to_h3, square_cover
 
 from tests.test_utils import *
 from tests.test_rast_converter import rast_ingest
@@ -96,6 +97,37 @@ def test_add_centr(table1_h3):
     assert table1_centr.execute().shape[0] == table1_h3.count().execute()
 
 
+def test_square_cover(table1_h3):
+    """The covers computed in DuckDB match the batch ones and keep the totals."""
+    cover = rast_to_h3["5000"]
+    assert cover["h3_res"] == h3_res
+
+    spread = snoo.square_cover(table1_h3, cover["nn"]).execute().set_index("h3_id").band_var
+
+    cells = [h3.str_to_int(cell) for cell in table1_h3.h3_id.execute()]
+    _, covers, shares = square_cover(cells, cover["nn"], table1_h3.band_var.execute().to_numpy())
+    bench = pd.Series(shares, index=[h3.int_to_str(int(cell)) for cell in covers]).groupby(level=0).sum()
+
+    assert spread.sum() == pytest.approx(np.sum(band_var))
+    assert np.allclose(spread.sort_index(), bench.sort_index())
+
+
+def test_square_cover_pentagon(conn):
+    """Around a pentagon, the shares of the pixels are computed over the same resolved cells as the batch ones."""
+    cover = rast_to_h3["10"]
+    cells = h3.grid_disk(h3.get_pentagons(cover["h3_res"])[0], 1)
+    values = np.arange(1, len(cells) + 1, dtype=float)
+
+    pixels = conn.create_table("pentagon", obj=pd.DataFrame({"h3_id": cells, "band_var": values}))
+    spread = snoo.square_cover(pixels, cover["nn"]).execute().set_index("h3_id").band_var
+
+    _, covers, shares = square_cover([h3.str_to_int(cell) for cell in cells], cover["nn"], values)
+    bench = pd.Series(shares, index=[h3.int_to_str(int(cell)) for cell in covers]).groupby(level=0).sum()
+
+    assert spread.sum() == pytest.approx(values.sum())
+    assert np.allclose(spread.sort_index(), bench.sort_index())
+
+
 def test_reindex():
     assert True
     # pass
@@ -3,21 +3,61 @@
 import pytest
 import numpy as np
 
+import h3
+import duckdb
 import rasterio
+import rasterio.shutil
 from rasterio import open
 from rasterio.transform import from_origin
 from rasterio.crs import CRS
+from rasterio.enums import Resampling
 
 from pandas import DataFrame
+from geopandas import GeoDataFrame
+import shapely
+from pyproj import Transformer
+from pyarrow import concat_tables
+import pyarrow.compute as pc
+from pyarrow.parquet import ParquetFile, read_table
 
-from scalenav.rast_convert_par import process
+import scalenav.oop as snoo
+from scalenav.rast_convert_par import (
+    process,
+    merge_h3_parts,
+    partition_dir,
+    partition_keys,
+    rast_converter,
+    plan_sources,
+    rast_to_arrow,
+    rast_to_duckdb,
+    consolidate,
+    morton_keys,
+    pyramid_decimation,
+    plan_windows,
+    schedule,
+    source_names,
+    window_weights,
+)
 from scalenav.rast_converter import (
+    band_times,
+    h3_area_weights,
+    local_longitudes,
     rast_convert_core,
+    rast_convert_arrow,
+    rast_convert_bands,
+    h3_cells,
     check_nodata,
     check_crs,
     check_path,
+    check_paths,
 )
 
+import builtins
+import shutil
+from glob import glob
+import importlib.util
+import json
+
 # Directory to save rasters
 output_dir = "data"
 
@@ -160,3 +200,964 @@ def test_output_dim():
 #     What to do if crs not found ? Have parameter set to None by default.
 #     """
 #     pass
+
+
+def test_arrow_kernel():
+    """The arrow kernel matches the data frame path once nodata is dropped."""
+    for filename in filenames:
+        with open(filename) as src:
+            nodata = check_nodata(src)
+
+            out_df = rast_convert_core(src, transform=src.transform)
+            out_df = out_df.loc[out_df.band_var != nodata].dropna()
+            out_df = out_df.loc[out_df.band_var > 0]
+
+            out = rast_convert_arrow(src, transform=src.transform, nodata=nodata)
+
+            assert out.num_rows == out_df.shape[0] == 32 * 32 - 1
+            assert out.schema.names == ["lon", "lat", "band_var"]
+            assert np.allclose(out["lon"].to_numpy(), out_df.lon, atol=1e-4)
+            assert np.allclose(out["lat"].to_numpy(), out_df.lat, atol=1e-4)
+            assert np.all(out["band_var"].to_numpy() == out_df.band_var)
+
+
+def test_arrow_kernel_window():
+    """Reading by window gives the same pixels as reading the whole raster."""
+    with open(filenames[0]) as src:
+        nodata = check_nodata(src)
+        full = rast_convert_arrow(src, transform=src.transform, nodata=nodata)
+
+        rows = 0
+        for _, window in src.block_windows():
+            out = rast_convert_arrow(
+                src, transform=src.window_transform, win=window, nodata=nodata
+            )
+            rows += out.num_rows
+
+        assert rows == full.num_rows
+
+
+def test_h3_cells():
+    lats = np.array([51.5, -33.9, 0.0])
+    lons = np.array([-0.12, 18.4, 0.0])
+
+    cells = h3_cells(lats, lons, 8)
+
+    assert cells.dtype == np.uint64
+    assert [h3.int_to_str(int(c)) for c in cells] == [
+        h3.latlng_to_cell(lat, lng, 8) for lat, lng in zip(lats, lons)
+    ]
+
+
+def test_h3_process(tmp_path):
+    """Aggregating in the workers gives the same totals as projecting the pixels."""
+    with open(filenames[1]) as src:
+        nodata = check_nodata(src)
+        pixels = rast_convert_arrow(src, transform=src.transform, nodata=nodata)
+        windows = [window for _, window in src.block_windows()]
+
+    h3_res = 7
+    bench = (
+        DataFrame(
+            {
+                "h3_id": h3_cells(
+                    pixels["lat"].to_numpy().astype(float),
+                    pixels["lon"].to_numpy().astype(float),
+                    h3_res,
+                ),
+                "band_var": pixels["band_var"].to_numpy(),
+            }
+        )
+        .groupby("h3_id")
+        .band_var.sum()
+    )
+
+    parts = [str(tmp_path / f"part_{i}.parquet") for i in range(2)]
+    for part, wins in zip(parts, [windows, []]):
+        process(
+            out_file=part,
+            src_file=filenames[1],
+            windows=wins,
+            rast_schema=None,
+            vrt_options={"crs": "epsg:4326"},
+            nodata=nodata,
+            h3_res=h3_res,
+        )
+
+    out_file = str(tmp_path / "h3.parquet")
+    n_cells = merge_h3_parts(parts, out_file, h3_agg="sum")
+
+    out = read_table(out_file).to_pandas().set_index("h3_id").band_var
+
+    assert n_cells == bench.shape[0]
+    assert np.allclose(out.loc[bench.index], bench)
+    assert not os.path.exists(parts[0])
+
+
+def test_schedule():
+    windows = list(range(10))
+    weights = np.array([0, 0, 0, 0, 5, 5, 5, 5, 1, 1])
+
+    chunks = schedule(windows, weights, size=4)
+
+    assert chunks == [(4, 5, 6, 7), (8, 9), (0, 1, 2, 3)]
+
+
+def test_window_weights():
+    with open(filenames[0]) as src:
+        windows = [window for _, window in src.block_windows()]
+
+        areas = window_weights(src, windows, estimate=False)
+        weights = window_weights(src, windows)
+
+    assert np.all(areas == 16 * 16)
+    assert np.all(weights <= areas)
+    assert np.isclose(weights.sum(), 32 * 32 - 1, atol=2)
+
+
+def test_rast_converter(tmp_path):
+    """Workers taking windows from the shared queue write all the valid pixels."""
+    out_path = str(tmp_path / "out")
+
+    rast_converter(
+        [filenames[1], "--out_path", out_path, "--workers", "3", "--chunk_size", "1"]
+        + ["--engine", "processes"]
+    )
+
+    out_files = os.listdir(out_path)
+    rows = sum(read_table(os.path.join(out_path, f)).num_rows for f in out_files)
+
+    assert len(out_files) == 3
+    assert rows == 32 * 32 - 1
+
+
+@pytest.fixture
+def multiband_file(tmp_path):
+    filename = str(tmp_path / "multiband.tif")
+    data = np.random.randint(1, 100, (3, 32, 32)).astype("uint8")
+    data[0, 0, 0] = 255
+    data[:, 1, 1] = 255
+    data[2, 2, 2] = 0
+
+    with rasterio.open(
+        filename,
+        "w",
+        driver="GTiff",
+        height=32,
+        width=32,
+        count=3,
+        dtype=data.dtype,
+        crs="epsg:4326",
+        transform=transforms[0],
+        nodata=255,
+        tiled=True,
+        blockxsize=16,
+        blockysize=16,
+    ) as dst:
+        dst.write(data)
+
+    return filename
+
+
+def test_bands_kernel(multiband_file):
+    with open(multiband_file) as src:
+        nodata = [check_nodata(src, band=b) for b in src.indexes]
+
+        out_any = rast_convert_bands(
+            src, transform=src.transform, bands=[1, 2, 3], nodata=nodata
+        )
+        out_all = rast_convert_bands(
+            src,
+            transform=src.transform,
+            bands=[1, 2, 3],
+            nodata=nodata,
+            nodata_mode="all",
+        )
+        single = rast_convert_arrow(src, transform=src.transform, band=2, nodata=255)
+
+    assert out_any.schema.names == ["lon", "lat", "band_1_var", "band_2_var", "band_3_var"]
+    assert out_any.schema.field("band_1_var").type == "uint8"
+    assert out_any.num_rows == 32 * 32 - 3
+    assert out_any["band_1_var"].null_count == 0
+
+    assert out_all.num_rows == 32 * 32 - 1
+    assert out_all["band_1_var"].null_count == 1
+    assert out_all["band_3_var"].null_count == 1
+    assert np.all(
+        out_all["band_2_var"].drop_null().to_numpy() == single["band_var"].to_numpy()
+    )
+
+
+def test_rast_converter_bands(tmp_path, multiband_file):
+    out_path = str(tmp_path / "out")
+
+    rast_converter([multiband_file, "--out_path", out_path, "--all_bands", "-w", "2"])
+
+    out = [read_table(os.path.join(out_path, f)) for f in os.listdir(out_path)]
+
+    assert all("_bands_" in f for f in os.listdir(out_path))
+    assert sum(t.num_rows for t in out) == 32 * 32 - 3
+    assert out[0].schema.names[2:] == ["band_1_var", "band_2_var", "band_3_var"]
+
+
+def test_paths():
+    in_paths = check_paths(["./data/raster_1.tif", "./data/test_data_*.tif", "./data"])
+
+    assert len(in_paths) == len(set(in_paths)) == 9
+    assert check_paths("./data/test_data_*.tif") == [
+        f"./data/test_data_{i}.tif" for i in range(3)
+    ]
+
+
+def test_rast_converter_files(tmp_path):
+    """Windows from several files are processed in one pool and keep their provenance."""
+    out_path = str(tmp_path / "out")
+
+    rast_converter([filenames[0], "data/raster_[2-3].tif", "-o_p", out_path, "-w", "2"])
+
+    out = concat_tables(
+        [read_table(os.path.join(out_path, f)) for f in sorted(os.listdir(out_path))]
+    )
+    sources, counts = np.unique(out["source"].to_pylist(), return_counts=True)
+
+    assert all(f.startswith("rast_convert_") for f in os.listdir(out_path))
+    assert list(sources) == ["raster_1", "raster_2", "raster_3"]
+    assert list(counts) == [32 * 32 - 1] * 3
+
+
+def test_rast_to_arrow(multiband_file):
+    """The streamed batches match the files written by the CLI and can be queried by duckdb."""
+    reader = rast_to_arrow(multiband_file, bands=[1, 2, 3])
+    out = reader.read_all()
+
+    assert out.num_rows == 32 * 32 - 3
+    assert out.schema.names[2:] == ["band_1_var", "band_2_var", "band_3_var"]
+
+    parallel = rast_to_arrow(
+        [filenames[0], "data/raster_[2-3].tif"], workers=2, prefetch=1, chunk_size=1
+    )
+    conn = duckdb.connect()
+    conn.register("parallel", parallel)
+    counts = conn.execute(
+        "select source, count(*) from parallel group by source order by source"
+    ).fetchall()
+
+    assert counts == [(f"raster_{i}", 32 * 32 - 1) for i in range(1, 4)]
+
+
+def test_rast_to_duckdb(tmp_path):
+    """The pixels and their H3 aggregates are written straight into tables of a database."""
+    database = str(tmp_path / "rasters.duckdb")
+
+    rast_converter([filenames[0], "--duckdb", database, "-w", "2"])
+    rows = rast_to_duckdb(
+        filenames[0], database, "cells", h3_res=3, h3_agg="sum", workers=2, chunk_size=1
+    )
+
+    conn = duckdb.connect(database, read_only=True)
+    pixels = conn.execute("select count(*), sum(band_var) from raster_1").fetchone()
+    cells = conn.execute("select count(*), sum(band_var) from cells").fetchone()
+
+    assert pixels[0] == 32 * 32 - 1
+    assert cells[0] == rows
+    assert cells[1] == pytest.approx(pixels[1])
+    assert conn.execute("select min(len(h3_id)) from cells").fetchone()[0] == 15
+
+
+def test_rast_to_duckdb_bands(tmp_path, multiband_file):
+    """All the bands reach the table, and the options of the parquet writers are refused."""
+    database = str(tmp_path / "rasters.duckdb")
+
+    rast_converter([multiband_file, "--duckdb", database, "--table", "bands", "--all_bands", "-w", "2"])
+
+    conn = duckdb.connect(database)
+    names = [c[0] for c in conn.execute("describe bands").fetchall()]
+    assert {"band_1_var", "band_2_var", "band_3_var"} <= set(names)
+    assert conn.execute("select count(*) from bands").fetchone()[0] == 32 * 32 - 3
+    conn.close()
+
+    for flags in [["--profile", "fast-read"], ["--metrics"], ["--engine", "threads"]]:
+        with pytest.raises(SystemExit):
+            rast_converter([multiband_file, "--duckdb", database, "--all_bands"] + flags)
+
+
+def test_source_names(tmp_path):
+    """Files sharing a name in different folders are told apart by their folders."""
+    for folder in ["x", "y"]:
+        os.makedirs(tmp_path / "tiles" / folder)
+        rasterio.shutil.copy(filenames[0], str(tmp_path / "tiles" / folder / "a.tif"))
+
+    out = rast_to_arrow(str(tmp_path / "tiles" / "*" / "a.tif")).read_all()
+    assert sorted(set(out["source"].to_pylist())) == ["x/a", "y/a"]
+
+    assert source_names(["x/a.tif", "y/b.tif"]) == ["a", "b"]
+    with pytest.raises(ValueError):
+        source_names(["x/a.tif", "x/a.vrt"])
+
+
+def test_rast_to_duckdb_table_name(tmp_path):
+    """The default table name of a file is quoted, even when it is not a valid identifier."""
+    filename = str(tmp_path / "2020-pop.tif")
+    rasterio.shutil.copy(filenames[0], filename)
+    database = str(tmp_path / "rasters.duckdb")
+
+    rast_converter([filename, "--duckdb", database, "-w", "1"])
+    rast_to_duckdb(filename, database, 'my "data"')
+
+    conn = duckdb.connect(database, read_only=True)
+    assert conn.execute('select count(*) from "2020-pop"').fetchone()[0] == 32 * 32 - 1
+    assert conn.execute('select count(*) from "my ""data"""').fetchone()[0] == 32 * 32 - 1
+
+
+def test_consolidate(tmp_path):
+    """The fragments are merged into sorted files of even sizes, with several merge passes for many runs."""
+    in_path = str(tmp_path / "in")
+    out_path = str(tmp_path / "out")
+
+    rast_converter([filenames[0], filenames[1], "-o_p", in_path, "-w", "3", "--engine", "processes"])
+    # 69 runs of 30 rows, more than `consolidate_fan_in`
+    out_files = consolidate(in_path, out_path, file_mb=0.005, run_rows=30)
+
+    assert sorted(os.listdir(out_path)) == ["_metadata"] + sorted(map(os.path.basename, out_files))
+
+    rows = [ParquetFile(file).metadata.num_rows for file in out_files]
+    assert sum(rows) == 2 * (32 * 32 - 1)
+    assert max(rows) - min(rows) <= 1
+    assert ParquetFile(os.path.join(out_path, "_metadata")).metadata.num_rows == sum(rows)
+
+    out = concat_tables([read_table(file) for file in out_files])
+    lon, lat = out["lon"].to_numpy(), out["lat"].to_numpy()
+    keys = morton_keys(lon, lat, (lon.min(), lat.min(), lon.max(), lat.max()))
+    assert np.all(keys[1:] >= keys[:-1])
+    before = read_table(in_path).sort_by([("lat", "ascending"), ("lon", "ascending")])
+    assert out.sort_by([("lat", "ascending"), ("lon", "ascending")])["band_var"].equals(
+        before["band_var"]
+    )
+
+
+def test_consolidate_h3(tmp_path):
+    in_path = str(tmp_path / "in")
+    out_path = str(tmp_path / "out")
+
+    rast_converter([filenames[0], "-o_p", in_path, "-w", "2", "--h3_res", "5"])
+    rast_converter(["consolidate", in_path, "-o_p", out_path])
+
+    out = read_table(os.path.join(out_path, "part-0.parquet"))
+    assert out["h3_id"].to_numpy().tolist() == sorted(out["h3_id"].to_numpy().tolist())
+    sorting = ParquetFile(os.path.join(out_path, "part-0.parquet")).metadata.row_group(0).sorting_columns
+    assert sorting[0].column_index == out.schema.get_field_index("h3_id")
+
+
+def test_consolidate_inputs(tmp_path):
+    """An output folder containing inputs is refused, rather than having its inputs removed."""
+    in_path = str(tmp_path / "in")
+    out_path = str(tmp_path / "out")
+
+    rast_converter([filenames[0], "-o_p", in_path, "-w", "2"])
+    before = sorted(os.listdir(in_path))
+
+    with pytest.raises(ValueError):
+        consolidate(in_path, in_path)
+    assert sorted(os.listdir(in_path)) == before
+
+    consolidate(in_path, out_path)
+    with pytest.raises(ValueError):
+        consolidate(out_path, out_path)
+    assert read_table(out_path).num_rows == 32 * 32 - 1
+
+    # the rasters are not removed with the fragments of a checkpointed run
+    raster = str(tmp_path / "in" / "tile_c0.tif")
+    rasterio.shutil.copy(filenames[0], raster)
+    with pytest.raises(ValueError):
+        rast_converter([raster, "-o_p", in_path, "--checkpoint"])
+    assert os.path.exists(raster)
+
+
+def test_partition_keys():
+    batch = rast_convert_arrow(
+        open(filenames[5]), transform=transforms[5], nodata=nodata_values[5]
+    )
+    partition = ("tile", 10.0)
+
+    keys = partition_keys(batch, partition)
+    dirs = {partition_dir(key, partition) for key in keys}
+
+    # 32 pixels of 1 degree from (-60,-15)
+    assert dirs == {
+        os.path.join(f"lon_tile={lon}", f"lat_tile={lat}")
+        for lon in range(-6, -2)
+        for lat in range(-5, -1)
+    }
+
+
+def test_partitioned_output(tmp_path):
+    out_path = str(tmp_path / "out")
+
+    rast_converter([filenames[5], "-o_p", out_path, "-w", "2", "--partition", "tile:10"])
+
+    conn = snoo.connect(preload_ext=False)
+    out = snoo.table(conn, "out", out_path)
+    out_bbox = snoo.table(conn, "out_bbox", out_path, bbox=[-45, -40, -35, -30])
+
+    assert out.count().execute() == 32 * 32 - 1
+    assert set(out.columns) >= {"lon", "lat", "band_var", "lon_tile", "lat_tile"}
+    assert out_bbox.count().execute() == 10 * 10
+    assert set(out_bbox.lon_tile.execute()) == {-5, -4}
+
+    for root, _, files in os.walk(out_path):
+        for f in files:
+            lat = read_table(os.path.join(root, f))["lat"].to_numpy()
+            assert np.all(np.diff(lat) >= 0)
+
+
+@pytest.fixture
+def large_file(tmp_path):
+    """A raster spanning several windows of the warped VRT."""
+    filename = str(tmp_path / "large.tif")
+    data = np.random.randint(0, 5, (1100, 1100)).astype("uint8")
+    create_raster(filename, data, 0, "epsg:4326", transforms[1], 256, 256)
+    return filename, int((data > 0).sum())
+
+
+def test_resume(tmp_path, large_file):
+    filename, valid = large_file
+    out_path = str(tmp_path / "out")
+    args = [filename, "-o_p", out_path, "-w", "2", "--chunk_size", "1"]
+
+    rast_converter(args + ["--checkpoint"])
+    name = os.path.basename(filename).split(".")[0]
+
+    def fragments():
+        return [f for f in os.listdir(out_path) if f.startswith(name) and f.endswith(".parquet")]
+
+    def rows():
+        return sum(read_table(os.path.join(out_path, f)).num_rows for f in fragments())
+
+    assert rows() == valid
+    n_fragments = len(fragments())
+    assert n_fragments > 1
+
+    # a crash after writing a fragment but before recording it, and while writing another
+    manifest = [f for f in os.listdir(out_path) if f.startswith("_manifest_")][0]
+    with builtins.open(os.path.join(out_path, manifest)) as f:
+        lines = f.readlines()
+    with builtins.open(os.path.join(out_path, manifest), "w") as f:
+        f.writelines(lines[:-1])
+    with builtins.open(os.path.join(out_path, f"{name}_1_c99.parquet.tmp"), "w") as f:
+        f.write("partial")
+    # the files of other inputs in the folder are not fragments of the run
+    with builtins.open(os.path.join(out_path, "other_c3.parquet"), "w") as f:
+        f.write("foreign")
+
+    rast_converter(args + ["--resume"])
+
+    assert rows() == valid
+    assert len(fragments()) == n_fragments
+    assert not any(f.endswith(".tmp") for f in os.listdir(out_path))
+    assert os.path.exists(os.path.join(out_path, "other_c3.parquet"))
+
+
+def test_resume_partition(tmp_path, large_file):
+    """The partial fragments of an unfinished chunk are removed from the partitions before resuming."""
+    filename, valid = large_file
+    out_path = str(tmp_path / "out")
+    args = [filename, "-o_p", out_path, "-w", "2", "--chunk_size", "1", "--partition", "tile:2"]
+
+    rast_converter(args + ["--checkpoint"])
+
+    def rows():
+        files = glob(os.path.join(out_path, "**", "*.parquet"), recursive=True)
+        return sum(ParquetFile(f).metadata.num_rows for f in files)
+
+    assert rows() == valid
+
+    # a crash after writing the fragments of a chunk but before recording it, with one more fragment
+    # than the chunk gets when it is written again, so that it is not overwritten
+    manifest = [f for f in os.listdir(out_path) if f.startswith("_manifest_")][0]
+    with builtins.open(os.path.join(out_path, manifest)) as f:
+        lines = f.readlines()
+    with builtins.open(os.path.join(out_path, manifest), "w") as f:
+        f.writelines(lines[:-1])
+    for fragment in json.loads(lines[-1])["fragments"]:
+        fragment = os.path.join(out_path, fragment)
+        shutil.copy(fragment, fragment.replace(".parquet", "9.parquet"))
+    assert rows() > valid
+
+    rast_converter(args + ["--resume"])
+
+    assert rows() == valid
+
+
+def test_writer_profiles(tmp_path, large_file):
+    """The windows are coalesced into large row groups, sorted with statistics in the 'fast-read' profile."""
+    filename, valid = large_file
+    fast_write = str(tmp_path / "fast_write")
+    fast_read = str(tmp_path / "fast_read")
+
+    rast_converter([filename, "-o_p", fast_write, "-w", "1"])
+    rast_converter(
+        [filename, "-o_p", fast_read, "-w", "1"]
+        + ["--profile", "fast-read", "--row_group_size", "100000"]
+    )
+
+    written = ParquetFile(os.path.join(fast_write, os.listdir(fast_write)[0]))
+    assert written.metadata.num_rows == valid
+    assert written.metadata.num_row_groups == 1
+    assert written.metadata.row_group(0).column(0).compression == "LZ4"
+
+    read = ParquetFile(os.path.join(fast_read, os.listdir(fast_read)[0]))
+    assert read.metadata.num_rows == valid
+    assert read.metadata.num_row_groups == -(-read.metadata.num_rows // 100_000)
+
+    lat = read.metadata.row_group(0).column(1)
+    assert lat.compression == "ZSTD" and lat.is_stats_set
+    assert read.metadata.row_group(0).sorting_columns[0].column_index == 1
+
+    first = read.read_row_group(0)["lat"].to_numpy()
+    assert (np.diff(first) >= 0).all()
+
+
+def test_engines(tmp_path, large_file):
+    """Threads share one writer, processes write one file each, with the same rows."""
+    filename, valid = large_file
+
+    def run(engine):
+        out_path = str(tmp_path / engine)
+        rast_converter(
+            [filename, "-o_p", out_path, "-w", "3", "--chunk_size", "1", "--engine", engine]
+        )
+        return [read_table(os.path.join(out_path, f)) for f in sorted(os.listdir(out_path))]
+
+    threads = run("threads")
+    processes = run("processes")
+
+    assert len(threads) == 1 and len(processes) == 3
+    assert threads[0].num_rows == sum(t.num_rows for t in processes) == valid
+    assert threads[0].sort_by([("lat", "ascending"), ("lon", "ascending")]).equals(
+        concat_tables(processes).sort_by([("lat", "ascending"), ("lon", "ascending")])
+    )
+
+
+def test_h3_pyramid(tmp_path):
+    """The coarse levels are read decimated, from the overviews when there are any, and keep the totals."""
+    filename = str(tmp_path / "coast.tif")
+    data = np.random.randint(1, 5, (1100, 1100)).astype("uint8")
+    # a sea of nodata, as the decimated pixels stand for the average of their valid pixels
+    data[:, :500] = 0
+    create_raster(filename, data, 0, "epsg:4326", transforms[1], 256, 256)
+    valid = int((data > 0).sum())
+    out_path = str(tmp_path / "pyramid")
+
+    rast_converter([filename, "-o_p", out_path, "-w", "2", "--h3_pyramid", "3", "6", "--h3_agg", "count"])
+
+    levels = duckdb.sql(
+        f"select h3_res, sum(band_var) from read_parquet('{out_path}/*/*.parquet', hive_partitioning=true) group by 1 order by 1"
+    ).fetchall()
+    assert [res for res, _ in levels] == [3, 6]
+    assert levels[1][1] == valid
+    assert levels[0][1] == pytest.approx(valid, rel=0.02)
+
+    source = plan_sources([filename], {"crs": CRS.from_epsg(4326)})["sources"][0]
+    assert pyramid_decimation(source, 6) == 1
+    assert pyramid_decimation(source, 3) == 13
+
+    with rasterio.open(filename, "r+") as dst:
+        dst.build_overviews([2, 4, 8], Resampling.average)
+    assert pyramid_decimation(source, 3) == 8
+
+
+@pytest.fixture
+def netcdf_file(tmp_path):
+    """A NetCDF file with a time dimension of 3 monthly steps, as GDAL writes them."""
+    data = np.random.randint(1, 100, (3, 40, 50)).astype("float32")
+    data[:, :10, :] = -1
+    data[1, 20, 20] = -1
+    tif = str(tmp_path / "stack.tif")
+    with rasterio.open(
+        tif, "w", driver="GTiff", height=40, width=50, count=3, dtype="float32",
+        crs="epsg:4326", transform=transforms[0], nodata=-1,
+    ) as dst:
+        dst.write(data)
+        dst.update_tags(
+            NETCDF_DIM_EXTRA="{time}",
+            NETCDF_DIM_time_DEF="{3,6}",
+            NETCDF_DIM_time_VALUES="{0,31,60}",
+            **{"time#units": "days since 2000-01-01"},
+        )
+        for b, day in zip(dst.indexes, [0, 31, 60]):
+            dst.update_tags(b, NETCDF_DIM_time=str(day))
+
+    filename = str(tmp_path / "stack.nc")
+    rasterio.shutil.copy(tif, filename, driver="netCDF")
+    return filename, data
+
+
+def test_time_stack(tmp_path, netcdf_file):
+    """The timesteps are rows of their own with their time, and only the ones in the range are read."""
+    filename, data = netcdf_file
+
+    with rasterio.open(filename) as src:
+        times = band_times(src)
+    assert times.tolist() == list(np.array(["2000-01-01", "2000-02-01", "2000-03-01"], dtype="datetime64[s]"))
+
+    out = rast_to_arrow(filename, time=True).read_all()
+    assert out.schema.names == ["lon", "lat", "band_var", "time"]
+    assert out.num_rows == int((data > 0).sum())
+
+    first = out.filter(pc.equal(out["time"], out["time"][0])).drop_columns("time")
+    single = rast_to_arrow(filename, band=1).read_all()
+    assert first.sort_by([("lat", "ascending"), ("lon", "ascending")]).equals(
+        single.sort_by([("lat", "ascending"), ("lon", "ascending")])
+    )
+
+    out_path = str(tmp_path / "out")
+    rast_converter([filename, "-o_p", out_path, "-w", "2", "--time-range", "2000-01-15", "2000-03-01"])
+    steps = duckdb.sql(
+        f"select time::date::varchar, count(*), sum(band_var) from '{out_path}/*.parquet' group by 1 order by 1"
+    ).fetchall()
+
+    assert steps == [
+        ("2000-02-01", int((data[1] > 0).sum()), pytest.approx(float(data[1][data[1] > 0].sum()))),
+        ("2000-03-01", int((data[2] > 0).sum()), pytest.approx(float(data[2][data[2] > 0].sum()))),
+    ]
+
+
+def test_h3_area_weights(tmp_path):
+    """The pixels apportioned to the cells they overlap keep their total, and the cells within the raster count their area in pixels."""
+    filename = str(tmp_path / "uniform.tif")
+    data = np.full((120, 160), 2.0, dtype="float32")
+    data[:, :20] = np.nan
+    create_raster(filename, data, np.nan, "epsg:4326", from_origin(5, 48, 0.05, 0.05), 64, 64)
+    valid = int((~np.isnan(data)).sum())
+
+    cells = {}
+    for h3_agg in ["sum", "mean", "count"]:
+        out_path = str(tmp_path / h3_agg)
+        rast_converter([filename, "-o_p", out_path, "-w", "2", "--h3_res", "5", "--h3_agg", h3_agg, "--h3_area_weights"])
+        cells[h3_agg] = read_table(os.path.join(out_path, "uniform_h3_5.parquet")).to_pandas().set_index("h3_id").band_var
+
+    assert cells["sum"].sum() == pytest.approx(2 * valid)
+    assert cells["count"].sum() == pytest.approx(valid)
+    assert np.allclose(cells["mean"], 2)
+
+    # the cells away from the edges of the valid pixels
+    inner = shapely.box(6.1, 42.1, 12.9, 47.9)
+    for cell, count in cells["count"].items():
+        hexagon = shapely.Polygon([(lng, lat) for lat, lng in h3.cell_to_boundary(h3.int_to_str(cell))])
+        if inner.contains(hexagon):
+            assert count == pytest.approx(hexagon.area / 0.05**2)
+
+
+@pytest.mark.parametrize("origin", [(179.5, 10), (-180, 70)])
+def test_h3_area_weights_antimeridian(origin):
+    """The overlap fractions of the windows at the antimeridian are the exact areas, in a longitude frame local to the window."""
+    transform = from_origin(*origin, 0.05, 0.05)
+    pixel_index, cell_index, fractions, cells = h3_area_weights(transform, (20, 20), 5)
+
+    assert np.allclose(np.bincount(pixel_index, weights=fractions), 1)
+
+    lon0 = origin[0] + 0.5
+    for k in np.flatnonzero(fractions < 1)[:200]:
+        row, col = divmod(int(pixel_index[k]), 20)
+        x0, y0 = origin[0] + 0.05 * col, origin[1] - 0.05 * row
+        pixel = shapely.box(x0, y0 - 0.05, x0 + 0.05, y0)
+        boundary = np.array([(lng, lat) for lat, lng in h3.cell_to_boundary(h3.int_to_str(int(cells[cell_index[k]])))])
+        boundary[:, 0] = local_longitudes(boundary[:, 0], lon0)
+        assert fractions[k] == pytest.approx(shapely.Polygon(boundary).intersection(pixel).area / pixel.area, abs=1e-6)
+
+
+def test_plan_windows(tmp_path):
+    """The rows of a striped raster are merged into larger windows and large tiles are split, aligned on the blocks."""
+    striped = str(tmp_path / "striped.tif")
+    data = np.random.randint(1, 5, (300, 1000)).astype("int16")
+    with rasterio.open(
+        striped, "w", driver="GTiff", height=300, width=1000, count=1, dtype="int16",
+        crs="epsg:4326", transform=transforms[1], nodata=0, tiled=False, blockysize=1,
+    ) as dst:
+        dst.write(data, 1)
+
+    with rasterio.open(striped) as src:
+        windows = plan_windows(src)
+        assert len(windows) == 5
+        assert all(w.row_off % 65 == 0 and w.width == 1000 for w in windows)
+        assert sum(w.height for w in windows) == 300
+
+    out = rast_to_arrow(striped, window_mb=0.5).read_all()
+    assert out.num_rows == data.size
+
+    filename = str(tmp_path / "tiled.tif")
+    create_raster(filename, data, 0, "epsg:4326", transforms[1], 256, 256)
+    with rasterio.open(filename) as src:
+        split = plan_windows(src, max_pixels=256 * 100)
+        assert max(w.width * w.height for w in split) <= 256 * 100
+        assert all(w.row_off % 256 in (0, 100, 200) for w in split)
+        assert sum(w.width * w.height for w in split) == data.size
+
+    assert rast_to_arrow(filename, max_window_mb=0.05).read_all().num_rows == data.size
+
+
+def test_categorical(tmp_path):
+    """The classes keep their native type and are counted per cell and class instead of summed."""
+    filename = str(tmp_path / "landcover.tif")
+    data = np.random.choice(np.array([0, 1, 2, 5], dtype="uint8"), (300, 300))
+    create_raster(filename, data, 0, "epsg:4326", transforms[1], 256, 256)
+    counts = {k: int((data == k).sum()) for k in [1, 2, 5]}
+
+    pixels_path = str(tmp_path / "pixels")
+    rast_converter([filename, "-o_p", pixels_path, "-w", "1", "--categorical"])
+    pixels = ParquetFile(os.path.join(pixels_path, "landcover_0.parquet"))
+    assert pixels.schema_arrow.field("band_class").type == "uint8"
+    assert "RLE_DICTIONARY" in pixels.metadata.row_group(0).column(2).encodings
+
+    results = {}
+    for agg in ["count", "fraction", "majority"]:
+        out_path = str(tmp_path / agg)
+        rast_converter(
+            [filename, "-o_p", out_path, "-w", "2", "--categorical", "--h3_res", "5", "--h3_agg", agg]
+        )
+        results[agg] = read_table(os.path.join(out_path, "landcover_h3_5.parquet")).sort_by("h3_id")
+
+    assert results["count"].schema.names == ["h3_id", "class_1_var", "class_2_var", "class_5_var"]
+    assert {k: pc.sum(results["count"][f"class_{k}_var"]).as_py() for k in counts} == counts
+
+    fractions = np.column_stack([results["fraction"][f"class_{k}_frac"].to_numpy() for k in counts])
+    assert np.allclose(fractions.sum(axis=1), 1)
+
+    wide = np.column_stack([results["count"][f"class_{k}_var"].to_numpy() for k in counts])
+    assert (results["majority"]["band_class"].to_numpy() == np.array([1, 2, 5])[wide.argmax(axis=1)]).all()
+
+
+def test_skip_empty(tmp_path):
+    """Windows without valid pixels in the overviews are left for the workers to check at full resolution."""
+    filename = str(tmp_path / "sparse.tif")
+    data = np.random.randint(1, 5, (1024, 1024)).astype("uint8")
+    data[:, :512] = 0
+    data[:256, 512:] = 0
+    data[300, 600] = 0
+    create_raster(filename, data, 0, "epsg:4326", transforms[1], 256, 256)
+    with rasterio.open(filename, "r+") as dst:
+        dst.build_overviews([2, 4], Resampling.nearest)
+
+    plan = plan_sources([filename], {"crs": CRS.from_epsg(4326)})
+
+    assert plan["classes"] == {"empty": 0, "mixed": 1, "full": 5, "unsure": 10}
+    assert len(plan["windows"]) == 16
+    assert len(plan["sources"][0]["unsure"]) == 10
+
+    out = rast_to_arrow(filename).read_all()
+    assert out.num_rows == int((data > 0).sum())
+
+
+def test_skip_empty_nearest_overviews(tmp_path):
+    """Isolated valid pixels missing from nearest overviews are still written."""
+    filename = str(tmp_path / "isolated.tif")
+    data = np.zeros((2048, 2048), dtype="float32")
+    rows, cols = np.random.default_rng(0).integers(0, 2048, (2, 300))
+    data[rows, cols] = 1
+    create_raster(filename, data, 0, "epsg:4326", transforms[1], 256, 256)
+    with rasterio.open(filename, "r+") as dst:
+        dst.build_overviews([2, 4, 8, 16], Resampling.nearest)
+    valid = int((data > 0).sum())
+
+    occupied = len({(r // 256, c // 256) for r, c in zip(rows, cols)})
+
+    # the windows empty in the overviews are left for the workers to check, none is read while planning
+    plan = plan_sources([filename], {"crs": CRS.from_epsg(4326)})
+    assert plan["classes"]["empty"] == 0
+    assert plan["classes"]["unsure"] >= 64 - occupied
+    assert len(plan["windows"]) == 64
+
+    out_path = str(tmp_path / "out")
+    rast_converter([filename, "-o_p", out_path, "-w", "2", "--metrics"])
+    files = [f for f in os.listdir(out_path) if f.endswith(".parquet")]
+    assert sum(ParquetFile(os.path.join(out_path, f)).metadata.num_rows for f in files) == valid
+
+    with builtins.open(os.path.join(out_path, "_metrics.jsonl")) as f:
+        records = [json.loads(line) for line in f]
+    # the empty windows are skipped by the workers before converting them
+    assert len([r for r in records if r["type"] == "window"]) == occupied
+    assert records[-1]["windows_unsure"] == plan["classes"]["unsure"]
+    assert records[-1]["plan_seconds"] > 0
+
+    no_skip_path = str(tmp_path / "no_skip")
+    rast_converter([filename, "-o_p", no_skip_path, "-w", "2", "--no_skip_empty"])
+    assert sum(ParquetFile(os.path.join(no_skip_path, f)).metadata.num_rows for f in os.listdir(no_skip_path)) == valid
+
+
+def test_area_of_interest(tmp_path):
+    """Only the windows intersecting the area are read, and only the pixels inside it are kept."""
+    filename = str(tmp_path / "large.tif")
+    data = np.random.randint(0, 5, (1100, 1100)).astype("uint8")
+    create_raster(filename, data, 0, "epsg:4326", transforms[1], 256, 256)
+
+    rows, cols = np.indices(data.shape)
+    lons, lats = -120 + 0.01 * (cols + 0.5), 35 - 0.01 * (rows + 0.5)
+
+    bbox = [-118, 30, -116.5, 33]
+    in_bbox = (lons > bbox[0]) & (lons < bbox[2]) & (lats > bbox[1]) & (lats < bbox[3])
+
+    out = rast_to_arrow(filename, bbox=bbox).read_all()
+    assert out.num_rows == int((in_bbox & (data > 0)).sum())
+
+    triangle = shapely.Polygon([(-119, 25), (-111, 25), (-115, 34)])
+    aoi = str(tmp_path / "aoi.geojson")
+    GeoDataFrame(geometry=[triangle], crs="epsg:4326").to_file(aoi)
+
+    out_path = str(tmp_path / "out")
+    rast_converter([filename, "-o_p", out_path, "--aoi", aoi, "--bbox", *map(str, bbox)])
+    out = concat_tables([read_table(os.path.join(out_path, f)) for f in os.listdir(out_path)])
+
+    in_aoi = shapely.contains_xy(triangle, lons, lats) & in_bbox
+    assert out.num_rows == int((in_aoi & (data > 0)).sum())
+
+
+def test_metrics(tmp_path, large_file):
+    """Every window and worker is recorded in the metrics file."""
+    filename, valid = large_file
+    out_path = str(tmp_path / "out")
+
+    rast_converter([filename, "-o_p", out_path, "-w", "2", "--engine", "processes", "--metrics"])
+
+    with builtins.open(os.path.join(out_path, "_metrics.jsonl")) as f:
+        records = [json.loads(line) for line in f]
+
+    windows = [r for r in records if r["type"] == "window"]
+    workers = [r for r in records if r["type"] == "worker"]
+
+    assert len(workers) == 2 and records[-1]["type"] == "run"
+    assert sum(r["rows"] for r in windows) == sum(r["rows"] for r in workers) == valid
+    assert sum(r["pixels"] for r in windows) == 1100 * 1100
+    assert all(r["read"] > 0 and r["write"] >= 0 for r in windows)
+    assert sum(r["bytes"] for r in workers) == records[-1]["bytes"] > 0
+
+
+def test_grid_index(tmp_path, large_file):
+    """The coordinates rebuilt from the pixel ids and the grid in the metadata match the ones written by default."""
+    filename, valid = large_file
+    lonlat_path = str(tmp_path / "lonlat")
+    grid_path = str(tmp_path / "grid")
+
+    rast_converter([filename, "-o_p", lonlat_path, "-w", "2"])
+    rast_converter([filename, "-o_p", grid_path, "-w", "2", "--grid_index"])
+
+    out = read_table(os.path.join(grid_path, os.listdir(grid_path)[0]))
+    assert out.schema.names == ["pixel_id", "band_var"]
+    assert snoo.grid_spec(grid_path)["sources"]["large"]["width"] == 1100
+
+    conn = snoo.connect(preload_ext=False)
+    lonlat = snoo.table(conn, "lonlat", lonlat_path + "/*.parquet").order_by(["lat", "lon"])
+    grid = snoo.table(conn, "grid", grid_path + "/*.parquet").order_by(["lat", "lon"])
+
+    assert grid.count().execute() == valid
+    assert np.allclose(grid.lon.execute(), lonlat.lon.execute(), atol=1e-4)
+    assert np.allclose(grid.lat.execute(), lonlat.lat.execute(), atol=1e-4)
+    assert (grid.band_var.execute() == lonlat.band_var.execute()).all()
+
+
+def test_grid_index_same_names(tmp_path):
+    """The pixel ids of files sharing a name are decoded with the grid of their own file."""
+    data = np.arange(1, 17, dtype="uint8").reshape(4, 4)
+    for folder, x0 in [("x", 0), ("y", 10)]:
+        os.makedirs(tmp_path / folder)
+        create_raster(str(tmp_path / folder / "a.tif"), data, 0, "epsg:4326", from_origin(x0, 4, 1, 1), 16, 16)
+
+    grid_path = str(tmp_path / "grid")
+    rast_converter([str(tmp_path / "x" / "a.tif"), str(tmp_path / "y" / "a.tif"), "-o_p", grid_path, "-w", "1", "--grid_index"])
+
+    assert sorted(snoo.grid_spec(grid_path)["sources"]) == ["x/a", "y/a"]
+
+    conn = snoo.connect(preload_ext=False)
+    out = snoo.table(conn, "grid", grid_path + "/*.parquet").execute()
+    for name, x0 in [("x/a", 0), ("y/a", 10)]:
+        lons = out.loc[out["source"] == name, "lon"]
+        assert len(lons) == 16
+        assert lons.min() == pytest.approx(x0 + 0.5) and lons.max() == pytest.approx(x0 + 3.5)
+
+
+def test_grid_view_projected(tmp_path):
+    """The H3 cells of a grid in a projected CRS are refused, its coordinates are not longitudes and latitudes."""
+    filename = str(tmp_path / "mercator.tif")
+    create_raster(filename, np.ones((20, 20), dtype="uint8"), 0, "epsg:3857", from_origin(0, 2_000, 100, 100))
+
+    grid_path = str(tmp_path / "grid")
+    rast_converter([filename, "-o_p", grid_path, "-w", "1", "--grid_index", "--out_crs", "epsg:3857"])
+
+    conn = snoo.connect(preload_ext=False)
+    with pytest.raises(ValueError):
+        snoo.grid_view(conn, "grid", grid_path, res=8)
+    assert snoo.grid_view(conn, "grid", grid_path).count().execute() == 400
+
+
+def test_encoding(tmp_path):
+    """The quantised band values are decoded by `snoo.table` within half a step of the raw ones."""
+    filename = str(tmp_path / "temperature.tif")
+    data = np.random.uniform(-30, 45, (200, 300)).astype("float32")
+    create_raster(filename, data, np.nan, "epsg:4326", from_origin(0, 10, 0.01, 0.01), 64, 64)
+
+    raw_path = str(tmp_path / "raw")
+    rast_converter([filename, "-o_p", raw_path, "-w", "2", "--include_negative", "1"])
+
+    conn = snoo.connect(preload_ext=False)
+    raw = snoo.table(conn, "raw", raw_path + "/*.parquet").order_by(["lat", "lon"]).band_var.execute()
+
+    for encoding, step in [("int16", 75 * 1.02 / 65535), ("uint16", 0.01), ("float16", 0.05)]:
+        out_path = str(tmp_path / encoding)
+        options = ["--scale", "0.01", "--offset", "-40"] if encoding == "uint16" else []
+        rast_converter([filename, "-o_p", out_path, "-w", "2", "--include_negative", "1", "--encoding", encoding] + options)
+
+        out = read_table(os.path.join(out_path, os.listdir(out_path)[0]))
+        assert str(out.schema.field("band_var").type) == {"float16": "halffloat"}.get(encoding, encoding)
+
+        decoded = snoo.table(conn, encoding, out_path + "/*.parquet").order_by(["lat", "lon"]).band_var.execute()
+        assert len(decoded) == data.size
+        assert np.abs(decoded.to_numpy() - raw.to_numpy()).max() <= step / 2 + 1e-4
+
+    # the range of the values is read, no statistics are saved next to the raster
+    assert not os.path.exists(filename + ".aux.xml")
+
+
+def test_reproject_coords(tmp_path):
+    """With 'coords', every native pixel is kept once and only the coordinates of its centre are transformed."""
+    filename = str(tmp_path / "mercator.tif")
+    data = np.random.randint(0, 5, (300, 400)).astype("int16")
+    transform = from_origin(-1_100_000, 8_400_000, 1000, 1000)
+    create_raster(filename, data, 0, "epsg:3857", transform, 256, 256)
+
+    out = rast_to_arrow(filename, reproject="coords").read_all()
+
+    rows, cols = np.nonzero(data > 0)
+    lons, lats = Transformer.from_crs("epsg:3857", "epsg:4326", always_xy=True).transform(
+        -1_100_000 + 1000 * (cols + 0.5), 8_400_000 - 1000 * (rows + 0.5)
+    )
+    out = out.sort_by([("lat", "descending"), ("lon", "ascending")])
+
+    assert out.num_rows == len(rows)
+    assert np.allclose(out["lon"].to_numpy(), lons, atol=1e-4)
+    assert np.allclose(out["lat"].to_numpy(), lats, atol=1e-4)
+    assert (out["band_var"].to_numpy() == data[rows, cols]).all()
+
+    same_crs = plan_sources([filenames[0]], {"crs": CRS.from_epsg(4326)})
+    assert not same_crs["sources"][0]["warp"]
+
+
+def test_bench_smoke(tmp_path):
+    """The benchmarks run on a tiny raster and their results can be compared with the stored baseline."""
+    bench_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "benchmarks")
+    spec = importlib.util.spec_from_file_location("bench_rastapar", os.path.join(bench_dir, "bench_rastapar.py"))
+    bench_rastapar = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bench_rastapar)
+
+    out_file = str(tmp_path / "bench.json")
+    bench_rastapar.bench(
+        ["--sizes", "tiny", "-w", "1", "--engines", "threads", "--repeat", "1"]
+        + ["--data_path", str(tmp_path), "-o", out_file, "--baseline", os.path.join(bench_dir, "baseline.json")]
+    )
+
+    with builtins.open(out_file) as f:
+        out = json.load(f)
+    assert out["machine"]["cpus"] > 0
+    assert len(out["results"]) == 1
+    assert len(out["results"][0]["runs_seconds"]) == 1
+
+    comparison = bench_rastapar.compare(out["results"], bench_rastapar.load_results(out_file))
+    assert [case["regression"] for case in comparison] == [False]